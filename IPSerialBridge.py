@@ -6,6 +6,8 @@
 #  
 #
 
+from __future__ import print_function
+
 import errno
 import time
 import socket
@@ -13,6 +15,13 @@ import select
 
 import sys
 
+from ipserial import to_bytes
+
+try:
+    input = raw_input
+except NameError:
+    pass
+
 
 
 
@@ -22,30 +31,36 @@ class IPSerialBridge:
         self.socket = None
         self.address = address
         self.port = port
+        # read() receives straight into this, allocated once
+        self.rxbuffer = bytearray(5)
+        self.rxview = memoryview(self.rxbuffer)
         
     
     def __del__(self):
         self.disconnect()
     
     def connect(self, timeout=1):
+        """
+        raises socket.error if the bridge can't be reached (the caller decides
+        whether to retry or give up)
+        """
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.socket.settimeout(timeout)#timeout)
-        except socket.error, e:
-            print "Some error creating socket: %s" % e
-            sys.exit(1)
-
-        try:
             self.socket.connect((self.address, self.port)) #(self.address, self.port)
             self.socket.setblocking(0)
             self.socket.settimeout(0)
-        except socket.gaierror, e:
-            print "Address-related error connecting to server: %s" % e
-            sys.exit(1)
-        except socket.error, e:
-            print "Connection error: %s" % e
-            sys.exit(1)
+        except socket.gaierror as e:
+            print("Address-related error connecting to server: %s" % e)
+            self.socket.close()
+            self.socket = None
+            raise
+        except socket.error as e:
+            print("Connection error: %s" % e)
+            self.socket.close()
+            self.socket = None
+            raise
         # self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         # self.socket.settimeout(timeout)#timeout)
         # self.socket.connect((self.address, self.port)) #(self.address, self.port)
@@ -57,24 +72,31 @@ class IPSerialBridge:
         
     def disconnect(self):
         #self.kq.control([select.kevent(self.socket, select.KQ_FILTER_READ, select.KQ_EV_DELETE)],0)
-        self.socket.shutdown(socket.SHUT_RDWR)
+        if self.socket is None:
+            return
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
         self.socket.close()
+        self.socket = None
       
     
     def read(self):
         still_reading = 1
-        response = ""
+        received = self.rxbuffer
+        nread = 0
 
-        while(still_reading and len(response)<5):
+        while(still_reading and nread<5):
             try:
-                response += self.socket.recv(5)
-                print "added response from recv: ", response
-                print "response length: ", len(response)
-                if len(response) == 5:
+                nread += self.socket.recv_into(self.rxview[nread:], 5 - nread)
+                print("added response from recv: ", bytes(received[:nread]))
+                print("response length: ", nread)
+                if nread == 5:
                     still_reading = 1
-            except socket.error, (value, message):
-                print "READ error val: %s" % value
-                print "READ error msg: %s" % message
+            except socket.error as E:
+                print("READ error val: %s" % E.errno)
+                print("READ error msg: %s" % E.strerror)
                 # sys.exit(1)
                 # if(value == errno.EWOULDBLOCK or value == errno.EAGAIN):
                     # time.sleep(5.0)
@@ -86,8 +108,9 @@ class IPSerialBridge:
                     # print "Network error"
                     # pass  # TODO deal with this
 
-            if(response != None and len(response) > 0 and response[-1] == '\n'):
+            if(nread > 0 and received[nread-1:nread] == b'\n'):
                 still_reading = 0
+        response = bytes(received[:nread])
         
         
         if(self.verbose):
@@ -97,13 +120,27 @@ class IPSerialBridge:
         return response
 
 
-    def safesend(self, msg):
+    def safesend(self, msg, timeout=1.0):
+        """
+        send all of msg on the non-blocking socket, continuing partial sends
+        once the socket is writable again (raises IOError after timeout
+        seconds without progress)
+        """
+        msg = memoryview(to_bytes(msg))
         msglen = len(msg)
         totalsent = 0
         while totalsent < msglen:
-            sent = self.send(msg[totalsent:])
+            (ready_to_read, ready_to_write, in_error) = select.select([],[self.socket],[], timeout)
+            if(len(ready_to_write) == 0):
+                raise IOError('send timed out after %i of %i bytes' % (totalsent, msglen))
+            try:
+                sent = self.socket.send(msg[totalsent:])
+            except socket.error as E:
+                if E.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                raise
             if sent == 0:
-                raise RuntimeError, 'connection broken'
+                raise RuntimeError('connection broken')
             totalsent = totalsent + sent
 
         return totalsent
@@ -118,7 +155,7 @@ class IPSerialBridge:
             self.read()
         
         # send the outgoing message
-        self.socket.send(message + "\n\r")
+        self.safesend(to_bytes(message) + b"\n\r")
         
         # self.verbose = 0
         if(self.verbose):
@@ -159,7 +196,7 @@ class IPSerialBridge:
             if(len(ready_to_read) != 0):
                 ready = 1
             if(time.time() - tic > timeout):
-                return ""
+                return b""
         # print "%.3f" % (time.time() - tic),
         #r = self.read()
         #print r
@@ -188,16 +225,16 @@ PumpWDraw = """01 DIR WDR
 
 if __name__ == "__main__":
 
-    print "Instantiating"
+    print("Instantiating")
     bridge = IPSerialBridge("192.168.0.10", 100)
     bridge.verbose = 1
     
-    print "Connecting"
+    print("Connecting")
     connecting = None
     try:
         connecting = bridge.connect()
     except socket.error as msg:
-        print "Sending during CONNECTING went bad: ", msg
+        print("Sending during CONNECTING went bad: ", msg)
         # sys.exit(1)
 
     # connecting.close()
@@ -205,11 +242,11 @@ if __name__ == "__main__":
     # if connecting != 0:
     #     sys.exit(1)
 
-    print "Testing"
+    print("Testing")
     try: 
         response = bridge.send("Test")
     except socket.error as msg:
-        print "Sending during TESTING went bad: ", msg
+        print("Sending during TESTING went bad: ", msg)
 
      # connecting.close()
 
@@ -217,35 +254,35 @@ if __name__ == "__main__":
     # response = bridge.send("Test")
 
 
-    print "What test would you like to perform?"
-    print " 1: infuse"
-    print " 2: withdraw"
-    print " 3: stop"
-    cmdIndex = int(raw_input())
+    print("What test would you like to perform?")
+    print(" 1: infuse")
+    print(" 2: withdraw")
+    print(" 3: stop")
+    cmdIndex = int(input())
 
 
     if cmdIndex == 1:
-        print "infusing"
+        print("infusing")
         for command in PumpInfuse.splitlines():
             cmd = command.strip() 
             response = bridge.send(cmd,0)
-            print "Attempting cmd: %s" % cmd 
-            print "out ", response
+            print("Attempting cmd: %s" % cmd) 
+            print("out ", response)
     elif cmdIndex == 2:
-        print "withdrawing"
+        print("withdrawing")
         for command in PumpWDraw.splitlines():
             cmd = command.strip()
             response = bridge.send(cmd,0)
-            print "out ", response
+            print("out ", response)
     elif cmdIndex == 3:
-        print "stopping"
+        print("stopping")
         response = bridge.send("01 STP",1)
-        print "out ", response
+        print("out ", response)
     else:
-        print "Unknown command..."
+        print("Unknown command...")
 
 
-print "out of loop"
+    print("out of loop")
 
 
     # bridge.disconnect()
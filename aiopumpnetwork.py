@@ -0,0 +1,232 @@
+#
+# aiopumpnetwork.py
+#
+# asyncio version of pumpnetwork.NE500Network: same commands, but over
+# non-blocking streams so a single event loop can drive every setup's
+# IP-serial bridge at once (needs python >= 3.7)
+#
+
+import asyncio
+import socket
+
+from ipserial import FrameBuffer, to_bytes
+from pumpreply import STOPPED, PAUSED, ALARM, STATES, parse_reply
+
+
+class AsyncNE500Network(object):
+    recv_size = 4096
+
+    def __init__(self, address, port, npumps=1, timeout=0.01, reply_timeout=1.0):
+        """
+        address : str
+            ip address of the IP-serial bridge
+
+        port : int
+            port to connect to
+
+        npumps : int
+            number of pumps in network
+
+        timeout : float
+            seconds of silence that end a plain read (see read)
+
+        reply_timeout : float
+            default seconds to wait for a reply frame
+        """
+        self.address = address
+        self.port = port
+        self.npumps = npumps
+        self.timeout = timeout
+        self.reply_timeout = reply_timeout
+        self.reader = None
+        self.writer = None
+        self.rxbuffer = FrameBuffer()
+        # one command/reply exchange at a time per bridge
+        self.lock = asyncio.Lock()
+
+    async def connect(self, timeout=1, pump_wait=0.1):
+        """
+        timeout : float
+            connect timeout in seconds (will raise asyncio.TimeoutError on timeout)
+        """
+        if self.writer is not None:
+            raise IOError('Attempt to call connect on already connected bridge: %s:%s' % \
+                (self.address, self.port))
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.address, self.port), timeout)
+        sock = self.writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        await asyncio.sleep(pump_wait)
+        return await self.read()
+
+    async def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.reader = None
+            self.writer = None
+        self.rxbuffer.clear()
+
+    async def _fill(self, timeout):
+        """
+        wait up to timeout seconds for data, returns False on timeout
+        """
+        try:
+            data = await asyncio.wait_for(self.reader.read(self.recv_size), timeout)
+        except asyncio.TimeoutError:
+            return False
+        if not data:
+            raise IOError('connection closed by %s:%s' % (self.address, self.port))
+        self.rxbuffer.feed(data)
+        return True
+
+    async def read(self):
+        """
+        read until the bridge has been quiet for self.timeout seconds
+        """
+        if self.writer is None:
+            raise IOError("read called on not-connected bridge")
+        while await self._fill(self.timeout):
+            pass
+        return self.rxbuffer.take()
+
+    async def read_frame(self, timeout=None):
+        """
+        read one complete STX ... ETX frame, see IPSerial.read_frame
+        """
+        if self.writer is None:
+            raise IOError("read_frame called on not-connected bridge")
+        if timeout is None:
+            timeout = self.reply_timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        frame = self.rxbuffer.pop_frame()
+        while frame is None:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise IOError('no complete frame received within %s seconds' % timeout)
+            await self._fill(remaining)
+            frame = self.rxbuffer.pop_frame()
+        return frame
+
+    async def write(self, data):
+        if self.writer is None:
+            raise IOError("write called on not-connected bridge")
+        self.writer.write(to_bytes(data))
+        await self.writer.drain()
+
+    async def call_and_response(self, data, timeout=None):
+        """
+        send one command and return its reply frame
+
+        timeout : float or None
+            reply deadline, defaults to self.reply_timeout
+        """
+        data = to_bytes(data)
+        if data[-1:] != b'\r':
+            data += b'\r'
+        async with self.lock:
+            await self.write(data)
+            return await self.read_frame(timeout)
+
+    async def status(self, pump):
+        """
+        return the status letter of a pump (S, I, W, P, ... or A for alarm)
+        """
+        reply = await self.call_and_response(b'%02i\r' % pump)
+        return parse_reply(reply).status
+
+    async def wait_until_stopped(self, pump, interval=0.05, timeout=60.0):
+        """
+        poll pump every interval seconds until it reports 'S'
+
+        timeout : float or None
+            give up (raises asyncio.TimeoutError) after this many seconds
+
+        raises IOError if the pump reports paused ('P') or an alarm ('A')
+        """
+        async def poll():
+            while True:
+                status = await self.status(pump)
+                if status == STOPPED:
+                    return
+                if status in (PAUSED, ALARM):
+                    raise IOError("pump %02i reports %s, it won't stop by itself" % (pump, STATES[status]))
+                await asyncio.sleep(interval)
+        await asyncio.wait_for(poll(), timeout)
+
+    async def infuse(self, pump, volume):
+        assert ((pump > 0) and (pump <= self.npumps))
+        volume = float(volume)
+        await self.call_and_response('%02i DIR INF\r' % pump)
+        await self.call_and_response('%02i VOL %.4f\r' % (pump, volume))
+        return await self.call_and_response('%02i RUN\r' % pump)
+
+    async def withdraw(self, pump, volume):
+        assert ((pump > 0) and (pump <= self.npumps))
+        volume = float(volume)
+        await self.call_and_response('%02i DIR WDR\r' % pump)
+        await self.call_and_response('%02i VOL %.4f\r' % (pump, volume))
+        return await self.call_and_response('%02i RUN\r' % pump)
+
+    async def stop(self, pump):
+        assert ((pump > 0) and (pump <= self.npumps))
+        return await self.call_and_response('%02i STP\r' % pump)
+
+    async def reset(self, pump):
+        """This will reset ALL pump params, regardless of its address"""
+        return await self.call_and_response('%02i * RESET\r' % pump)
+
+    async def run_commandset(self, pumpID, commandset, ncycles=1, npumps=1):
+        """
+        see NE500Network.run_commandset
+
+        commandset : dict
+            e.g. from NE500Network.get_commandset
+        """
+        # a single pump is addressed by pumpID, like its RUN below
+        pumps = [pumpID] if npumps == 1 else range(1, npumps+1)
+        runreply = None
+        for n in range(ncycles):
+            for p in pumps:
+                await self.wait_until_stopped(p)
+            for cmd, param in commandset.items():
+                for p in pumps:
+                    await self.call_and_response('%02i %s %s\r' % (p, cmd, param))
+            if npumps == 1:
+                runreply = await self.call_and_response('%02i RUN\r' % pumpID)
+            else:
+                runreply = await self.call_and_response('*RUN\r')
+        return runreply
+
+
+async def run_commandset_on_setups(ipAddresses, port, pumpID, commandset, ncycles=1,
+        npumps=1):
+    """
+    run the same commandset on every setup concurrently
+
+    one setup failing does not stop the others: the result for each address
+    is either its last RUN reply or the exception it raised
+
+    returns dict of {ipAddress: result}
+    """
+    async def run_one(ipAddress):
+        n = AsyncNE500Network(ipAddress, port, npumps=max(npumps, pumpID))
+        await n.connect()
+        try:
+            return await n.run_commandset(pumpID, commandset, ncycles, npumps)
+        finally:
+            await n.disconnect()
+
+    results = await asyncio.gather(*[run_one(ip) for ip in ipAddresses],
+        return_exceptions=True)
+    return dict(zip(ipAddresses, results))
+
+
+def run_setups(ipAddresses, port, pumpID, commandset, ncycles=1, npumps=1):
+    """
+    blocking wrapper around run_commandset_on_setups for non-asyncio callers
+    """
+    return asyncio.run(run_commandset_on_setups(ipAddresses, port, pumpID,
+        commandset, ncycles, npumps))
@@ -9,15 +9,138 @@ import socket
 import select
 
 
+STX = b'\x02'
+ETX = b'\x03'
+
+
+def to_bytes(data):
+    """
+    data as sent on the wire: text commands are ascii encoded, bytes pass
+    through untouched
+    """
+    if isinstance(data, bytes):
+        return data
+    return data.encode('ascii')
+
+
+def to_str(data):
+    """
+    native str of received bytes (for printing, traces and parsing text)
+    """
+    if isinstance(data, str):
+        return data
+    return data.decode('latin-1')
+
+
+class FrameBuffer(object):
+    # initial capacity, it grows if more than this is left unread
+    size = 4096
+
+    def __init__(self, size=None):
+        """
+        receive buffer for an IPSerial socket
+        
+        bytes are received straight into a preallocated bytearray (recv_into)
+        and handed out either as raw bytes (take) or as complete STX ... ETX
+        frames (pop_frame), without building intermediate strings
+        """
+        if size is not None:
+            self.size = size
+        self.buffer = bytearray(self.size)
+        self.view = memoryview(self.buffer)
+        # unread bytes are buffer[start:end]
+        self.start = 0
+        self.end = 0
+    
+    def __len__(self):
+        return self.end - self.start
+
+    def _reserve(self, nbytes):
+        """
+        make room for nbytes more after end
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        if self.end + nbytes <= len(self.buffer):
+            return
+        n = len(self)
+        if n + nbytes <= len(self.buffer):
+            # move the unread bytes to the front
+            self.buffer[:n] = self.buffer[self.start:self.end]
+        else:
+            # new buffer rather than a resize (self.view pins the old one)
+            buffer = bytearray(max(2 * len(self.buffer), n + nbytes))
+            buffer[:n] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.start = 0
+        self.end = n
+    
+    def recv_into(self, sock, nbytes):
+        """
+        receive up to nbytes from sock straight into the buffer
+
+        returns the number of bytes received (0: connection closed)
+        """
+        self._reserve(nbytes)
+        n = sock.recv_into(self.view[self.end:self.end + nbytes], nbytes)
+        self.end += n
+        return n
+
+    def feed(self, data):
+        n = len(data)
+        self._reserve(n)
+        self.buffer[self.end:self.end + n] = data
+        self.end += n
+    
+    def clear(self):
+        self.start = self.end = 0
+    
+    def frame_started(self):
+        """
+        True if the start of a frame (STX) is buffered
+        """
+        return self.buffer.find(STX, self.start, self.end) >= 0
+    
+    def take(self, nbytes=-1):
+        """
+        remove and return up to nbytes buffered bytes (all of them if nbytes < 0)
+        """
+        if nbytes < 0 or nbytes > len(self):
+            nbytes = len(self)
+        resp = self.view[self.start:self.start + nbytes].tobytes()
+        self.start += nbytes
+        return resp
+
+    def pop_frame(self):
+        """
+        remove the next complete frame, STX and ETX included, and return it
+        as bytes
+
+        bytes before the STX are dropped, returns None (and leaves the buffer
+        untouched) if no complete frame has been received yet
+        """
+        start = self.buffer.find(STX, self.start, self.end)
+        if start < 0:
+            return None
+        end = self.buffer.find(ETX, start + 1, self.end)
+        if end < 0:
+            return None
+        self.start = end + 1
+        return self.view[start:end + 1].tobytes()
+
+
 class IPSerial(object):
-    def __init__(self, address, port, timeout=0.01, sleep_on_timeout=0.01, max_timeouts=1,
+    recv_size = 4096
+    
+    def __init__(self, address, port, timeout=0.01, sleep_on_timeout=0.01, max_timeouts=100,
             autoconnect=True):
         """
         address : str
             ip address to connect to
         
         port : int
-            port to connec to
+            port to connect to
         
         timeout : float
             read/write timeout (for select) in seconds
@@ -27,6 +150,7 @@ class IPSerial(object):
         
         max_timeouts : int
             maximum number of read/write timeouts for a given read/write
+            (the default gives a stalled bridge about 1 s to catch up)
         """
         self.socket = None
         self.address = address
@@ -34,12 +158,30 @@ class IPSerial(object):
         self.timeout = timeout
         self.sleep_on_timeout = sleep_on_timeout
         self.max_timeouts = max_timeouts
+        self.rxbuffer = FrameBuffer()
+        # queued, not yet sent (see queue and flush)
+        self.txbuffer = bytearray()
         if autoconnect:
             self.connect()
     
     def __del__(self):
         self.disconnect()
     
+    def _readable(self, timeout):
+        """
+        wait up to timeout seconds for the socket to become readable
+        """
+        r, _, _ = select.select([self.socket], [], [], timeout)
+        return len(r) > 0
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+    def _account(self, sent=0, received=0, retries=0):
+        # bytes moved and timeouts retried, for subclasses that keep totals
+        # (see pumpnetwork.IPSerial)
+        pass
+    
     def connect(self, timeout=1):
         """
         timeout : float
@@ -48,79 +190,170 @@ class IPSerial(object):
         if self.socket is not None:
             raise IOError('Attempt to call connect on already connected socket: %s' % \
                 self.socket)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self.socket.settimeout(timeout)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.socket.connect((self.address, self.port))
-        except socket.timeout as E:
-            # clean up
-            del self.socket
-            self.socket = None
-            # reraise
-            raise E
-        self.socket.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(timeout)
+            sock.connect((self.address, self.port))
+        except socket.error:
+            # clean up (socket.timeout is a socket.error too), then reraise
+            sock.close()
+            raise
+        # reads and writes wait in select, see _fill and flush
+        sock.setblocking(False)
+        self.socket = sock
     
     def disconnect(self):
         if self.socket is not None:
-            self.socket.shutdown(socket.SHUT_RDWR)
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                # already closed by the bridge
+                pass
             self.socket.close()
             del self.socket
             self.socket = None
+        self.rxbuffer.clear()
+        del self.txbuffer[:]
+
+    def is_alive(self):
+        """
+        False if the socket is not connected or the bridge has closed it
+        (anything already waiting on the socket is moved into the receive buffer)
+        """
+        if self.socket is None:
+            return False
+        try:
+            r, _, _ = select.select([self.socket], [], [], 0)
+            if len(r) == 0:
+                return True
+            nbytes = self.rxbuffer.recv_into(self.socket, self.recv_size)
+        except (socket.error, select.error):
+            return False
+        self._account(received=nbytes)
+        return nbytes > 0
+    
+    def _fill(self, timeout):
+        """
+        wait up to timeout seconds for the socket to become readable, then move
+        everything available into the receive buffer with a single recv
+
+        returns True if any data was received, False on timeout
+        """
+        if not self._readable(timeout):
+            return False
+        nbytes = self.rxbuffer.recv_into(self.socket, self.recv_size)
+        if nbytes == 0:
+            raise IOError('connection closed by %s:%s' % (self.address, self.port))
+        self._account(received=nbytes)
+        return True
     
     def read(self, nbytes=-1):
         """
         read nbytes from the socket
         
-        if nbytes 0, return ""
+        if nbytes 0, return b""
         if nbytes <0, read until a timeout
         """
         if self.socket is None:
             raise IOError("read called on not-connected socket")
         if nbytes == 0:
-            return ""
-        resp = ""
+            return b""
         if nbytes < 0:
-            break_on_timeout = True
-            nbytes = 1
-        else:
-            break_on_timeout = False
-        ntimeout = 0
-        while len(resp) < nbytes:
-            r, _, _ = select.select([self.socket], [], [], self.timeout)
-            if len(r) != 0:
-                resp += self.socket.recv(1)
-            else:
-                if break_on_timeout:
-                    return resp
-                else:
+            while self._fill(self.timeout):
+                pass
+            return self.rxbuffer.take()
+        ntimeouts = 0
+        while len(self.rxbuffer) < nbytes:
+            if not self._fill(self.timeout):
+                ntimeouts += 1
+                self._account(retries=1)
+                if ntimeouts >= self.max_timeouts:
+                    raise IOError('read timed out too many times [%s >= %s]' % \
+                        (ntimeouts, self.max_timeouts))
+                self._sleep(self.sleep_on_timeout)
+        return self.rxbuffer.take(nbytes)
+    
+    def read_frame(self, timeout=1.0):
+        """
+        read one complete STX ... ETX frame from the socket
+        
+        returns as soon as the frame is complete, bytes received after the
+        frame stay buffered for the next read
+        
+        timeout : float
+            seconds to wait for the frame (raises IOError on timeout)
+        """
+        if self.socket is None:
+            raise IOError("read_frame called on not-connected socket")
+        deadline = time.time() + timeout
+        frame = self.rxbuffer.pop_frame()
+        while frame is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise IOError('no complete frame received within %s seconds' % timeout)
+            self._fill(remaining)
+            frame = self.rxbuffer.pop_frame()
+        return frame
+    
+    def queue(self, data):
+        """
+        add data to the send buffer without sending it, see flush
+
+        data : bytes or str
+            data to write (str is ascii encoded)
+        """
+        self.txbuffer += to_bytes(data)
+
+    def flush(self):
+        """
+        send everything in the send buffer, in as few segments as the socket
+        takes (several queued commands go out together)
+
+        the socket is non-blocking: partial sends are continued once select
+        reports it writable again, each select that times out counts
+        towards max_timeouts (raises IOError, the unsent rest stays buffered)
+        """
+        if self.socket is None:
+            raise IOError("flush called on not-connected socket")
+        ntimeouts = 0
+        sent = 0
+        view = memoryview(self.txbuffer)
+        try:
+            while sent < len(view):
+                _, w, _ = select.select([], [self.socket], [], self.timeout)
+                if len(w) == 0:
                     ntimeouts += 1
+                    self._account(retries=1)
                     if ntimeouts >= self.max_timeouts:
-                        raise IOError('read timed out too many times [%s >= %s]' % \
+                        raise IOError('write timed out too many times [%s >= %s]' % \
                             (ntimeouts, self.max_timeouts))
-                    time.sleep(self.sleep_on_timeout)
-            # if we're waiting for a timeout, keep reading until we get one
-            if break_on_timeout:
-                nbytes = len(resp) + 1
-        return resp
-    
+                    self._sleep(self.sleep_on_timeout)
+                    continue
+                try:
+                    nbytes = self.socket.send(view[sent:])
+                except socket.error as E:
+                    if E.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        continue
+                    raise
+                sent += nbytes
+                self._account(sent=nbytes)
+        finally:
+            # the view has to go before the buffer can shrink
+            del view
+            del self.txbuffer[:sent]
+
     def write(self, data):
         """
-        write data to the socket
+        write data to the socket (queue, then flush)
         
-        data : str
-            data to write
+        data : bytes or str
+            data to write (str is ascii encoded)
         """
         if self.socket is None:
             raise IOError("write called on not-connected socket")
-        ntimeouts = 0
-        while ntimeouts < self.max_timeouts:
-            _, w, _ = select.select([], [self.socket], [], self.timeout)
-            if (len(w) != 0):
-                self.socket.send(data)
-                return
-        raise IOError('write timed out too many times [%s >= %s]' % \
-            (ntimeouts, self.max_timeouts))
+        self.queue(data)
+        self.flush()
     
     def write_then_read(self, data, nbytes=-1, pause=0.1):
         """
@@ -136,8 +369,21 @@ class IPSerial(object):
             seconds to wait between write and read
         """
         self.write(data)
-        time.sleep(pause)
+        self._sleep(pause)
         return self.read(nbytes)
+    
+    def write_then_read_frame(self, data, timeout=1.0):
+        """
+        write, then wait for the reply frame (no fixed pause)
+        
+        data : str
+            see write
+        
+        timeout : float
+            seconds to wait for the reply frame, see read_frame
+        """
+        self.write(data)
+        return self.read_frame(timeout)
 
 
 class NE500Network(IPSerial):
@@ -0,0 +1,202 @@
+#
+# pumpbench.py
+#
+# Round-trip latency and throughput of the pumpnetwork transport, measured
+# against local simulated bridges (see pumpsim.py). Prints (or writes) the
+# results as JSON so runs can be compared:
+#
+#   python pumpbench.py --n 500 --latency 0.001 --output bench.json
+#
+
+import os
+import sys
+import json
+import time
+import platform
+import threading
+from contextlib import contextmanager
+
+import pumpsim
+import pumpnetwork
+
+
+# simulated pumping time runs this much faster, so RUNs finish at once
+SIM_SPEED = 1e6
+
+
+def percentile(samples, p):
+    """
+    nearest-rank percentile of a sorted list
+    """
+    k = int(round(p / 100. * (len(samples) - 1)))
+    return samples[k]
+
+
+def summarize(samples):
+    """
+    latency summary (in ms) of a list of durations in seconds
+    """
+    samples = sorted(samples)
+    ms = lambda s: round(s * 1000., 4)
+    return {
+        'n': len(samples),
+        'mean_ms': ms(sum(samples) / len(samples)),
+        'p50_ms': ms(percentile(samples, 50)),
+        'p95_ms': ms(percentile(samples, 95)),
+        'p99_ms': ms(percentile(samples, 99)),
+        'max_ms': ms(samples[-1]),
+    }
+
+
+@contextmanager
+def quiet():
+    # NE500Network.run_commandset and friends print as they go
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def time_calls(func, n):
+    samples = []
+    for i in range(n):
+        tic = time.time()
+        func()
+        samples.append(time.time() - tic)
+    return samples
+
+
+def connect(sim, reply_timeout):
+    return pumpnetwork.NE500Network(sim.address[0], sim.address[1], npumps=2,
+        reply_timeout=reply_timeout)
+
+
+def bench_commands(n, count):
+    """
+    round-trip latency per command type on one connection
+    """
+    commandset = n.get_commandset('training')
+
+    def run_commandset():
+        with quiet():
+            n.run_commandset(1, commandset, npumps=2)
+
+    benchmarks = [
+        ('status', lambda: n.call_and_response('01')),
+        ('set_rate', lambda: n.call_and_response('01 RAT 100.0')),
+        ('query_dis', lambda: n.call_and_response('01 DIS')),
+        ('infuse', lambda: n.infuse(1, 0.02)),
+        ('run_commandset', run_commandset),
+    ]
+    results = {}
+    for name, func in benchmarks:
+        func()  # warm up (connection, parameter cache)
+        results[name] = summarize(time_calls(func, count))
+    return results
+
+
+def bench_throughput(n, count, max_inflight=(1, 2, 4)):
+    """
+    status queries per second on one connection, one at a time and pipelined
+    """
+    commands = ['%02i' % (i % 2 + 1) for i in range(count)]
+    results = {}
+
+    tic = time.time()
+    for data in commands:
+        n.call_and_response(data)
+    results['sequential'] = round(count / (time.time() - tic), 1)
+
+    for k in max_inflight:
+        tic = time.time()
+        n.call_pipelined(commands, max_inflight=k)
+        results['pipelined_%i' % k] = round(count / (time.time() - tic), 1)
+    return results
+
+
+def bench_scaling(nsetups, count, latency, reply_timeout):
+    """
+    total status queries per second with one thread per setup, all running
+    at the same time
+    """
+    sims = [pumpsim.BridgeSimulator(2, latency=latency, speed=SIM_SPEED).start()
+        for i in range(nsetups)]
+    networks = [connect(sim, reply_timeout) for sim in sims]
+
+    def work(n):
+        for i in range(count):
+            n.call_and_response('01')
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in networks]
+    tic = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - tic
+
+    for n, sim in zip(networks, sims):
+        n.disconnect()
+        sim.stop()
+    return {
+        'setups': nsetups,
+        'seconds': round(elapsed, 4),
+        'commands_per_second': round(nsetups * count / elapsed, 1),
+    }
+
+
+def run(count=200, latency=0.0, reply_timeout=1.0, setups=(1, 2, 4, 9)):
+    """
+    run every benchmark, returns the results as a dict
+
+    reply_timeout : float or None
+        see NE500Network, None benchmarks the fixed-pause mode
+    """
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'count': count,
+            'latency': latency,
+            'reply_timeout': reply_timeout,
+        },
+    }
+    sim = pumpsim.BridgeSimulator(2, latency=latency, speed=SIM_SPEED).start()
+    n = connect(sim, reply_timeout)
+    try:
+        results['latency'] = bench_commands(n, count)
+        results['throughput'] = bench_throughput(n, count)
+    finally:
+        n.disconnect()
+        sim.stop()
+    results['scaling'] = [bench_scaling(k, count, latency, reply_timeout) for k in setups]
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='pumpnetwork transport benchmarks')
+    parser.add_argument('--n', type=int, default=200,
+        help='commands per benchmark')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='simulated bridge reply latency in seconds')
+    parser.add_argument('--pause', action='store_true',
+        help='benchmark the fixed-pause mode (reply_timeout=None), slow')
+    parser.add_argument('--setups', default='1,2,4,9',
+        help='comma separated setup counts for the scaling benchmark')
+    parser.add_argument('--output', default=None,
+        help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    results = run(args.n, args.latency, None if args.pause else 1.0,
+        [int(k) for k in args.setups.split(',')])
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
@@ -0,0 +1,483 @@
+#
+# pumpd.py
+#
+# Long-running pump controller: holds the bridge connections (a BridgePool
+# read by one Reactor) and the pumps' cached state, and takes commands as
+# JSON-RPC 2.0 over a Unix domain socket, so task software triggers a
+# reward with one local round trip instead of starting Python and
+# connecting to the bridge:
+#
+#   python pumpd.py serve --socket /tmp/pumpd.sock --setup 1=192.168.0.2
+#
+#   client = PumpClient('/tmp/pumpd.sock')
+#   client.infuse(1, 1, 0.02)        # setup 1, pump 1, 0.02 in VOL units
+#   client.status(1, 1)['status']    # 'I'
+#
+# one request or response per line, e.g.
+#
+#   {"jsonrpc": "2.0", "id": 1, "method": "infuse",
+#    "params": {"setup": 1, "pump": 1, "volume": 0.02}}
+#
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from ipserial import to_str
+from pumpreply import parse_reply
+from pumpprofiles import default_profiles
+from pumpreactor import Reactor
+from pumpnetwork import BridgePool, fire_synchronized, run_synchronized
+
+
+DEFAULT_SOCKET = '/tmp/pumpd.sock'
+
+# the facility's bridges, see pumpnetwork.__main__
+DEFAULT_SETUPS = dict((i, '192.168.0.%i' % (2 * i)) for i in range(1, 10))
+DEFAULT_PORT = 100
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+PUMP_ERROR = -32000
+
+# seconds run_profile and run_synchronized wait for pumps to stop, less
+# than PumpClient's timeout so the client gets the error
+ARM_TIMEOUT = 3.0
+
+
+class RPCError(IOError):
+    def __init__(self, code, message):
+        IOError.__init__(self, '%s (%s)' % (message, code))
+        self.code = code
+        self.message = message
+
+
+def reply_dict(frame):
+    """
+    a reply frame as JSON-able dict, None for no reply
+    """
+    if frame is None:
+        return None
+    reply = parse_reply(frame)
+    return {
+        'address': reply.address,
+        'status': reply.status,
+        'ok': reply.ok,
+        'error': reply.error,
+        'alarm': reply.alarm,
+        'data': reply.data,
+        'description': reply.describe(),
+        'frame': to_str(frame),
+    }
+
+
+class PumpDaemon(object):
+    def __init__(self, path=DEFAULT_SOCKET, setups=None, port=DEFAULT_PORT, pool=None,
+            reactor=None):
+        """
+        path : str
+            Unix domain socket to listen on
+
+        setups : dict
+            {setupID : ipAddress}, defaults to DEFAULT_SETUPS
+
+        port : int
+            bridge port, see IPSerial
+
+        pool : BridgePool or None
+            connections to use, defaults to a BridgePool of NE500Networks
+            (2 pumps, reply_timeout 1 s) whose replies are read by reactor
+
+        reactor : pumpreactor.Reactor or None
+            defaults to a Reactor started (and closed) by the daemon
+        """
+        if setups is None:
+            setups = DEFAULT_SETUPS
+        self.path = path
+        self.setups = dict(setups)
+        self.port = port
+        self.reactor = None
+        if pool is None:
+            if reactor is None:
+                reactor = self.reactor = Reactor().start()
+            pool = BridgePool(npumps=2, reply_timeout=1.0, reactor=reactor)
+        self.pool = pool
+        self.server = None
+        self.thread = None
+
+    # ---------------- RPC methods (rpc_<method>) ----------------
+
+    def rpc_ping(self):
+        return {'time': time.time()}
+
+    def rpc_setups(self):
+        return dict((str(s), address) for s, address in self.setups.items())
+
+    def rpc_profiles(self):
+        return dict((name, dict(profile)) for name, profile in default_profiles().items())
+
+    def rpc_infuse(self, setup, pump, volume):
+        with self._lease(setup) as n:
+            return reply_dict(n.infuse(pump, float(volume)))
+
+    def rpc_withdraw(self, setup, pump, volume):
+        with self._lease(setup) as n:
+            return reply_dict(n.withdraw(pump, float(volume)))
+
+    def rpc_stop(self, setup, pump):
+        with self._shared(setup) as n:
+            return reply_dict(n.call_and_response('%02i STP\r' % pump))
+
+    def rpc_status(self, setup, pump):
+        with self._shared(setup) as n:
+            return reply_dict(n.call_and_response('%02i\r' % pump))
+
+    def rpc_run_profile(self, setup, profile, pumps=(1,), timeout=ARM_TIMEOUT):
+        """
+        set a profile (see pumpprofiles) on pumps of one setup and start them
+        together, waiting up to timeout seconds for them to stop first
+        """
+        pumps = list(pumps)
+        with self._lease(setup) as n:
+            line = n.arm(pumps, n.get_commandset(profile), float(timeout))
+            results = fire_synchronized([(setup, n, pumps, line)])
+        return dict((str(p), reply_dict(results[(setup, p)]['reply'])) for p in pumps)
+
+    def rpc_run_synchronized(self, setups, pumps=(1, 2), profile=None, timeout=ARM_TIMEOUT):
+        """
+        see pumpnetwork.run_synchronized (timeout is its arm_timeout),
+        results keyed 'setup:pump'
+        """
+        commandset = None
+        if profile is not None:
+            commandset = default_profiles()[profile]
+        result = run_synchronized(dict((s, self._address(s)) for s in setups), self.port,
+            list(pumps), commandset, arm_timeout=float(timeout), pool=self.pool)
+        pumps = {}
+        for (s, p), r in result['pumps'].items():
+            r = dict(r)
+            r['reply'] = reply_dict(r['reply'])
+            pumps['%s:%s' % (s, p)] = r
+        return {'pumps': pumps, 'spread': result['spread']}
+
+    # -------------------------------------------------------------
+
+    def _address(self, setup):
+        try:
+            return self.setups[setup]
+        except KeyError:
+            raise KeyError('unknown setup %r' % (setup,))
+
+    def _lease(self, setup):
+        return self.pool.lease(self._address(setup), self.port)
+
+    @contextmanager
+    def _shared(self, setup):
+        # the connection without waiting for the lease if its replies are
+        # routed by a ReplyReader (see BridgePool.shared): a STP mustn't
+        # queue behind a run_profile waiting for that pump to stop
+        n = self.pool.shared(self._address(setup), self.port)
+        if n is not None:
+            yield n
+            return
+        with self._lease(setup) as n:
+            yield n
+
+    def handle(self, request):
+        """
+        answer one decoded JSON-RPC request, returns the response dict (None
+        for notifications)
+        """
+        response = self._answer(request)
+        if isinstance(request, dict) and 'id' not in request:
+            # notifications are never answered, not even with an error
+            return None
+        return response
+
+    def _answer(self, request):
+        if not isinstance(request, dict) or 'method' not in request:
+            return self._error(None, INVALID_REQUEST, 'invalid request')
+        rid = request.get('id')
+        method = getattr(self, 'rpc_%s' % request['method'], None)
+        if method is None:
+            return self._error(rid, METHOD_NOT_FOUND, 'no method %r' % request['method'])
+        params = request.get('params', {})
+        try:
+            if isinstance(params, dict):
+                result = method(**dict((str(k), v) for k, v in params.items()))
+            else:
+                result = method(*params)
+        except TypeError as E:
+            return self._error(rid, INVALID_PARAMS, str(E))
+        except (socket.error, IOError, KeyError, ValueError, AssertionError) as E:
+            return self._error(rid, PUMP_ERROR, '%s: %s' % (E.__class__.__name__, E))
+        except Exception as E:
+            # a bug, but the client still gets an answer
+            return self._error(rid, INTERNAL_ERROR, '%s: %s' % (E.__class__.__name__, E))
+        return {'jsonrpc': '2.0', 'id': rid, 'result': result}
+
+    def _error(self, rid, code, message):
+        return {'jsonrpc': '2.0', 'id': rid, 'error': {'code': code, 'message': message}}
+
+    def connect_all(self):
+        """
+        connect to every setup now, so the first command doesn't pay for it
+
+        returns {setupID : error} for the setups that couldn't be reached
+        """
+        errors = {}
+        for setup in sorted(self.setups):
+            try:
+                with self._lease(setup):
+                    pass
+            except (socket.error, IOError) as E:
+                errors[setup] = str(E)
+        return errors
+
+    def listen(self):
+        """
+        bind the Unix socket (replacing a stale one left by a daemon that
+        died, raises IOError if another daemon is listening)
+        """
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.unlink(self.path)
+            else:
+                raise IOError('a daemon is already listening on %s' % self.path)
+            finally:
+                probe.close()
+        self.server = _RPCServer(self.path, _RPCHandler)
+        self.server.daemon = self
+        return self
+
+    def serve_forever(self):
+        if self.server is None:
+            self.listen()
+        self.server.serve_forever()
+
+    def start(self):
+        """
+        serve from a background thread
+        """
+        if self.server is None:
+            self.listen()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def shutdown(self):
+        """
+        stop serving, remove the socket, close the bridge connections
+        """
+        if self.server is not None:
+            if self.thread is not None:
+                self.server.shutdown()
+                self.thread.join()
+                self.thread = None
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        self.pool.close_all()
+        if self.reactor is not None:
+            self.reactor.close()
+            self.reactor = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+class _RPCHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.daemon
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError as E:
+                response = daemon._error(None, PARSE_ERROR, str(E))
+            else:
+                response = daemon.handle(request)
+            if response is not None:
+                try:
+                    self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+                except socket.error:
+                    # the client gave up on it (see PumpClient.call)
+                    return
+
+    def finish(self):
+        try:
+            socketserver.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+
+class _RPCServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class PumpClient(object):
+    def __init__(self, path=DEFAULT_SOCKET, timeout=5.0):
+        """
+        connection to a PumpDaemon, kept open between calls
+
+        timeout : float
+            seconds to wait for a response (RUNs wait for pumps to stop first)
+        """
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.connect()
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+        self.rfile = self.sock.makefile('rb')
+
+    def call(self, method, *args, **kwargs):
+        """
+        call method with args or kwargs (not both) and return its result
+
+        after a timeout the connection is closed (the late response must not
+        be read as the next one) and the next call connects again
+
+        raises RPCError if the daemon reports an error, IOError (socket.error)
+        if it doesn't answer
+        """
+        with self.lock:
+            if self.sock is None:
+                self.connect()
+            self.next_id += 1
+            rid = self.next_id
+            request = {'jsonrpc': '2.0', 'id': rid, 'method': method,
+                'params': kwargs or list(args)}
+            try:
+                self.sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+                line = self.rfile.readline()
+            except socket.error:
+                self.close()
+                raise
+            if not line:
+                self.close()
+                raise IOError('connection to %s closed' % self.path)
+            response = json.loads(line.decode('utf-8'))
+            if response.get('id') != rid:
+                self.close()
+                raise IOError('response id %r does not match request id %r' % \
+                    (response.get('id'), rid))
+        if 'error' in response:
+            raise RPCError(response['error']['code'], response['error']['message'])
+        return response['result']
+
+    def ping(self):
+        return self.call('ping')
+
+    def infuse(self, setup, pump, volume):
+        return self.call('infuse', setup=setup, pump=pump, volume=volume)
+
+    def withdraw(self, setup, pump, volume):
+        return self.call('withdraw', setup=setup, pump=pump, volume=volume)
+
+    def stop(self, setup, pump):
+        return self.call('stop', setup=setup, pump=pump)
+
+    def status(self, setup, pump):
+        return self.call('status', setup=setup, pump=pump)
+
+    def run_profile(self, setup, profile, pumps=(1,), timeout=ARM_TIMEOUT):
+        return self.call('run_profile', setup=setup, profile=profile, pumps=list(pumps),
+            timeout=timeout)
+
+    def run_synchronized(self, setups, pumps=(1, 2), profile=None, timeout=ARM_TIMEOUT):
+        return self.call('run_synchronized', setups=list(setups), pumps=list(pumps),
+            profile=profile, timeout=timeout)
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.rfile.close()
+        self.sock.close()
+        self.sock = None
+        self.rfile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    import signal
+    import argparse
+
+    parser = argparse.ArgumentParser(description='NE500 pump controller daemon')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    serve = commands.add_parser('serve', help='run the daemon')
+    serve.add_argument('--setup', action='append', default=[],
+        help='setupID=ipAddress (repeat), defaults to the 9 facility setups')
+    serve.add_argument('--port', type=int, default=DEFAULT_PORT)
+    call = commands.add_parser('call', help='call a daemon method and print the result')
+    call.add_argument('method')
+    call.add_argument('params', nargs='?', default='{}',
+        help='JSON object (or list) of parameters')
+    args = parser.parse_args()
+
+    if args.command == 'call':
+        params = json.loads(args.params)
+        with PumpClient(args.socket) as client:
+            if isinstance(params, dict):
+                result = client.call(args.method, **params)
+            else:
+                result = client.call(args.method, *params)
+        print(json.dumps(result, indent=2, sort_keys=True))
+        sys.exit(0)
+
+    setups = None
+    if args.setup:
+        setups = dict((int(s.split('=')[0]), s.split('=')[1]) for s in args.setup)
+    daemon = PumpDaemon(args.socket, setups, args.port).listen()
+    for setup, error in sorted(daemon.connect_all().items()):
+        print("setup%i not reachable yet: %s" % (setup, error))
+    # SIGTERM ends serve_forever like Ctrl-C does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Listening on %s" % args.socket)
+    try:
+        daemon.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        daemon.shutdown()
@@ -4,156 +4,177 @@
 # DATE:  02.15.2013 (jyr)
 #
 
+from __future__ import print_function
+
 import sys
 
 import errno
 import time
+import random
 import socket
 import select
+import atexit
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import IPSerialBridge
+import ipserial
+from ipserial import FrameBuffer, to_bytes, to_str
+from pumpreply import STOPPED, PAUSED, ALARM, STATES, FrameError, number, parse_reply
+from pumpprofiles import Profile, default_profiles
+from pumptrace import CommandRecord
 
+try:
+    input = raw_input
+except NameError:
+    pass
 
-class IPSerial(object):
-    def __init__(self, address, port, timeout=0.01, sleep_on_timeout=0.01, max_timeouts=1,
-            autoconnect=True):
-        """
-        address : str
-            ip address to connect to
-        
-        port : int
-            port to connect to
-        
-        timeout : float
-            read/write timeout (for select() in seconds
-        
-        sleep_on_timeout : float
-            seconds to wait after a read/write timeout
-        
-        max_timeouts : int
-            maximum number of read/write timeouts for a given read/write
-        """
-        self.socket = None
-        self.address = address
-        self.port = port
-        self.timeout = timeout
-        self.sleep_on_timeout = sleep_on_timeout
-        self.max_timeouts = max_timeouts
-        if autoconnect:
-            self.connect()
 
-    
-    def __del__(self):
-        self.disconnect()
+# commands that can safely be sent again after a lost connection: status,
+# parameter queries and writes, stopping (not RUN, CLD, RESET, DIR REV, ...)
+IDEMPOTENT = ('', 'DIA', 'RAT', 'VOL', 'DIR', 'DIS', 'PHN', 'FUN', 'STP')
 
-    
-    def connect(self, timeout=1):
+
+def idempotent(data):
+    """
+    True if command data can be sent twice with the same effect as once
+    """
+    text = to_str(data).strip()
+    if '*' in text:
+        # broadcasts and bursts
+        return False
+    words = text.split()
+    if words and words[0].isdigit():
+        words = words[1:]
+    if not words:
+        return True
+    cmd = words[0].upper()
+    if cmd == 'DIR' and words[1:2] == ['REV']:
+        return False
+    return cmd in IDEMPOTENT
+
+
+def param_order(commandset):
+    """
+    commandset keys with DIA first (setting DIA changes RAT/VOL units)
+    """
+    return sorted(commandset.keys(), key=lambda cmd: cmd != 'DIA')
+
+
+def param_value(param):
+    """
+    comparable value of a command parameter: float if numeric, else str
+    """
+    param = str(param)
+    value = number(param)
+    if value is None:
+        return param
+    return value
+
+
+class IPSerial(ipserial.IPSerial):
+    def __init__(self, *args, **kwargs):
         """
-        timeout : float
-            connect timeout in seconds (will raise socket.timeout on timeout)
+        ipserial.IPSerial that keeps running totals of its socket traffic and
+        calls trace hooks after every command/reply exchange, see add_hook
+
+        (same arguments as ipserial.IPSerial)
         """
-        if self.socket is not None:
-            raise IOError('Attempt to call connect on already connected socket: %s' % \
-                self.socket)
-        try:    
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            self.socket.settimeout(timeout)
-        except socket.error, e:
-            print "Some error creating socket: %s" % e
-            sys.exit(1)
-        try:
-            self.socket.connect((self.address, self.port))
-        except socket.timeout as E:
-            # clean up
-            del self.socket
-            self.socket = None
-            # reraise
-            raise E
-        self.socket.settimeout(None)
-    
-    def disconnect(self):
-        if self.socket is not None:
-            self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()
-            del self.socket
-            self.socket = None
-    
-    def read(self, nbytes=-1):
+        self.hooks = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.select_wait = 0.0
+        self.sleep_time = 0.0
+        self.retries = 0
+        # set before connecting (autoconnect)
+        ipserial.IPSerial.__init__(self, *args, **kwargs)
+
+    def _readable(self, timeout):
+        tic = time.time()
+        readable = ipserial.IPSerial._readable(self, timeout)
+        self.select_wait += time.time() - tic
+        return readable
+
+    def _sleep(self, seconds):
+        self.sleep_time += seconds
+        time.sleep(seconds)
+
+    def _account(self, sent=0, received=0, retries=0):
+        self.bytes_sent += sent
+        self.bytes_received += received
+        self.retries += retries
+
+    def add_hook(self, hook):
         """
-        read nbytes from the socket
-        
-        if nbytes 0, return ""
-        if nbytes <0, read until a timeout
+        call hook(record) with a pumptrace.CommandRecord after every
+        command/reply exchange (see pumptrace for ready-made hooks)
         """
-        if self.socket is None:
-            raise IOError("read called on not-connected socket")
-        if nbytes == 0:
-            return ""
-        resp = ""
-        if nbytes < 0:
-            break_on_timeout = True
-            nbytes = 1
-        else:
-            break_on_timeout = False
-        ntimeouts = 0
-        while len(resp) < nbytes:
-            r, _, _ = select.select([self.socket], [], [], self.timeout)
-            if len(r) != 0:
-                resp += self.socket.recv(1)
-            else:
-                if break_on_timeout:
-                    return resp
-                else:
-                    ntimeouts += 1
-                    if ntimeouts >= self.max_timeouts:
-                        raise IOError('read timed out too many times [%s >= %s]' % \
-                            (ntimeouts, self.max_timeouts))
-                    time.sleep(self.sleep_on_timeout)
-            # if we're waiting for a timeout, keep reading until we get one
-            if break_on_timeout:
-                nbytes = len(resp) + 1
+        self.hooks.append(hook)
 
-        return resp
-    
-    def write(self, data):
-        """
-        write data to the socket
-        
-        data : str
-            data to write
-        """
-        if self.socket is None:
-            raise IOError("write called on not-connected socket")
-        ntimeouts = 0
-        while ntimeouts < self.max_timeouts:
-            _, w, _ = select.select([], [self.socket], [], self.timeout)
-            if (len(w) != 0):
-                self.socket.send(data)
-                return
-        raise IOError('write timed out too many times [%s >= %s]' % \
-            (ntimeouts, self.max_timeouts))
-    
-    def write_then_read(self, data, nbytes=-1, pause=0.1):
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _trace_start(self):
+        if not self.hooks:
+            return None
+        return (time.time(), self.bytes_sent, self.bytes_received, self.select_wait,
+            self.sleep_time, self.retries)
+
+    def _trace_end(self, trace, data, resp, error=None, pending=()):
         """
-        write, then read from the socket (with an options brief pause)
-        
-        data : str
-            see write
-        
-        nbytes : int
-            see read
-        
-        pause : float
-            seconds to wait between write and read
+        pass the exchange's CommandRecord to the hooks
+
+        pending : list of PendingReply
+            the replies, if a ReplyReader received them. The reader receives
+            for every thread, and others write while these replies are waited
+            for, so the running totals aren't this exchange's: bytes are
+            counted from data and resp instead, and select_wait is the time
+            from the end of the write to the last reply (sleep and retries
+            are still totals over the exchange)
         """
-        self.write(data)
-        time.sleep(pause)
-
-        return self.read(nbytes)
+        if trace is None:
+            return
+        tic, sent, received, select_wait, sleep_time, retries = trace
+        toc = time.time()
+        sent = self.bytes_sent - sent
+        received = self.bytes_received - received
+        select_wait = self.select_wait - select_wait
+        if pending:
+            sent = len(data)
+            received = len(resp)
+            written = [p.sent for p in pending if p.sent is not None]
+            if written:
+                replied = [p.time for p in pending if p.time is not None]
+                select_wait = max(replied or [toc]) - min(written)
+            else:
+                select_wait = 0.0
+        # records hold native strs, so hooks don't depend on the wire format
+        command = to_str(data).rstrip('\r')
+        resp = to_str(resp)
+        pump = None
+        if command[:2].isdigit():
+            pump = int(command[:2])
+        status = ''
+        if resp[:1] == '\x02':
+            status = resp[3:4]
+        record = CommandRecord(tic, self.address, self.port, pump, command, status,
+            resp, sent, received, select_wait, self.sleep_time - sleep_time,
+            toc - tic, self.retries - retries,
+            None if error is None else str(error))
+        for hook in self.hooks:
+            hook(record)
 
 
 class NE500Network(IPSerial):
+    # longest '*'-separated command burst line sent in one go
+    max_burst_length = 64
+
     def __init__(self, *args, **kwargs):
         """
         see IPSerial for additional args and kwargs
@@ -166,67 +187,483 @@ class NE500Network(IPSerial):
         nsetups : int
             number of setups in network
 
+        reply_timeout : float or None
+            if None (default), commands sleep for a fixed pause before reading
+            the reply. Otherwise commands return as soon as the reply frame
+            arrives, waiting at most reply_timeout seconds for it.
+
+        verbose : bool
+            print every command and reply
+
+        reactor : pumpreactor.Reactor or None
+            if given, start_reader(reactor=reactor) once connected, so one
+            thread reads every bridge sharing the reactor
+
+        reconnect_attempts : int
+            connection attempts when the bridge drops the connection during a
+            command (see reconnect), 0 disables reconnecting
+
+        backoff, max_backoff : float
+            seconds between connection attempts, doubling from backoff up to
+            max_backoff (with random jitter)
+
+        profiles : dict or None
+            {name: pumpprofiles.Profile} for get_commandset, defaults to the
+            shared pumpprofiles.default_profiles()
+
         """
+        self.verbose = kwargs.pop('verbose', 0)
         self.npumps = kwargs.pop('npumps', 1)
         self.nsetups = kwargs.pop('nsetups', 4)
+        self.reply_timeout = kwargs.pop('reply_timeout', None)
+        self.reconnect_attempts = kwargs.pop('reconnect_attempts', 3)
+        self.backoff = kwargs.pop('backoff', 0.1)
+        self.max_backoff = kwargs.pop('max_backoff', 2.0)
+        self.profiles = kwargs.pop('profiles', None)
+        reactor = kwargs.pop('reactor', None)
+        # last acknowledged DIA/RAT/VOL/DIR per pump: {pump: {cmd: param}}
+        self.pumpstate = {}
+        # latest RewardProgram compiled by infuse/withdraw: {(pump, dir): program}
+        self.programs = {}
+        # PumpPrograms stored on the pumps and their RUN triggers: {pump: (program, frame)}
+        self.uploaded = {}
+        # replies still due for commands a CommandPipeline gave up on, dropped
+        # when they arrive: {pump: count}
+        self.stale = {}
+        # held for every command/reply exchange, so threads (e.g. a
+        # pumpstatus.StatusPoller) can share the connection. With a
+        # ReplyReader running it is only held while writing.
+        self.lock = threading.RLock()
+        self.reader = None
+        # the PendingReply this thread's exchange is waiting for, see read_frame
+        self._local = threading.local()
         IPSerial.__init__(self, *args, **kwargs)
+        if reactor is not None:
+            self.start_reader(reactor=reactor)
 
     def connect(self, timeout=1, pump_wait=0.1):
         IPSerial.connect(self, timeout)
+        if self.reader is not None:
+            self.reader.attach()
+        # pumps may have been changed (or reset) while we were away
+        self.pumpstate = {}
+        self.uploaded = {}
+        self.stale = {}
         time.sleep(pump_wait)
         return self.read()
 
-    def response_read(self, nbytes=5):
-        assert nbytes > 2
-        resp = IPSerial.read(self, nbytes)
+    def start_reader(self, poll_interval=0.1, reactor=None):
+        """
+        hand the read side of the connection to a ReplyReader thread: replies
+        are routed to the command waiting for that pump, commands to
+        different pumps no longer wait for each other, and alarms nobody
+        asked for go to reader.alarms
+
+        reactor : pumpreactor.Reactor or None
+            read on the reactor's thread, shared with other bridges, instead
+            of a thread per connection
+
+        returns the ReplyReader (also self.reader)
+        """
+        with self.lock:
+            if self.reader is None:
+                self.reader = ReplyReader(self, poll_interval, reactor).start()
+            return self.reader
+
+    def stop_reader(self):
+        """
+        stop the ReplyReader, reads go back to the calling thread
+        """
+        with self.lock:
+            reader, self.reader = self.reader, None
+        if reader is not None:
+            reader.stop()
+
+    def disconnect(self):
+        reader = getattr(self, 'reader', None)
+        if reader is not None:
+            reader.detach()
+        IPSerial.disconnect(self)
+        if reader is not None:
+            # replies to anything written before can't arrive anymore
+            reader._fail(IOError('disconnected from %s:%s' % (self.address, self.port)))
+
+    def is_alive(self):
+        if self.reader is not None:
+            return self.reader.alive()
+        return IPSerial.is_alive(self)
+
+    def read(self, nbytes=-1):
+        """
+        see IPSerial.read, with a ReplyReader running: the frames no command
+        was waiting for, received until a timeout
+        """
+        if self.reader is None:
+            return IPSerial.read(self, nbytes)
+        if self.socket is None:
+            raise IOError("read called on not-connected socket")
+        frames = []
+        while True:
+            try:
+                frames.append(self.reader.unclaimed.get(True, self.timeout))
+            except queue.Empty:
+                return b''.join(frames)
+
+    def read_frame(self, timeout=1.0):
+        """
+        see IPSerial.read_frame, with a ReplyReader running: the reply to the
+        command this thread is exchanging, or the next frame no command was
+        waiting for
+        """
+        if self.reader is None:
+            return IPSerial.read_frame(self, timeout)
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:
+            self._local.pending = None
+            return pending.result(timeout)
+        try:
+            return self.reader.unclaimed.get(True, timeout)
+        except queue.Empty:
+            raise IOError('no complete frame received within %s seconds' % timeout)
 
-        while not ('\x02' in resp and '\x03' in resp):
-            resp = IPSerial.read(self, nbytes)
-            print resp
+    def response_read(self, timeout=1.0):
+        resp = self.read_frame(timeout)
+        self.check_alarm(resp)
 
         if(self.verbose):
-            print("RECEIVED (%s; %s): %s" % (self.address, str(self), resp))
+            print("RECEIVED (%s; %s): %s" % (self.address, str(self), to_str(resp)))
 
         return resp
 
-    def call_and_response(self, data, nbytes=5, pause=0.1):
-        if data[-1] != '\r':
-            data += '\r'
-        self.write(data)
+    def check_alarm(self, resp):
+        reply = parse_reply(resp)
+        if reply.status == ALARM and reply.address is not None:
+            # alarm (stall, power reset, ...): pump params can't be trusted
+            self.pumpstate.pop(reply.address, None)
+        return reply
 
+    def _exchange_once(self, data, receive):
+        """
+        write data, then return receive() (traced, see add_hook)
+        """
+        if self.reader is not None:
+            return self._exchange_reader(data, receive)
+        with self.lock:
+            trace = self._trace_start()
+            try:
+                self.write(data)
+
+                if(self.verbose):
+                    print("SENDING (%s; %s): %s\n\r" % (self.address, str(self), to_str(data)))
+
+                resp = receive()
+            except Exception as E:
+                self._trace_end(trace, data, b'', E)
+                raise
+            self._trace_end(trace, data, resp)
+            return resp
+
+    def _exchange_reader(self, data, receive):
+        # the reply is registered and data written under the lock, so replies
+        # from one pump are handed out in the order the commands went out.
+        # It is waited for without the lock: read_frame takes it from
+        # self._local.pending
+        trace = self._trace_start()
+        with self.lock:
+            pending = self.reader.expect(data)
+            try:
+                self.write(data)
+            except Exception as E:
+                self.reader.cancel(pending, sent=False)
+                self._trace_end(trace, data, b'', E, [pending])
+                raise
+            pending.sent = time.time()
         if(self.verbose):
-            print("SENDING (%s; %s): %s\n\r" % (self.address, str(self), data))
+            print("SENDING (%s; %s): %s\n\r" % (self.address, str(self), to_str(data)))
+        self._local.pending = pending
+        try:
+            resp = receive()
+        except Exception as E:
+            self.reader.cancel(pending)
+            self._trace_end(trace, data, b'', E, [pending])
+            raise
+        finally:
+            self._local.pending = None
+        self._trace_end(trace, data, resp, pending=[pending])
+        return resp
 
-        time.sleep(pause)
+    def _exchange(self, data, receive):
+        """
+        _exchange_once, but if the connection turns out to be broken,
+        reconnect and send data once more if it is idempotent
 
-        return self.response_read(nbytes)
+        errors with the connection still up (e.g. reply timeouts) are raised
+        as they are, so are errors of commands that can't be repeated (after
+        reconnecting, so the next command finds the connection working)
+        """
+        with (self.lock if self.reader is None else _Unlocked()):
+            try:
+                return self._exchange_once(data, receive)
+            except (socket.error, IOError) as E:
+                error = E
+            with self.lock:
+                if self.reconnect_attempts < 1 or self.is_alive():
+                    raise error
+                self.reconnect()
+            if not idempotent(data):
+                raise error
+            self.retries += 1
+            return self._exchange_once(data, receive)
+
+    def reconnect(self, attempts=None):
+        """
+        close the connection and connect again, up to attempts times
+        (default: reconnect_attempts) waiting backoff seconds between
+        attempts (doubling, with random jitter), then resync the parameter
+        cache with what the pumps report
 
-    def call_and_read(self, data, nbytes=-1, pause=0.1):
-        if data[-1] != '\r':
-            data += '\r'
-        self.write(data)
+        raises IOError if every attempt fails
+        """
+        if attempts is None:
+            attempts = max(self.reconnect_attempts, 1)
+        delay = self.backoff
+        with self.lock:
+            pumpstate = self.pumpstate
+            for attempt in range(attempts):
+                if attempt > 0:
+                    self._sleep(delay * random.uniform(0.5, 1.5))
+                    delay = min(delay * 2, self.max_backoff)
+                self.disconnect()
+                try:
+                    self.connect()
+                    self.resync(pumpstate)
+                    return
+                except (socket.error, IOError) as E:
+                    error = E
+            self.disconnect()
+        raise IOError('could not reconnect to %s:%s in %i attempts: %s' % \
+            (self.address, self.port, attempts, error))
+
+    def resync(self, pumpstate=None):
+        """
+        rebuild the parameter cache from the pumps: every pump is asked for
+        its status (which also reports and clears alarms), and pumps that
+        answer normally for the parameters cached in pumpstate (default:
+        the current cache)
 
-        if(self.verbose):
-            print("SENDING (%s; %s): %s\n\r" % (self.address, str(self), data))
+        returns {pump: status letter}
+        """
+        if pumpstate is None:
+            pumpstate = self.pumpstate
+        timeout = self.reply_timeout or 1.0
+        receive = lambda: self.response_read(timeout)
+        statuses = {}
+        with self.lock:
+            self.pumpstate = {}
+            for pump in range(1, self.npumps + 1):
+                reply = parse_reply(self._exchange_once(b'%02i\r' % pump, receive))
+                statuses[pump] = reply.status
+                if not reply.ok:
+                    continue
+                for cmd in pumpstate.get(pump, {}):
+                    reply = parse_reply(self._exchange_once(
+                        to_bytes('%02i %s\r' % (pump, cmd)), receive))
+                    if reply.ok:
+                        self.pumpstate.setdefault(pump, {})[cmd] = reply.value()
+        return statuses
+
+    def call_and_response(self, data, pause=0.1, timeout=None):
+        """
+        timeout : float or None
+            per-command reply deadline, overrides reply_timeout (and skips the
+            fixed pause) for this command only
+        """
+        data = to_bytes(data)
+        if data[-1:] != b'\r':
+            data += b'\r'
+
+        if timeout is None:
+            timeout = self.reply_timeout
+        if timeout is None:
+            def receive():
+                self._sleep(pause)
+                return self.response_read()
+        else:
+            receive = lambda: self.response_read(timeout)
 
-        time.sleep(pause)
+        return self._exchange(data, receive)
 
-        return self.read()
+    def call_and_read(self, data, nbytes=-1, pause=0.1, timeout=None):
+        data = to_bytes(data)
+        if data[-1:] != b'\r':
+            data += b'\r'
 
-    def infuse(self, pump, volume):
+        if timeout is None:
+            timeout = self.reply_timeout
+        if timeout is None:
+            def receive():
+                self._sleep(pause)
+                return self.read()
+        else:
+            # first reply frame, plus whatever else (e.g. other pumps) followed it
+            receive = lambda: self.read_frame(timeout) + self.read()
+
+        return self._exchange(data, receive)
+
+    def write_then_read(self, data, nbytes=-1, pause=0.1):
+        if self.reply_timeout is None:
+            def receive():
+                self._sleep(pause)
+                return self.read(nbytes)
+        else:
+            receive = lambda: self.read_frame(self.reply_timeout)
+
+        return self._exchange(data, receive)
+
+    def status(self, pump):
+        """
+        status letter of pump ('S', 'I', 'W', 'P' or 'A'), never waits
+        a fixed pause
+        """
+        reply = self.call_and_response(b'%02i\r' % pump, timeout=self.reply_timeout or 1.0)
+        return parse_reply(reply).status
+
+    def wait_until_stopped(self, pump, timeout=60.0, interval=0.01, max_interval=0.5):
+        """
+        poll pump until it reports stopped ('S')
+
+        the polling interval starts at interval seconds and doubles up to
+        max_interval while the pump keeps running
+
+        timeout : float or None
+            raise IOError if the pump is still running after this many
+            seconds, None waits for as long as it takes
+
+        raises IOError if the pump reports paused ('P') or an alarm ('A'):
+        it won't stop on its own
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            status = self.status(pump)
+            if status == STOPPED:
+                return
+            if status in (PAUSED, ALARM):
+                raise IOError("pump %02i reports %s, it won't stop by itself" % (pump, STATES[status]))
+            if deadline is not None and time.time() + interval > deadline:
+                raise IOError('pump %02i still running after %s seconds' % (pump, timeout))
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+    def set_param(self, pump, cmd, param):
+        """
+        send '<pump> <cmd> <param>' unless pump already holds param
+
+        pump : int
+            pump address
+
+        cmd : str
+            parameter command, e.g. 'DIA', 'RAT', 'VOL', 'DIR'
+
+        param : str or number
+            numbers are compared by value, so '0.02' and '0.0200' match
+
+        returns the reply frame, or None if nothing had to be sent
+        """
+        value = param_value(param)
+        state = self.pumpstate.get(pump, {})
+        if state.get(cmd) == value:
+            return None
+
+        self.leave_program(pump)
+        reply = self.call_and_response('%02i %s %s\r' % (pump, cmd, param))
+        self._note_param(pump, cmd, value, reply)
+        return reply
+
+    def _note_param(self, pump, cmd, value, reply):
+        """
+        update pumpstate after sending a parameter (reply None: no answer)
+        """
+        if cmd == 'DIA':
+            # a new diameter changes the units (and values) of RAT and VOL
+            self.pumpstate.pop(pump, None)
+        if reply is not None and parse_reply(reply).ok:
+            self.pumpstate.setdefault(pump, {})[cmd] = value
+        else:
+            self.pumpstate.pop(pump, None)
+
+    def set_params(self, pump, commandset):
+        """
+        set_param for every cmd in commandset, DIA first (see set_param)
+
+        returns list of (cmd, reply) for the commands that were sent
+        """
+        replies = []
+        if isinstance(commandset, Profile):
+            # precompiled frames, nothing to format
+            state = self.pumpstate.get(pump, {})
+            for cmd, value, frame in commandset.setup(pump):
+                if state.get(cmd) != value:
+                    self.leave_program(pump)
+                    reply = self.call_and_response(frame)
+                    self._note_param(pump, cmd, value, reply)
+                    replies.append((cmd, reply))
+                    state = self.pumpstate.get(pump, {})
+            return replies
+        for cmd in param_order(commandset):
+            reply = self.set_param(pump, cmd, commandset[cmd])
+            if reply is not None:
+                replies.append((cmd, reply))
+        return replies
+
+    def call_frame(self, frame, timeout=None):
+        """
+        send a precompiled command (bytes ending in b'\r') and return the reply
+        frame, no formatting, no fixed pause
+
+        timeout : float or None
+            reply deadline, defaults to reply_timeout (or 1 s)
+        """
+        timeout = timeout or self.reply_timeout or 1.0
+        return self._exchange(frame, lambda: self.response_read(timeout))
+
+    def compile_reward(self, pump, volume, direction='INF'):
+        """
+        check and format a delivery once, see RewardProgram and fire
+        """
         assert ((pump > 0) and (pump <= self.npumps))
-        assert isinstance(volume, float)
-        self.write_then_read('%02i DIR INF\r' % pump)
-        self.write_then_read('%02i VOL %.4f\r' % (pump, volume))
-        self.write_then_read('%02i RUN\r' % pump)
+        return RewardProgram(pump, volume, direction)
+
+    def fire(self, program, timeout=None):
+        """
+        run a RewardProgram: its DIR/VOL commands are sent only if the pump
+        doesn't hold those values already, then RUN
+
+        returns the reply to RUN
+        """
+        pump = program.pump
+        # RUN would run the uploaded program instead
+        self.leave_program(pump)
+        for cmd, value, frame in program.setup:
+            if self.pumpstate.get(pump, {}).get(cmd) != value:
+                self._note_param(pump, cmd, value, self.call_frame(frame, timeout))
+        return self.call_frame(program.run, timeout)
+
+    def _reward(self, pump, volume, direction):
+        volume = float(volume)
+        program = self.programs.get((pump, direction))
+        if program is None or program.volume != volume:
+            program = self.programs[(pump, direction)] = \
+                self.compile_reward(pump, volume, direction)
+        return self.fire(program)
+
+    def infuse(self, pump, volume):
+        return self._reward(pump, volume, 'INF')
 
     
     def withdraw(self, pump, volume):
-        assert ((pump > 0) and (pump <= self.npumps))
-        assert isinstance(volume, float)
-        self.write_then_read('%02i DIR WDR\r' % pump)
-        self.write_then_read('%02i VOL %.4f\r' % (pump, volume))
-        self.write_then_read('%02i RUN\r' % pump)
+        return self._reward(pump, volume, 'WDR')
 
 
     # =============== Command functions ========================
@@ -237,7 +674,7 @@ class NE500Network(IPSerial):
     # --sets the units for VOL and DIS, too
     
     # if syringe < 10 ml, VOL units microL; if >= 10 ml (i.e., 
-    #       14.01-50.0 mm DIA), VOL units ml
+    #       14.01-50.0 mm DIA), VOL units ml (see pumpprofiles.volume_units)
     # RAT [<float>] : rate of pumping, can change while running
     # VOL [<float>] : vol to be inf/wdr. 
     # --if VOL = 0.0, continuous and can change direction. 
@@ -245,24 +682,88 @@ class NE500Network(IPSerial):
     #       for a given direction, INF | WDR)
     # DIR [str] : INF | WDR 
     # -- DIR REV will reverse pumping direction I <--> W
+    # PHN [<int>] : program phase (1-41) that FUN, RAT, VOL, DIR apply to
+    # FUN RAT | STP | LPS | LOP <n> : function of the phase, pump (RAT),
+    # --stop and go back to phase 1 (STP), loop start (LPS), loop back n times (LOP)
+    # --see PumpProgram and upload_program
 
     def continuous_flow(self, pump, commandset, continuous=1):
-        response=""
-        alarm = -1
-        while (alarm) < 0:
-            for cmd, param in commandset.items():
-                reply = self.write_then_read('%02i %s %.4f' % (pump, cmd, param))
-                # do sth where next command not sent until til current command processed
-                # completion of command processing = when first byte of resp packet transmitted
-                alarm == reply.find('?')
-                return
-        print "Alarm detected in pump %02i, of type %s" % (pump, reply)
-        # do other stuff...
-        # command errors:
-        # '?' = command not recog
-        # '?NA' = command not applicable
-        # '?OOR' = command data out of range
-        # 'A' = alarm
+        # params are written directly below, not through set_param
+        self.leave_program(pump)
+        self.pumpstate.pop(pump, None)
+        for cmd, param in commandset.items():
+            # next command not sent until the current one is processed
+            # completion of command processing = when first byte of resp packet transmitted
+            reply = parse_reply(self.call_and_response('%02i %s %.4f' % (pump, cmd, param)))
+            if not reply.ok:
+                # do other stuff...
+                print("Alarm detected in pump %02i, of type %s" % (pump, reply.describe()))
+                return reply
+        # command errors and alarms: see pumpreply.ERRORS and pumpreply.ALARMS
+
+    def upload_program(self, pump, program, verify=True):
+        """
+        store a PumpProgram on a (stopped) pump, so that each delivery only
+        needs trigger(pump): one RUN and one round trip
+
+        verify : bool
+            read every phase back and compare it to the program
+
+        raises IOError if the pump is running or rejects or misreports a phase
+        """
+        assert ((pump > 0) and (pump <= self.npumps))
+        if self.status(pump) != STOPPED:
+            raise IOError('pump %02i must be stopped to upload a program' % pump)
+
+        timeout = self.reply_timeout or 1.0
+        self.uploaded.pop(pump, None)
+        # the phase 1 values are the ones pumpstate tracks
+        self.pumpstate.pop(pump, None)
+        for cmd in program.commands(pump):
+            reply = self.call_and_response(cmd, timeout=timeout)
+            if not parse_reply(reply).ok:
+                raise IOError('pump %02i rejected %r: %r' % (pump, cmd, reply))
+
+        if verify:
+            for phase, expected in enumerate(program.phases, 1):
+                self.call_and_response('%02i PHN %i\r' % (pump, phase), timeout=timeout)
+                for cmd, value in expected:
+                    reply = self.call_and_response('%02i %s\r' % (pump, cmd), timeout=timeout)
+                    if not same_value(parse_reply(reply).value(), value):
+                        raise IOError('pump %02i phase %i: %s is %r, expected %r' % \
+                            (pump, phase, cmd, reply, value))
+
+        # deliveries start at the first phase
+        self.call_and_response('%02i PHN 1\r' % pump, timeout=timeout)
+        self.uploaded[pump] = (program, b'%02i RUN\r' % pump)
+
+    def trigger(self, pump, timeout=None):
+        """
+        run the program uploaded to pump (see upload_program)
+
+        returns the reply to RUN
+        """
+        if pump not in self.uploaded:
+            raise IOError('no program uploaded to pump %02i' % pump)
+        return self.call_frame(self.uploaded[pump][1], timeout)
+
+    def leave_program(self, pump):
+        """
+        turn the program uploaded to pump back into a single pumping phase
+        (PHN 1 FUN RAT, PHN 2 FUN STP), before plain parameter writes: the
+        program's phases stay stored on the pump, and RUN would run them
+
+        phase 1 keeps the rate it holds on the pump (nothing is cached for
+        it since upload_program, so set_params sends RAT again)
+        """
+        if pump not in self.uploaded:
+            return
+        timeout = self.reply_timeout or 1.0
+        for cmd in ('PHN 1', 'FUN RAT', 'PHN 2', 'FUN STP', 'PHN 1'):
+            reply = self.call_and_response('%02i %s\r' % (pump, cmd), timeout=timeout)
+            if not parse_reply(reply).ok:
+                raise IOError('pump %02i rejected %r: %r' % (pump, cmd, reply))
+        del self.uploaded[pump]
 
     def stop(self, pump):
         assert ((pump > 0) and (pump <= self.npumps))
@@ -270,114 +771,95 @@ class NE500Network(IPSerial):
 
     def reset(self, pump):
         """This will reset ALL pump params, regardless of its address"""
+        self.pumpstate = {}
+        self.uploaded = {}
         self.write_then_read('%02i * RESET\r' % pump)
 
     def get_commandset(self, mode):
         """set of pertinent commands and associated parameters for particular pump modes
 
-        cmdset is a str [ 'training' | 'cleaning' ]
-
-        cmds : list of str elements
-            ['DIA', 'RAT', 'VOL', 'DIR', 'DIS']
-
-        params : list of str elements
-
-        'cleaning' : dict
-            {'DIA':'15.0', 'RAT':'100.0', 'VOL':'1.0', 'DIR':'WDR'}
-
-        'cleaning_rev' : dict
-            {'DIA':'15.0', 'RAT':'100.0', 'VOL':'1.0', 'DIR':'INF'}
+        mode is a profile name, e.g. 'training', 'cleaning', 'cleaning_rev'
+        (see pumpprofiles.ini)
 
-        'training' : dict 
+        returns a pumpprofiles.Profile, a read-only dict-like
             {'DIA':'15.0', 'RAT':'100.0', 'VOL':'0.02', 'DIR':'INF'}
-        """
-
-        cmds = ['DIA', 'RAT', 'VOL', 'DIR']
-        if mode == 'cleaning':
-            # faster rate than training mode - first, infuse 10.0ml, then withdraw.
-            params = ['15.0', '500.0', '1.0', 'INF']
-            pump_commands = dict(zip(cmds, params))
-        elif mode == 'cleaning_rev':
-            # reverse, from infuse, now WITHDRAW same amt...
-            params = ['15.0', '500.0', '1.0', 'WDR']
-            pump_commands = dict(zip(cmds, params))
+        shared by every network, don't copy it to change it: add a profile
 
-        elif mode == 'training':
-            params = ['15.0', '100.0', '0.02', 'INF'] # default
-            pump_commands = dict(zip(cmds, params))
-        return pump_commands
+        raises KeyError for unknown modes
+        """
+        if self.profiles is None:
+            self.profiles = default_profiles()
+        try:
+            return self.profiles[mode]
+        except KeyError:
+            raise KeyError('unknown pump profile %r (known: %s)' % \
+                (mode, ', '.join(sorted(self.profiles))))
 
     def run_commands(self, pumpID, commandset, ncycles=1, npumps=1):
+        runreply = None
         try:
-            print "Running commands to pump network..."
-            print "commands: ", commandset
-            status = self.call_and_response('%02i\r' % pumpID)
-            while not 'S' in status:
-                status = self.call_and_response('%02i\r' % pumpID)
-
-            print "SENDING commandset..."  
-            for i, cmd in enumerate(commandset.keys()):
-                print cmd
-                # right now, this sends 1 command to 1 pump at a time...
-                if npumps == 1:
-                    reply = self.call_and_response('%02i %s %s\r' \
-                                % (pumpID, cmd, commandset[cmd]), nbytes=5)
-                    print reply
-                elif npumps > 1:
-                    for p in range(1, npumps+1):
-                        status = self.call_and_response('%02i\r' % p)
-                        while not 'S' in status:
-                            status = self.call_and_response('%02i\r' % p)
-                        reply = self.call_and_response('%02i %s %s\r' \
-                                    % (p, cmd, commandset[cmd]), nbytes=5)
-                        print reply
-
-            print "Now, RUNNING commandset..."  
+            print("Running commands to pump network...")
+            print("commands: ", commandset)
+            self.wait_until_stopped(pumpID)
+
+            print("SENDING commandset...")  
+            # right now, this sends 1 command to 1 pump at a time...
+            # (and only what the pump doesn't hold already, see set_params)
+            if npumps == 1:
+                pumps = [pumpID]
+            else:
+                pumps = range(1, npumps+1)
+            for p in pumps:
+                if npumps > 1:
+                    self.wait_until_stopped(p)
+                for cmd, reply in self.set_params(p, commandset):
+                    print(cmd)
+                    print(reply)
+
+            print("Now, RUNNING commandset...")  
             if npumps == 1:
-                runreply = self.call_and_response('%02i RUN\r' % pumpID, nbytes=5)
+                runreply = self.call_and_response('%02i RUN\r' % pumpID)
             elif npumps == 2:
                 for p in range(1, npumps+1):
-                    status = self.call_and_response('%02i\r' % p)
-                    while not 'S' in status:
-                        status = self.call_and_response('%02i\r' % p)
-                    print "all good, pump %i" % p
+                    self.wait_until_stopped(p)
+                    print("all good, pump %i" % p)
                 runreply = self.call_and_read('*RUN\r', nbytes=2)
-                print runreply
-            print "Completed cycle." 
-        except socket.error, (value, message):
-            print "READ error val: %s" % value
-            print "READ error msg: %s" % message
+                print(runreply)
+            print("Completed cycle.") 
+        except (socket.error, IOError) as E:
+            # still there after reconnecting (see NE500Network._exchange)
+            print("READ error: %s" % E)
+            raise
+        return runreply
 
 
     def run_commandset(self, pumpID, commandset, ncycles=1, npumps=1): # commandset is a dict (pump_commands):
     
-        print "Running commands to pump network..."
-        print "commands: ", commandset
+        print("Running commands to pump network...")
+        print("commands: ", commandset)
 
+        runreply = None
         try:    
             for n in range(ncycles):
-                status = self.call_and_response('%02i\r' % pumpID)
-                while not 'S' in status:
-                    status = self.call_and_response('%02i\r' % pumpID)
-
-                print "Starting CYCLE: %i" % n
-                for i, cmd in enumerate(commandset.keys()):
-                    print cmd
-                    # right now, this sends 1 command to 1 pump at a time...
-                    for p in range(1, npumps+1):
-                        reply = self.call_and_response('%02i %s %s\r' \
-                                    % (p, cmd, commandset[cmd]), nbytes=5)
-                        print reply
-
-                print "Now, RUNNING commandset, for cycle: %i" % n
+                self.wait_until_stopped(pumpID)
+
+                print("Starting CYCLE: %i" % n)
+                # right now, this sends 1 command to 1 pump at a time...
+                # (and only what the pump doesn't hold already, see set_params)
+                for p in range(1, npumps+1):
+                    for cmd, reply in self.set_params(p, commandset):
+                        print(cmd)
+                        print(reply)
+
+                print("Now, RUNNING commandset, for cycle: %i" % n)
                 if n == 0: # first cycle, or only 1 cycle
                     if npumps == 1:
-                        runreply = self.call_and_response('%02i RUN\r' % pumpID, nbytes=5)
+                        runreply = self.call_and_response('%02i RUN\r' % pumpID)
                     elif npumps == 2:
                         # self.write_then_read('01 ADR DUAL\r')
-                        runreply = self.call_and_response('*RUN\r', nbytes=5)
+                        runreply = self.call_and_response('*RUN\r')
                         # self.write_then_read('* ADR 01\r')
-                    print "Completed first cycle."
+                    print("Completed first cycle.")
                 elif n > 0:
                     # print 'got to next cycle: cycle %i' % n
                     # DON'T SEND THE NEXT "RUN" command until pump done with first "run"
@@ -387,19 +869,20 @@ class NE500Network(IPSerial):
                     #     status = self.call_and_response('%02i\r' % pumpID)
 
                     if npumps == 1:
-                        runreply = self.call_and_response('%02i RUN\r' % pumpID, nbytes=5)
+                        runreply = self.call_and_response('%02i RUN\r' % pumpID)
                     elif npumps == 2:
                         # self.write_then_read('01 ADR DUAL\r')
-                        runreply = self.call_and_response('*RUN\r', nbytes=5)
+                        runreply = self.call_and_response('*RUN\r')
                         # self.write_then_read('* ADR 01\r')
-                    print "Completed CYCLE NO: %i" % n
-        except socket.error, (value, message):
-            print "READ error val: %s" % value
-            print "READ error msg: %s" % message
+                    print("Completed CYCLE NO: %i" % n)
+        except (socket.error, IOError) as E:
+            # still there after reconnecting (see NE500Network._exchange)
+            print("READ error: %s" % E)
+            raise
 
 
         return runreply
-        print "Successful command run."
+        print("Successful command run.")
 
     # other commnds of interest (for pump network):  
     
@@ -412,8 +895,900 @@ class NE500Network(IPSerial):
     # volume dispensed: DIS -- just queries, returns: I<float> W<float> <vol units>, good for how much liquid dispensed!
     # clear volume dispensd:  CLD {INF|WIDR} -- sets to 0.
 
+    def send_burst(self, burst, timeout=None):
+        """
+        send a CommandBurst, packed into as few burst lines as
+        max_burst_length allows, and collect the replies per pump
+
+        timeout : float or None
+            seconds to wait for all replies to one burst line, defaults to
+            reply_timeout (or 1 s)
+
+        returns list of (pump, cmd, param, reply) in the order the commands
+        were added, reply is None if that pump didn't answer in time
+        """
+        if timeout is None:
+            timeout = self.reply_timeout or 1.0
+        results = []
+        with self.lock:
+            for line, commands in burst.pack(self.max_burst_length):
+                trace = self._trace_start()
+                waiting = []
+                if self.reader is not None:
+                    # one reply per pump, registered before the line goes out
+                    waiting = [(pump, self.reader.expect(line, pump)) for pump, cmd, param
+                        in commands]
+                try:
+                    self.write(line)
+                except Exception:
+                    for pump, pending in waiting:
+                        self.reader.cancel(pending, sent=False)
+                    raise
+                for pump, pending in waiting:
+                    pending.sent = time.time()
+                if(self.verbose):
+                    print("SENDING (%s; %s): %s\n\r" % (self.address, str(self), line))
+
+                replies = {}
+                deadline = time.time() + timeout
+                for pump, pending in waiting:
+                    try:
+                        replies[pump] = pending.result(max(deadline - time.time(), 0))
+                    except IOError:
+                        self.reader.cancel(pending)
+                # without a reader, only frames from pumps on this line count
+                owing = set(pump for pump, cmd, param in commands) if not waiting else set()
+                while owing:
+                    remaining = deadline - time.time()
+                    try:
+                        reply = self.read_frame(max(remaining, 0))
+                    except IOError:
+                        break
+                    try:
+                        address = self.check_alarm(reply).address
+                    except FrameError:
+                        # garbled, not a reply to anything on this line
+                        continue
+                    if address in owing:
+                        owing.discard(address)
+                        replies[address] = reply
+                self._trace_end(trace, line, b''.join(replies.values()),
+                    pending=[pending for pump, pending in waiting])
+                for pump, cmd, param in commands:
+                    results.append((pump, cmd, param, replies.get(pump)))
+        return results
+
+    def set_params_burst(self, pumps, commandset):
+        """
+        like set_params, but for several pumps at once: every parameter that
+        has to change goes out as one burst line for all pumps
+
+        returns list of (pump, cmd, param, reply) for the commands that were sent
+        """
+        burst = CommandBurst()
+        for cmd in param_order(commandset):
+            for p in pumps:
+                if self.pumpstate.get(p, {}).get(cmd) != param_value(commandset[cmd]):
+                    self.leave_program(p)
+                    burst.add(p, cmd, commandset[cmd])
+
+        results = self.send_burst(burst)
+        for pump, cmd, param, reply in results:
+            self._note_param(pump, cmd, param_value(param), reply)
+        return results
+
+    def arm(self, pumps, commandset=None, timeout=60.0):
+        """
+        get pumps ready to start together: wait until they are stopped, set
+        commandset (if any) with bursts, and format their RUN
+
+        timeout : float or None
+            seconds to wait for all the pumps to stop (together, not each),
+            None waits for as long as it takes
 
-def set_pump_network(setupID, pumpID, ipAddress, port, npumps=1):
+        returns the RUN line (bytes) for fire_synchronized, one burst line
+        for several pumps
+
+        raises IOError if a pump doesn't stop (see wait_until_stopped) or
+        rejects a parameter, or if the RUNs don't fit in one burst line
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        for p in pumps:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+            self.wait_until_stopped(p, remaining)
+        if commandset is not None:
+            for pump, cmd, param, reply in self.set_params_burst(pumps, commandset):
+                if reply is None or not parse_reply(reply).ok:
+                    raise IOError('pump %02i: %s %s failed (%r)' % (pump, cmd, param, reply))
+        if len(pumps) == 1:
+            return b'%02i RUN\r' % pumps[0]
+        burst = CommandBurst()
+        for p in pumps:
+            burst.add(p, 'RUN')
+        lines = burst.pack(self.max_burst_length)
+        if len(lines) > 1:
+            raise IOError('RUN for pumps %s is longer than one %i character burst line, '
+                'start fewer pumps together' % (list(pumps), self.max_burst_length))
+        return to_bytes(lines[0][0])
+
+    def call_pipelined(self, commands, max_inflight=1, timeout=None):
+        """
+        send commands through a CommandPipeline and return their replies
+        (in order), see CommandPipeline for when this is safe to use
+        """
+        if self.reader is not None:
+            # the reader matches replies to pumps, just wait for each in turn
+            return [self.call_and_response(data, timeout=timeout or self.reply_timeout or 1.0)
+                for data in commands]
+        with self.lock:
+            pipeline = CommandPipeline(self, max_inflight, timeout)
+            pending = [pipeline.submit(data) for data in commands]
+            pipeline.flush()
+        return [p.result(0) for p in pending]
+
+
+def same_value(a, b):
+    """
+    equal, numbers within the 4 significant digits the pumps keep
+    """
+    if isinstance(a, float) and isinstance(b, float):
+        return abs(a - b) <= 5e-4 * max(abs(a), abs(b), 1e-3)
+    return a == b
+
+
+class PumpProgram(object):
+    # NE500 program phases hold up to 41 phases
+    max_phases = 41
+
+    def __init__(self):
+        """
+        pumping program (sequence of phases) to store on a pump, see
+        NE500Network.upload_program. Build it phase by phase:
+
+            program = PumpProgram().rate(100.0, 0.02, 'INF').stop()
+
+        or use PumpProgram.reward
+        """
+        self.phases = []
+
+    @classmethod
+    def reward(cls, volume, rate, direction='INF'):
+        """
+        single delivery of volume at rate, then stop
+        """
+        return cls().rate(rate, volume, direction).stop()
+
+    def _add(self, phase):
+        if len(self.phases) >= self.max_phases:
+            raise ValueError('NE500 programs hold at most %i phases' % self.max_phases)
+        self.phases.append(tuple(phase))
+        return self
+
+    def rate(self, rate, volume, direction='INF'):
+        """
+        pump volume at rate (FUN RAT phase)
+        """
+        assert direction in ('INF', 'WDR')
+        return self._add([('FUN', 'RAT'), ('RAT', float(rate)), ('VOL', float(volume)),
+            ('DIR', direction)])
+
+    def loop_start(self):
+        """
+        start of a loop (FUN LPS phase)
+        """
+        return self._add([('FUN', 'LPS')])
+
+    def loop(self, count):
+        """
+        go back to the last loop_start, count times in total (FUN LOP phase)
+        """
+        assert ((count >= 2) and (count <= 99))
+        return self._add([('FUN', 'LOP%02i' % count)])
+
+    def stop(self):
+        """
+        end of the program (FUN STP phase), it returns to phase 1
+        """
+        return self._add([('FUN', 'STP')])
+
+    def commands(self, pump):
+        """
+        the commands that store the program on pump
+        """
+        commands = []
+        for phase, settings in enumerate(self.phases, 1):
+            commands.append('%02i PHN %i\r' % (pump, phase))
+            for cmd, value in settings:
+                if cmd == 'FUN' and value.startswith('LOP'):
+                    value = 'LOP %s' % value[3:]
+                elif isinstance(value, float):
+                    value = '%.4g' % value
+                commands.append('%02i %s %s\r' % (pump, cmd, value))
+        return commands
+
+    def __repr__(self):
+        return 'PumpProgram(%r)' % (self.phases,)
+
+
+class RewardProgram(object):
+    __slots__ = ('pump', 'volume', 'direction', 'setup', 'run')
+
+    def __init__(self, pump, volume, direction='INF'):
+        """
+        one delivery (DIR, VOL, RUN) for one pump, formatted once so it can be
+        fired repeatedly with NE500Network.fire
+
+        pump : int
+            pump address
+
+        volume : float
+            in the pump's VOL units
+
+        direction : str
+            'INF' or 'WDR'
+        """
+        assert direction in ('INF', 'WDR')
+        volume = float(volume)
+        vol = '%.4f' % volume
+        self.pump = pump
+        self.volume = volume
+        self.direction = direction
+        # (cmd, cache value, frame)
+        self.setup = (
+            ('DIR', direction, to_bytes('%02i DIR %s\r' % (pump, direction))),
+            ('VOL', param_value(vol), to_bytes('%02i VOL %s\r' % (pump, vol))),
+        )
+        self.run = b'%02i RUN\r' % pump
+
+    def __repr__(self):
+        return 'RewardProgram(%r, %r, %r)' % (self.pump, self.volume, self.direction)
+
+
+class PendingReply(object):
+    def __init__(self, data):
+        """
+        reply to a command that has been sent, but maybe not answered yet
+
+        data : bytes
+            the command
+        """
+        self.data = data
+        self.reply = None
+        self.error = None
+        self.event = threading.Event()
+        # when the command had been written (if a reader is waiting for it)
+        self.sent = None
+        # when the reply (or error) came in
+        self.time = None
+        # see IPSerial._trace_start
+        self.trace = None
+        # a reply to the same pump was dropped as stale while this one
+        # waited: it may have been this reply, so a timeout owes nothing
+        self.overtaken = False
+
+    def done(self):
+        return self.event.is_set()
+
+    def set_result(self, reply):
+        self.time = time.time()
+        self.reply = reply
+        self.event.set()
+
+    def set_exception(self, error):
+        self.time = time.time()
+        self.error = error
+        self.event.set()
+
+    def result(self, timeout=None):
+        """
+        wait (at most timeout seconds) for the reply and return it, raises
+        IOError on timeout and re-raises the error if the command failed
+        """
+        if not self.event.wait(timeout):
+            raise IOError('no reply to %r within %s seconds' % (self.data, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+
+class CommandPipeline(object):
+    def __init__(self, network, max_inflight=1, timeout=None):
+        """
+        writes commands to one bridge without waiting for each reply to finish
+
+        a pump has processed a command once the first byte of its reply goes
+        out, so the next command is written as soon as the reply to the
+        previous one has started arriving. max_inflight > 1 also lets that
+        many commands be written before any reply starts (only for bridges
+        that buffer serial input). Replies are matched to commands in order.
+
+        meant for commands with no ordering dependency between them (status
+        and DIS queries to different pumps, ...). Parameter writes should go
+        through NE500Network.set_param so the parameter cache stays right.
+
+        network : NE500Network
+            connected network, hold network.lock while using the pipeline
+
+        max_inflight : int
+            commands written whose reply hasn't started yet
+
+        timeout : float or None
+            seconds to wait for a reply, defaults to the network's
+            reply_timeout (or 1 s)
+        """
+        assert max_inflight >= 1
+        if network.reader is not None:
+            raise IOError('CommandPipeline reads the socket itself, stop the ReplyReader first')
+        if timeout is None:
+            timeout = network.reply_timeout or 1.0
+        self.network = network
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        self.inflight = []
+
+    def __len__(self):
+        return len(self.inflight)
+
+    def _unstarted(self):
+        if self.network.rxbuffer.frame_started():
+            return len(self.inflight) - 1
+        return len(self.inflight)
+
+    def _poll(self, timeout):
+        """
+        wait up to timeout seconds for reply bytes, hand out complete replies
+        """
+        if not self.network._fill(timeout):
+            return False
+        frame = self.network.rxbuffer.pop_frame()
+        while frame is not None:
+            reply = self.network.check_alarm(frame)
+            stale = self.network.stale
+            if stale.get(reply.address):
+                # late reply to a command that timed out, or (if that one
+                # was never answered) the reply of one in flight, see
+                # PendingReply.overtaken
+                stale[reply.address] -= 1
+                for pending in self.inflight:
+                    if pending.data[:2] == b'%02i' % reply.address:
+                        pending.overtaken = True
+                frame = self.network.rxbuffer.pop_frame()
+                continue
+            if not self.inflight:
+                # nothing is waiting for it (an alarm: check_alarm has
+                # recorded it)
+                frame = self.network.rxbuffer.pop_frame()
+                continue
+            pending = self.inflight.pop(0)
+            address = pending.data[:2]
+            if address.isdigit() and reply.address != int(address):
+                error = IOError('reply %r does not match command %r' % (frame, pending.data))
+                pending.set_exception(error)
+                self.network._trace_end(pending.trace, pending.data, frame, error)
+                self._fail(error)
+                return True
+            pending.set_result(frame)
+            self.network._trace_end(pending.trace, pending.data, frame)
+            frame = self.network.rxbuffer.pop_frame()
+        return True
+
+    def _fail(self, error, late=False):
+        # replies can no longer be matched to commands, and commands not
+        # sent yet are dropped with them. late: the commands sent may still
+        # be answered, their replies are dropped when they arrive
+        self.network.rxbuffer.clear()
+        unsent = len(self.network.txbuffer)
+        del self.network.txbuffer[:]
+        for pending in reversed(self.inflight):
+            if unsent > 0:
+                unsent -= len(pending.data)
+                continue
+            address = pending.data[:2]
+            if late and address.isdigit() and not pending.overtaken:
+                self.network.stale[int(address)] = self.network.stale.get(int(address), 0) + 1
+        for pending in self.inflight:
+            pending.set_exception(error)
+            self.network._trace_end(pending.trace, pending.data, b'', error)
+        self.inflight = []
+
+    def _wait(self, done):
+        deadline = time.time() + self.timeout
+        while not done():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                error = IOError('no reply within %s seconds' % self.timeout)
+                self._fail(error, late=True)
+                raise error
+            try:
+                if self.network.txbuffer:
+                    # everything submitted so far goes out in one segment
+                    self.network.flush()
+                self._poll(remaining)
+            except (socket.error, IOError) as E:
+                self._fail(E)
+                raise
+
+    def submit(self, data):
+        """
+        queue data to be written as soon as the in-flight limit allows
+        (commands queued together are sent together), returns a
+        PendingReply for it
+
+        raises IOError if a reply doesn't arrive in time: every command
+        still in flight fails with it
+        """
+        data = to_bytes(data)
+        if data[-1:] != b'\r':
+            data += b'\r'
+        self._wait(lambda: self._unstarted() < self.max_inflight)
+        pending = PendingReply(data)
+        pending.trace = self.network._trace_start()
+        self.network.queue(data)
+        self.inflight.append(pending)
+        return pending
+
+    def flush(self):
+        """
+        wait for the replies to everything submitted so far
+
+        raises IOError as submit does
+        """
+        self._wait(lambda: len(self.inflight) == 0)
+
+
+class _Unlocked(object):
+    # stands in for NE500Network.lock where nothing needs to be held
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class ReplyReader(object):
+    # unclaimed alarms kept for alarms.get(), the oldest go first
+    max_alarms = 100
+
+    def __init__(self, network, poll_interval=0.1, reactor=None):
+        """
+        background thread that owns the read side of one bridge connection
+        (see NE500Network.start_reader): it parses reply frames as they
+        arrive and hands each one to the PendingReply of the oldest command
+        waiting for a reply from that pump address, so callers don't share
+        read state and commands to different pumps don't wait for each other
+
+        alarm frames no command is waiting for go to alarms (a queue of
+        pumpreply.Reply) and to the subscribe()d callbacks, other frames
+        nobody is waiting for to unclaimed (see NE500Network.read)
+
+        network : NE500Network
+            connected network
+
+        poll_interval : float
+            seconds between checks for stop() and for a new socket (after a
+            reconnect)
+
+        reactor : pumpreactor.Reactor or None
+            read from the reactor's thread (shared by many bridges) instead
+            of a thread of its own
+        """
+        self.network = network
+        self.poll_interval = poll_interval
+        self.reactor = reactor
+        self.lock = threading.Lock()
+        # {address: [PendingReply, ...]} oldest first, address None: any pump
+        self.waiting = {}
+        # {address: replies still due for cancelled commands}, dropped when
+        # they arrive (see cancel)
+        self.stale = {}
+        self.alarms = queue.Queue(self.max_alarms)
+        self.unclaimed = queue.Queue()
+        self.listeners = []
+        self.rxbuffer = FrameBuffer()
+        # the socket being read, and the last one that was found closed
+        self.socket = None
+        self.closed = None
+
+        self.running = False
+        self.thread = None
+
+    def subscribe(self, callback):
+        """
+        call callback(network, reply) with every unclaimed alarm Reply, from
+        the reader (or reactor) thread: it must not wait for replies itself
+        """
+        self.listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        self.listeners.remove(callback)
+
+    def expect(self, data, address=None):
+        """
+        register a command before it is written, returns the PendingReply
+        its reply will be handed to
+
+        address : int or None
+            pump address to take the reply from, defaults to the address data
+            starts with ('*RUN': the first reply from any pump)
+        """
+        pending = PendingReply(data)
+        if address is None:
+            text = to_str(data)
+            if text[:2].isdigit():
+                address = int(text[:2])
+        with self.lock:
+            self.waiting.setdefault(address, []).append(pending)
+        return pending
+
+    def cancel(self, pending, sent=True):
+        """
+        stop waiting for pending (timed out)
+
+        sent : bool
+            the command went out, so its reply may still arrive: the next
+            reply from that pump is dropped rather than handed to the next
+            command waiting for it (replies to '*' commands go to unclaimed)
+        """
+        with self.lock:
+            for address, waiting in self.waiting.items():
+                if pending in waiting:
+                    waiting.remove(pending)
+                    if sent and address is not None and not pending.overtaken:
+                        self.stale[address] = self.stale.get(address, 0) + 1
+
+    def alive(self):
+        """
+        False if the network's socket is gone or was found closed
+        """
+        sock = self.network.socket
+        if sock is None or sock is self.closed or not self.running:
+            return False
+        try:
+            r, _, _ = select.select([sock], [], [], 0)
+            # peek: the bytes are the reader thread's to take
+            return len(r) == 0 or len(sock.recv(1, socket.MSG_PEEK)) > 0
+        except (socket.error, select.error, ValueError):
+            return False
+
+    def _fail(self, error):
+        with self.lock:
+            waiting, self.waiting = self.waiting, {}
+            self.stale = {}
+        for pendings in waiting.values():
+            for pending in pendings:
+                pending.set_exception(error)
+
+    def _dispatch(self, frame):
+        try:
+            reply = self.network.check_alarm(frame)
+        except FrameError:
+            # garbled, there's no telling who it was for
+            self.unclaimed.put(frame)
+            return
+        pending = None
+        with self.lock:
+            if self.stale.get(reply.address):
+                # late reply to a cancelled command (alarms still go out).
+                # If that command was never answered this is the reply of
+                # a command still waiting: it mustn't owe one in turn
+                self.stale[reply.address] -= 1
+                for waiter in self.waiting.get(reply.address, ()):
+                    waiter.overtaken = True
+                if reply.status != ALARM:
+                    return
+            else:
+                for address in (reply.address, None):
+                    waiting = self.waiting.get(address)
+                    if waiting:
+                        pending = waiting.pop(0)
+                        break
+        if pending is not None:
+            pending.set_result(frame)
+            return
+        if(self.network.verbose):
+            print("UNCLAIMED (%s; %s): %s" % (self.network.address, str(self.network),
+                to_str(frame)))
+        if reply.status != ALARM:
+            self.unclaimed.put(frame)
+            return
+        try:
+            self.alarms.put_nowait(reply)
+        except queue.Full:
+            self.alarms.get_nowait()
+            self.alarms.put_nowait(reply)
+        for callback in list(self.listeners):
+            callback(self.network, reply)
+
+    def _read(self, sock):
+        """
+        wait up to poll_interval for data on sock and dispatch the complete
+        frames, returns False once sock is closed
+        """
+        try:
+            r, _, _ = select.select([sock], [], [], self.poll_interval)
+        except (select.error, ValueError):
+            # ValueError: closed by another thread (disconnect)
+            return False
+        if len(r) == 0:
+            return True
+        return self._readable(sock)
+
+    def _readable(self, sock):
+        """
+        move what sock has received into the buffer and dispatch the
+        complete frames, returns False if sock is closed
+        """
+        try:
+            nbytes = self.rxbuffer.recv_into(sock, self.network.recv_size)
+        except socket.error as E:
+            if E.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            nbytes = 0
+        except ValueError:
+            nbytes = 0
+        if nbytes == 0:
+            return False
+        self.network.bytes_received += nbytes
+        frame = self.rxbuffer.pop_frame()
+        while frame is not None:
+            self._dispatch(frame)
+            frame = self.rxbuffer.pop_frame()
+        return True
+
+    def _on_readable(self, sock):
+        # reactor callback
+        if not self._readable(sock):
+            self.closed = sock
+            self.detach()
+            if sock is self.network.socket:
+                self._fail(IOError('connection closed by %s:%s' % \
+                    (self.network.address, self.network.port)))
+
+    def attach(self):
+        """
+        with a reactor: register the network's socket (after connecting),
+        without one the thread finds new sockets by itself
+        """
+        if self.reactor is None or not self.running:
+            return
+        self.detach()
+        self.rxbuffer.clear()
+        sock = self.network.socket
+        if sock is not None:
+            self.socket = sock
+            self.reactor.register(sock, self._on_readable)
+
+    def detach(self):
+        """
+        with a reactor: unregister the socket (before it is closed)
+        """
+        if self.reactor is not None and self.socket is not None:
+            self.reactor.unregister(self.socket)
+            self.socket = None
+
+    def _run(self):
+        while self.running:
+            sock = self.network.socket
+            if sock is not self.socket:
+                # reconnected (NE500Network.disconnect failed what was
+                # waiting on the old socket)
+                self.rxbuffer.clear()
+                self.socket = sock
+            if sock is None or sock is self.closed:
+                time.sleep(self.poll_interval)
+                continue
+            if not self._read(sock):
+                self.closed = sock
+                if sock is self.network.socket:
+                    self._fail(IOError('connection closed by %s:%s' % \
+                        (self.network.address, self.network.port)))
+
+    def start(self):
+        self.running = True
+        if self.reactor is not None:
+            self.attach()
+            return self
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        stop reading, commands still waiting fail, bytes of unfinished
+        frames go back to the network's receive buffer
+        """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        socket_read = self.socket
+        self.detach()
+        self._fail(IOError('reply reader stopped'))
+        if socket_read is not None and socket_read is self.network.socket:
+            self.network.rxbuffer.feed(self.rxbuffer.take())
+        self.rxbuffer.clear()
+
+
+class CommandBurst(object):
+    def __init__(self):
+        """
+        commands for several pumps on one network, sent together using the
+        NE500 network command burst syntax:
+
+            '0 RAT 100* 1 RAT 250* 2 RAT 375*\r'
+
+        a burst line can carry only one command per pump, commands for the
+        same pump are sent in the order they were added
+        """
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add(self, pump, cmd, param=''):
+        """
+        pump : int
+            pump address, 0-9 (burst addresses are a single digit)
+        """
+        assert ((pump >= 0) and (pump <= 9))
+        self.commands.append((pump, cmd, str(param)))
+
+    def pack(self, max_length):
+        """
+        split the commands into as few burst lines as possible
+
+        max_length : int
+            longest burst line (including the '\r') the pumps accept
+
+        returns list of (line, [(pump, cmd, param), ...])
+        """
+        pending = list(self.commands)
+        lines = []
+        while pending:
+            line = ''
+            commands = []
+            rest = []
+            for pump, cmd, param in pending:
+                single = ('%i %s %s' % (pump, cmd, param)).rstrip() + '* '
+                busy = pump in [c[0] for c in commands] or pump in [c[0] for c in rest]
+                if busy or len(line) + len(single) + 1 > max_length:
+                    if not commands:
+                        raise ValueError('command too long for a burst line: %s' % single)
+                    rest.append((pump, cmd, param))
+                    continue
+                line += single
+                commands.append((pump, cmd, param))
+            lines.append((line.rstrip() + '\r', commands))
+            pending = rest
+        return lines
+
+
+class BridgePool(object):
+    def __init__(self, factory=None, **kwargs):
+        """
+        keeps one open connection per (address, port) across calls, instead
+        of connecting to the bridge for every operation
+        
+        connections are leased to one caller (thread) at a time, checked with
+        is_alive before each lease and reconnected lazily if they went away
+        
+        factory : callable
+            factory(address, port, **kwargs) makes a connected network,
+            defaults to NE500Network
+        
+        kwargs are passed on to factory
+        """
+        if factory is None:
+            factory = NE500Network
+        self.factory = factory
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.locks = {}
+
+    def _key_lock(self, key):
+        with self.lock:
+            if key not in self.locks:
+                self.locks[key] = threading.RLock()
+            return self.locks[key]
+
+    def acquire(self, address, port):
+        """
+        lease the connection for (address, port), blocking while another
+        caller holds it; every acquire must be matched by a release
+        """
+        key = (address, port)
+        lock = self._key_lock(key)
+        lock.acquire()
+        try:
+            n = self.connections.get(key)
+            if n is not None and not n.is_alive():
+                self._discard(key)
+                n = None
+            if n is None:
+                n = self.factory(address, port, **self.kwargs)
+                self.connections[key] = n
+            else:
+                # drop replies left over from the previous lease
+                n.rxbuffer.clear()
+        except:
+            lock.release()
+            raise
+        return n
+
+    def release(self, address, port, broken=False):
+        """
+        broken : bool
+            if True the connection is closed and the next acquire reconnects
+        """
+        key = (address, port)
+        if broken:
+            self._discard(key)
+        self._key_lock(key).release()
+
+    def shared(self, address, port):
+        """
+        the open connection for (address, port) without leasing it, None if
+        there is none (or it went away)
+
+        only networks with a ReplyReader are handed out: their commands can
+        go out while another caller holds the lease (e.g. a STP for a pump
+        someone is waiting on)
+        """
+        with self.lock:
+            n = self.connections.get((address, port))
+        if n is None or n.reader is None or not n.is_alive():
+            return None
+        return n
+
+    @contextmanager
+    def lease(self, address, port):
+        """
+        with pool.lease(address, port) as n:
+            n.infuse(1, 0.02)
+        
+        socket errors inside the block close the connection before re-raising
+        """
+        n = self.acquire(address, port)
+        broken = False
+        try:
+            yield n
+        except (socket.error, IOError):
+            broken = True
+            raise
+        finally:
+            self.release(address, port, broken)
+
+    def _discard(self, key):
+        n = self.connections.pop(key, None)
+        if n is not None:
+            try:
+                n.disconnect()
+            except (socket.error, IOError):
+                pass
+
+    def close(self, address, port):
+        key = (address, port)
+        lock = self._key_lock(key)
+        with lock:
+            self._discard(key)
+
+    def close_all(self):
+        for key in list(self.connections.keys()):
+            self.close(*key)
+
+
+# shared by set_pump_network, run_command_burst, ...
+bridge_pool = BridgePool()
+atexit.register(bridge_pool.close_all)
+
+
+def set_pump_network(setupID, pumpID, ipAddress, port, npumps=1, pool=None):
     """set a set of commands for a pump or pump network
 
     ***NOT SURE YET IF CAN RUN MORE THAN ONE SETUP AT TIME 
@@ -430,13 +1805,18 @@ def set_pump_network(setupID, pumpID, ipAddress, port, npumps=1):
 
     port : int
         (see IPSerial)
+
+    pool : BridgePool
+        connections to reuse, defaults to bridge_pool
     """
-    print "Setting up commands for pump network:  setup %i, pump %02i..." \
-                % (setupID, pumpID)
-    n = NE500Network(ipAddress, port)
+    print("Setting up commands for pump network:  setup %i, pump %02i..." \
+                % (setupID, pumpID))
+    if pool is None:
+        pool = bridge_pool
+    n = pool.acquire(ipAddress, port)
     n.verbose = 0
 
-    def set_commandset(mode): # q, t, or c.
+    def set_commandset(mode): # q, t, c or p.
         """return 0 to continue, else exit"""
         if mode == '':
             return 0
@@ -446,91 +1826,107 @@ def set_pump_network(setupID, pumpID, ipAddress, port, npumps=1):
         elif m == 't' or m == 'T':
 
             # set training mode:
-            print "Training mode ON"
+            print("Training mode ON")
             # get the command set...
             try:
                 pump_commands = n.get_commandset('training')
-                print "got commandset"
+                print("got commandset")
             except:
-                print "Invalid entry, pump configuration not set. Try again."
+                print("Invalid entry, pump configuration not set. Try again.")
                 return 0
 
             # run command set:
             try:
                 n.run_commands(pumpID, pump_commands, npumps=npumps)
-                print "ran commandset"
-            except socket.error, (value, message):
-                print "READ error val: %s" % value
-                print "READ error msg: %s" % message
+                print("ran commandset")
+            except (socket.error, IOError):
+                # run_commands printed it
                 return 0
 
         elif m == 'c' or m == 'C':
             # set cleaning mode:
-            print "Cleaning mode ON"
-            print "How many cycles to run?"
-            ncycles = int(raw_input())
+            print("Cleaning mode ON")
+            print("How many cycles to run?")
+            ncycles = int(input())
 
             nphase = 0
             for i in range(ncycles):
                 # get the command set...
                 try:
                     if nphase == 0: 
-                        print "Getting commandset for cleaning phase %i" % nphase
+                        print("Getting commandset for cleaning phase %i" % nphase)
                         pump_commands = n.get_commandset('cleaning')
                         nphase = 1
                     elif nphase == 1:
-                        print "Getting commandset for cleaning phase %i" % nphase
+                        print("Getting commandset for cleaning phase %i" % nphase)
                         pump_commands = n.get_commandset('cleaning_rev')
                         nphase = 0
-                    print "got commandset, for cycle: %i" % i
+                    print("got commandset, for cycle: %i" % i)
 
                 # run command set:
-                    print "Running commandset on pump: %i" % pumpID
+                    print("Running commandset on pump: %i" % pumpID)
                     if npumps == 1:
                         runreply = n.run_commands(pumpID, pump_commands, ncycles=ncycles, npumps=npumps)
                     elif npumps > 1:
                         runreply = n.run_commands(pumpID, pump_commands, ncycles=ncycles, npumps=npumps)
 
-                except socket.error, (value, message):
-                    print "READ error val: %s" % value
-                    print "READ error msg: %s" % message
+                except (socket.error, IOError):
+                    # run_commands printed it
                     return 0
 
+        elif m == 'p' or m == 'P':
+            # any profile in pumpprofiles.ini (or NE500Network profiles)
+            print("Profile name?")
+            try:
+                pump_commands = n.get_commandset(input().strip())
+            except KeyError as E:
+                print(E)
+                return 0
+            print("%s mode ON" % pump_commands.name)
+            try:
+                n.run_commands(pumpID, pump_commands, npumps=npumps)
+            except (socket.error, IOError):
+                # run_commands printed it
+                return 0
+
         else:
-            print "Invalid command"
+            print("Invalid command")
             return 0
         
         return pump_commands
 
     def print_commandset():
-        print
-        print "Enter pump network mode:"
-        print " --"
-        print "q: quit"
-        print " --"
+        print()
+        print("Enter pump network mode:")
+        print(" --")
+        print("q: quit")
+        print(" --")
         print_configs()
-        print
+        print()
 
     def print_configs():
         pump_commands_training = n.get_commandset('training')
         pump_commands_cleaning = n.get_commandset('cleaning')
-        print "t: train (current config): \n", pump_commands_training
-        print "c: clean (current config): \n", pump_commands_cleaning
-
-    while True:
-        # set parameter/quit
-        print_commandset()
-        r = raw_input()
-        pump_commands = set_commandset(r)
-        didit = 1
-        if didit == 1:
-            break
-
-    # n.disconnect()
+        print("t: train (current config): \n", pump_commands_training)
+        print("c: clean (current config): \n", pump_commands_cleaning)
+        print("p: run a profile by name (%s)" % ', '.join(sorted(n.profiles)))
+
+    try:
+        while True:
+            # set parameter/quit
+            print_commandset()
+            r = input()
+            pump_commands = set_commandset(r)
+            didit = 1
+            if didit == 1:
+                break
+    finally:
+        pool.release(ipAddress, port)
+
     return pump_commands    
     # print "Pump network mode set."
 
-def run_command_burst(commandset, setupID, ipAddress, port, pumps=[1,2]):
+def run_command_burst(commandset, setupID, ipAddress, port, pumps=[1,2], pool=None):
     """run 2 or more pumps simultaneously in a given network 
 
     commandset : dict (??)
@@ -548,32 +1944,316 @@ def run_command_burst(commandset, setupID, ipAddress, port, pumps=[1,2]):
 
     port : int
         see IPSerial
+
+    pool : BridgePool
+        connections to reuse, defaults to bridge_pool
     """
     
-    print "Running command burst to pump network..."
-    n = NE500Network(ipAddress, port)
+    print("Running command burst to pump network...")
+    if pool is None:
+        pool = bridge_pool
+    with pool.lease(ipAddress, port) as n:
+        _run_command_burst(n, commandset, pumps)
 
-    # for pumps with secondary pump attached...
-    n.write_then_read('* ADR DUAL\r')
-    for i, cmd in enumerate(commandset.iterkeys()):
-        n.write_then_read('* %s %s\r' % (cmd, commandset[cmd]))
 
-    print "Commands in dual-mode finished running."
-    n.write_then_read('* ADR %02f\r' % pumpID)
+def _run_command_burst(n, commandset, pumps):
+    # one burst line per parameter, for all pumps
+    for pump, cmd, param, reply in n.set_params_burst(pumps, commandset):
+        print("pump %i, %s %s: %s" % (pump, cmd, param, reply))
 
+    print("All commands completed.")
 
-    # for all pumps in a network...
-    for i, cmd in enumerate(commandset.iterkeys()):
-        burst = ''
-        for p in pumps:
-            single = '%02f %s %s* ' % (p, cmd, commandset[cmd])
-            burst = burst + single
-        burst = burst + '\r'
 
-        n.writen_then_read(burst)
-        print "Ran command: %s, on all set pumps." % cmd
+def run_cleaning(setups, port, pumps=(1, 2), ncycles=2, workers=None, pool=None,
+        timeout=60.0):
+    """run cleaning cycles on several setups at once, without prompts
+
+    like the 'c' mode of set_pump_network, cycles alternate between the
+    'cleaning' (infuse) and 'cleaning_rev' (withdraw) commandsets. Each setup
+    runs in its own worker thread, a failing bridge only stops its own setup.
+
+    setups : dict
+        {setupID : ipAddress}
+
+    port : int
+        see IPSerial
+
+    pumps : list of int
+        pumps to clean on every setup, all run together
+
+    ncycles : int
+        cycles per setup (one infuse or withdraw each)
+
+    workers : int
+        worker threads, defaults to one per setup
+
+    pool : BridgePool
+        connections to reuse, defaults to bridge_pool
+
+    timeout : float
+        seconds a cycle may take before the setup is given up
+
+    returns {setupID : summary}, summary is a dict with 'address', 'cycles'
+    (completed), 'seconds' and 'error' (None if all cycles completed)
+    """
+    if pool is None:
+        pool = bridge_pool
+    if workers is None:
+        workers = len(setups)
+
+    def clean(setup):
+        setupID, ipAddress = setup
+        tic = time.time()
+        cycles = 0
+        error = None
+        try:
+            with pool.lease(ipAddress, port) as n:
+                for i in range(ncycles):
+                    if i % 2 == 0:
+                        commandset = n.get_commandset('cleaning')
+                    else:
+                        commandset = n.get_commandset('cleaning_rev')
+                    _run_cleaning_cycle(n, pumps, commandset, timeout)
+                    cycles += 1
+                for p in pumps:
+                    n.wait_until_stopped(p, timeout)
+        except Exception as E:
+            error = '%s: %s' % (E.__class__.__name__, E)
+        return setupID, {'address': ipAddress, 'cycles': cycles,
+            'seconds': time.time() - tic, 'error': error}
+
+    threads = ThreadPool(max(1, min(workers, len(setups))))
+    try:
+        return dict(threads.map(clean, sorted(setups.items())))
+    finally:
+        threads.close()
+
+
+def _run_cleaning_cycle(n, pumps, commandset, timeout):
+    for p in pumps:
+        n.wait_until_stopped(p, timeout)
+    for pump, cmd, param, reply in n.set_params_burst(pumps, commandset):
+        if reply is None or not parse_reply(reply).ok:
+            raise IOError('pump %02i: %s %s failed (%r)' % (pump, cmd, param, reply))
+    burst = CommandBurst()
+    for p in pumps:
+        burst.add(p, 'RUN')
+    for pump, cmd, param, reply in n.send_burst(burst):
+        if reply is None or not parse_reply(reply).ok:
+            raise IOError('pump %02i: RUN failed (%r)' % (pump, reply))
+
+
+def fire_synchronized(armed, timeout=1.0):
+    """
+    send armed RUN lines to their bridges back to back, from this thread
+    and without waiting for any reply in between, then collect the replies
+    and time them
+
+    a pump answers RUN once it has processed it (and started), so the time
+    its reply arrives is its measured start. Hold the networks' leases (and
+    nothing else should be sending to them) while this runs.
+
+    replies are timed when their bridge's data is received: replies that
+    arrive in one segment share that time, so the skew is measured per
+    bridge, and between pumps on one bridge only as finely as the bridge
+    splits its segments.
+
+    armed : list of (key, network, pumps, line)
+        line from NE500Network.arm, key labels the bridge (e.g. setupID)
+
+    timeout : float
+        seconds to wait for all replies
+
+    returns {(key, pump): {'sent': s, 'started': s, 'reply': frame}}, sent
+    and started in seconds after the first line went out (started and
+    reply are None for pumps that didn't answer)
+
+    raises IOError if a line can't be written, naming the keys whose RUN
+    went out before it (their replies are collected first, so none are
+    left for the next command)
+    """
+    networks = dict((key, n) for key, n, pumps, line in armed)
+    for n in networks.values():
+        n.lock.acquire()
+    try:
+        # with a ReplyReader, replies are registered before anything goes out
+        pending = {}
+        for key, n, pumps, line in armed:
+            if n.reader is not None:
+                for p in pumps:
+                    pending[(key, p)] = n.reader.expect(line, p)
+
+        sent = {}
+        traces = {}
+        error = None
+        for key, n, pumps, line in armed:
+            traces[key] = n._trace_start()
+            try:
+                n.write(line)
+            except (socket.error, IOError) as E:
+                error = (key, E)
+                n._trace_end(traces[key], line, b'', E)
+                break
+            sent[key] = time.time()
+            for p in pumps:
+                if (key, p) in pending:
+                    pending[(key, p)].sent = sent[key]
+        if error is not None:
+            # nothing waits for the lines that didn't go out, the others'
+            # replies are still collected below (pumps have started)
+            for (key, p), pend in list(pending.items()):
+                if key not in sent:
+                    networks[key].reader.cancel(pend, sent=False)
+                    del pending[(key, p)]
+            armed = [item for item in armed if item[0] in sent]
+        t0 = min(sent.values()) if sent else time.time()
+
+        # without a reader: one select over every bridge still owing replies
+        replies = {}
+        started = {}
+        owing = {}
+        for key, n, pumps, line in armed:
+            if n.reader is None:
+                owing[n.socket] = (key, n, set(pumps))
+        deadline = t0 + timeout
+        while owing:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            r, _, _ = select.select(list(owing), [], [], remaining)
+            for sock in r:
+                key, n, waiting = owing[sock]
+                try:
+                    n._fill(0)
+                except (socket.error, IOError):
+                    del owing[sock]
+                    continue
+                now = time.time()
+                frame = n.rxbuffer.pop_frame()
+                while frame is not None:
+                    address = n.check_alarm(frame).address
+                    if address in waiting:
+                        waiting.discard(address)
+                        replies[(key, address)] = frame
+                        started[(key, address)] = now
+                    frame = n.rxbuffer.pop_frame()
+                if not waiting:
+                    del owing[sock]
+
+        for (key, p), pend in pending.items():
+            try:
+                replies[(key, p)] = pend.result(max(deadline - time.time(), 0))
+                started[(key, p)] = pend.time
+            except IOError:
+                networks[key].reader.cancel(pend)
+
+        results = {}
+        for key, n, pumps, line in armed:
+            frames = [replies[(key, p)] for p in pumps if (key, p) in replies]
+            n._trace_end(traces[key], line, b''.join(frames),
+                pending=[pending[(key, p)] for p in pumps if (key, p) in pending])
+            for p in pumps:
+                start = started.get((key, p))
+                results[(key, p)] = {
+                    'sent': sent[key] - t0,
+                    'started': None if start is None else start - t0,
+                    'reply': replies.get((key, p)),
+                }
+        if error is not None:
+            key, E = error
+            raise IOError('writing RUN to %s failed (%s), it went out to %s already' % \
+                (key, E, sorted(sent)))
+        return results
+    finally:
+        for n in networks.values():
+            n.lock.release()
+
+
+def run_synchronized(setups, port, pumps=(1, 2), commandset=None, timeout=1.0, arm_timeout=60.0,
+        pool=None):
+    """start pumps on several setups at the same moment, without prompts
+
+    every setup is armed first (in parallel: pumps stopped, commandset
+    set), then all RUNs go out back to back, see fire_synchronized. Nothing
+    is started unless every setup could be armed.
+
+    setups : dict
+        {setupID : ipAddress}
+
+    port : int
+        see IPSerial
+
+    pumps : list of int, or dict
+        pumps to start on every setup, or {setupID : list of pumps}
+
+    commandset : dict or None
+        parameters to set before starting (e.g. from get_commandset), None
+        runs with what the pumps hold
+
+    timeout : float
+        seconds to wait for the replies to RUN
+
+    arm_timeout : float
+        seconds to wait for a pump to stop before arming
 
-    print "All commands completed."
+    pool : BridgePool
+        connections to reuse, defaults to bridge_pool
+
+    returns a dict with
+        'pumps' : {(setupID, pump) : {'sent', 'started', 'skew', 'status', 'reply'}}
+            seconds after the first RUN went out, skew is started minus the
+            earliest start, status the reply's status letter (None: no reply)
+        'spread' : latest minus earliest start, seconds (None if no pump
+            answered)
+
+    raises IOError (and starts nothing) if a setup can't be armed, or if
+    RUN can't be sent to every setup (see fire_synchronized)
+    """
+    if pool is None:
+        pool = bridge_pool
+    if not isinstance(pumps, dict):
+        pumps = dict((s, list(pumps)) for s in setups)
+
+    # in setupID order, like every other multi-setup caller
+    leased = []
+    try:
+        for setupID in sorted(setups):
+            n = pool.acquire(setups[setupID], port)
+            leased.append((setupID, n))
+
+        def arm(item):
+            setupID, n = item
+            try:
+                return setupID, n.arm(list(pumps[setupID]), commandset, arm_timeout), None
+            except Exception as E:
+                return setupID, None, '%s: %s' % (E.__class__.__name__, E)
+
+        threads = ThreadPool(max(1, len(leased)))
+        try:
+            lines = threads.map(arm, leased)
+        finally:
+            threads.close()
+        errors = dict((setupID, error) for setupID, line, error in lines if error is not None)
+        if errors:
+            raise IOError('could not arm %s' % errors)
+
+        networks = dict(leased)
+        armed = [(setupID, networks[setupID], list(pumps[setupID]), line)
+            for setupID, line, error in lines]
+        results = fire_synchronized(armed, timeout)
+    finally:
+        for setupID, n in leased:
+            pool.release(setups[setupID], port)
+
+    starts = [r['started'] for r in results.values() if r['started'] is not None]
+    first = min(starts) if starts else None
+    for r in results.values():
+        r['skew'] = None if r['started'] is None else r['started'] - first
+        r['status'] = None if r['reply'] is None else parse_reply(r['reply']).status
+    return {
+        'pumps': results,
+        'spread': max(starts) - first if starts else None,
+    }
 
 
 if __name__ == '__main__':
@@ -595,71 +2275,91 @@ if __name__ == '__main__':
 
     port = 100
     IPs = []
-    for i, key in enumerate(sorted(ipAddresses.iterkeys())):
+    for i, key in enumerate(sorted(ipAddresses)):
         IPs.append([i+1, key, ipAddresses[key]])
         # IPs = [[1, 'setup1_serial.local', '192.168.0.2'], 
         #           [2, 'setup2_serial.local', '192.168.0.4'],
         #           [3, 'setup3_serial.local', '192.168.0.6'], ...]
 
-    print "What network mode would you like to run?"
-    print " 1: run single pump"
-    print " 2: run partiuclar setup(s), single or both pumps"
-    print " 3: run simultaneously, particular setup(s), 1 pump" # or both?  FIX this...
+    print("What network mode would you like to run?")
+    print(" 1: run single pump")
+    print(" 2: run partiuclar setup(s), single or both pumps")
+    print(" 3: run simultaneously, particular setup(s) and pump(s)")
+    print(" 4: clean particular setup(s), all at once")
     # print " 3: run all setups, 1 pump"
     # print " 4: run all setups, all pumps"
     
-    runIndex = int(raw_input())
+    runIndex = int(input())
     if runIndex == 1:
-        print "Which setup would you like to run?"
-        print IPs
-        setupID = int(raw_input())
+        print("Which setup would you like to run?")
+        print(IPs)
+        setupID = int(input())
         ipAddress = IPs[setupID-1][2] 
-        print "Which pump? Left or Right: [1]/[2]"
-        pumpID = int(raw_input())
-        print "Running pump %02i, on setup%i, address %s..." \
-                % (pumpID, setupID, ipAddress)
+        print("Which pump? Left or Right: [1]/[2]")
+        pumpID = int(input())
+        print("Running pump %02i, on setup%i, address %s..." \
+                % (pumpID, setupID, ipAddress))
 
         commandset = set_pump_network(setupID, pumpID, ipAddress, port)
         # run_commandset(commandset, pumpID, ipAddress, port)
 
     elif runIndex == 2:
-        print "How many setups are you running?"
-        nsetups = int(raw_input())
-        print "Enter the setup number(s): *NO spaces or commas*"
-        print IPs
-        setups = list(raw_input())
+        print("How many setups are you running?")
+        nsetups = int(input())
+        print("Enter the setup number(s): *NO spaces or commas*")
+        print(IPs)
+        setups = list(input())
         setupIDs = []
         ipAddresses = []
         for setup in setups:
             sidx = int(setup)
             setupIDs.append(sidx)
             ipAddresses.append(IPs[sidx-1][2])
-        print setupIDs
+        print(setupIDs)
 
-        print "How many pumps on setup?"
-        npumps = int(raw_input())
+        print("How many pumps on setup?")
+        npumps = int(input())
         if npumps == 1:
-            print "Which pump? Left / Right: [1]/[2]"
-            pumpID = int(raw_input())
+            print("Which pump? Left / Right: [1]/[2]")
+            pumpID = int(input())
             for s, ip in zip(setupIDs, ipAddresses):
-                print "Running pump %02i, on setup%i, address %s..." \
-                        % (pumpID, s, ip)
+                print("Running pump %02i, on setup%i, address %s..." \
+                        % (pumpID, s, ip))
                 set_pump_network(s, pumpID, ip, port, npumps)
         elif npumps == 2:
             pumpID = 1
             for s, ip in zip(setupIDs, ipAddresses):
-                print "Running BOTH pumps, on setup%i, address %s..." \
-                        % (s, ip)
+                print("Running BOTH pumps, on setup%i, address %s..." \
+                        % (s, ip))
                 set_pump_network(s, pumpID, ip, port, npumps)
 
     elif runIndex == 3:
-        # get list of setups to be run
-        # get pump 01, 02, or both
-        # get list of CMDs and PARAMs
-        # FOR-loop through [CMDS, PARAMS]:
-        #       message of form: ('01 CMD PARAM* 02 CMD PARAM*\r')
-        #       
-        # ******FIND OUT IF EACH PUMP CAN HAVE DIFF ADDY....
-        # OTHERWISE, have to run each setup separately, but can do both pumps 01-02 simultaneously!
-        #
-        print "fix this"
\ No newline at end of file
+        print("Enter the setup number(s): *NO spaces or commas*")
+        print(IPs)
+        setupIDs = [int(setup) for setup in input()]
+        print("Which pump(s)? Left / Right / Both: [1]/[2]/[12]")
+        pumpIDs = [int(p) for p in input()]
+        print("Profile to set first? (e.g. training, empty: keep the pumps' settings)")
+        mode = input().strip()
+        commandset = None
+        if mode:
+            commandset = default_profiles()[mode]
+        result = run_synchronized(dict((s, IPs[s-1][2]) for s in setupIDs), port,
+            pumpIDs, commandset)
+        for (s, p), r in sorted(result['pumps'].items()):
+            print("setup%i pump %02i: status %s, sent +%.1f ms, started +%s ms" % \
+                (s, p, r['status'], r['sent'] * 1000.,
+                 'n/a' if r['started'] is None else '%.1f' % (r['started'] * 1000.)))
+        if result['spread'] is not None:
+            print("start spread: %.1f ms" % (result['spread'] * 1000.))
+
+    elif runIndex == 4:
+        print("Enter the setup number(s): *NO spaces or commas*")
+        print(IPs)
+        setupIDs = [int(setup) for setup in input()]
+        print("How many cycles to run?")
+        ncycles = int(input())
+        summary = run_cleaning(dict((s, IPs[s-1][2]) for s in setupIDs), port,
+            ncycles=ncycles)
+        for s in sorted(summary):
+            print("setup%i: %s" % (s, summary[s]))
@@ -0,0 +1,167 @@
+#
+# pumpprofiles.py
+#
+# Pump parameter profiles ('training', 'cleaning', ...) read from an INI
+# file instead of being hard-coded in NE500Network.get_commandset. Each
+# profile is checked once when it is loaded and compiled to an immutable
+# command sequence that every setup and pump shares:
+#
+#   profiles = load_profiles('pumpprofiles.ini')
+#   n.run_commands(1, profiles['training'])
+#
+# pumpprofiles.ini, next to this file, holds the default profiles. A new
+# protocol is a new section there (or in another file), not new code.
+#
+
+import os
+import threading
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+try:
+    from configparser import RawConfigParser
+except ImportError:
+    from ConfigParser import RawConfigParser
+
+from ipserial import to_bytes
+
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pumpprofiles.ini')
+
+# profile parameters, in the order they are sent (DIA first: it sets the
+# units of RAT and VOL)
+PARAMS = ('DIA', 'RAT', 'VOL', 'DIR')
+
+# syringe inside diameter range, mm
+MIN_DIA = 0.1
+MAX_DIA = 50.0
+# VOL is in ul for diameters up to this, ml above (syringes < 10 ml)
+MAX_UL_DIA = 14.0
+
+
+def volume_units(dia):
+    """
+    VOL (and DIS) units set by a syringe diameter in mm: 'UL' or 'ML'
+    """
+    return 'UL' if dia <= MAX_UL_DIA else 'ML'
+
+
+class Profile(Mapping):
+    def __init__(self, name, params):
+        """
+        validated set of pump parameters, read-only {cmd: param} mapping
+
+        name : str
+            profile name, e.g. 'training'
+
+        params : dict
+            {'DIA': '15.0', 'RAT': '100.0', 'VOL': '0.02', 'DIR': 'INF'}, and
+            optionally 'UNITS' ('ul' or 'ml') to check the VOL units against
+
+        raises ValueError if a parameter is missing, unknown or out of range
+        """
+        params = dict((str(k).upper(), str(v).strip()) for k, v in params.items())
+        expected_units = params.pop('UNITS', None)
+        unknown = sorted(set(params) - set(PARAMS))
+        missing = [cmd for cmd in PARAMS if cmd not in params]
+        if unknown or missing:
+            raise ValueError('profile %r: unknown parameters %s, missing %s' % \
+                (name, unknown, missing))
+
+        values = {}
+        for cmd in ('DIA', 'RAT', 'VOL'):
+            try:
+                values[cmd] = float(params[cmd])
+            except ValueError:
+                raise ValueError('profile %r: %s %r is not a number' % (name, cmd, params[cmd]))
+        values['DIR'] = params['DIR'] = params['DIR'].upper()
+
+        if not (MIN_DIA <= values['DIA'] <= MAX_DIA):
+            raise ValueError('profile %r: DIA %s outside %s-%s mm' % \
+                (name, params['DIA'], MIN_DIA, MAX_DIA))
+        if values['RAT'] <= 0:
+            raise ValueError('profile %r: RAT %s must be positive' % (name, params['RAT']))
+        if values['VOL'] < 0:
+            raise ValueError('profile %r: VOL %s must not be negative' % (name, params['VOL']))
+        if values['DIR'] not in ('INF', 'WDR'):
+            raise ValueError('profile %r: DIR %s is not INF or WDR' % (name, params['DIR']))
+
+        self.name = name
+        self.units = volume_units(values['DIA'])
+        if expected_units is not None and expected_units.upper() != self.units:
+            raise ValueError('profile %r: DIA %s mm sets VOL units to %s, not %s' % \
+                (name, params['DIA'], self.units.lower(), expected_units))
+
+        # (cmd, param) and (cmd, cache value), in PARAMS order
+        self.params = tuple((cmd, params[cmd]) for cmd in PARAMS)
+        self.values = tuple((cmd, values[cmd]) for cmd in PARAMS)
+        self._params = dict(self.params)
+        # {pump: ((cmd, cache value, frame), ...)}, see setup
+        self._frames = {}
+
+    def setup(self, pump):
+        """
+        the profile's commands for pump, formatted once per pump address:
+        tuple of (cmd, cache value, frame), as in RewardProgram.setup
+        """
+        frames = self._frames.get(pump)
+        if frames is None:
+            frames = self._frames[pump] = tuple(
+                (cmd, value, to_bytes('%02i %s %s\r' % (pump, cmd, param)))
+                for (cmd, param), (_, value) in zip(self.params, self.values))
+        return frames
+
+    def __getitem__(self, cmd):
+        return self._params[cmd]
+
+    def __iter__(self):
+        return (cmd for cmd, param in self.params)
+
+    def __len__(self):
+        return len(self.params)
+
+    def __str__(self):
+        return '{%s}' % ', '.join('%r: %r' % item for item in self.params)
+
+    def __repr__(self):
+        return 'Profile(%r, %s)' % (self.name, self)
+
+
+def load_profiles(*paths):
+    """
+    read profiles from INI files, one section per profile (later files
+    override profiles of the same name)
+
+    returns {name: Profile}
+
+    raises IOError if a file can't be read, ValueError if a profile is invalid
+    """
+    profiles = {}
+    for path in paths:
+        parser = RawConfigParser()
+        if not parser.read(path):
+            raise IOError('could not read pump profiles from %s' % path)
+        for name in parser.sections():
+            try:
+                profiles[name] = Profile(name, dict(parser.items(name)))
+            except ValueError as E:
+                raise ValueError('%s: %s' % (path, E))
+    return profiles
+
+
+_default_profiles = None
+_default_lock = threading.Lock()
+
+
+def default_profiles():
+    """
+    the profiles in DEFAULT_PATH, read once and shared by every network
+    """
+    global _default_profiles
+    with _default_lock:
+        if _default_profiles is None:
+            _default_profiles = load_profiles(DEFAULT_PATH)
+    return _default_profiles
@@ -0,0 +1,178 @@
+#
+# pumpreactor.py
+#
+# One event loop for the sockets of many bridges. A Reactor registers each
+# socket once with the OS readiness API (epoll on Linux, through selectors)
+# and calls back when it has data, so a single thread reads every bridge
+# instead of a thread, or a select list rebuilt on every call, per socket:
+#
+#   reactor = Reactor().start()
+#   pool = BridgePool(reactor=reactor)   # NE500Network(..., reactor=reactor)
+#   with pool.lease('192.168.0.10', 100) as n:
+#       n.infuse(1, 0.02)
+#
+
+import errno
+import select
+import socket
+import threading
+import traceback
+
+try:
+    import selectors
+except ImportError:
+    # python 2: select.epoll (Linux) or select.poll directly
+    selectors = None
+
+
+class Reactor(object):
+    def __init__(self, poll_interval=1.0):
+        """
+        poll_interval : float
+            longest wait for events, in seconds
+        """
+        if selectors is not None:
+            self.selector = selectors.DefaultSelector()
+        elif hasattr(select, 'epoll'):
+            self.selector = select.epoll()
+        else:
+            self.selector = select.poll()
+        self.poll_interval = poll_interval
+        # held while a callback runs and while (un)registering, so a socket is
+        # never called back once unregister has returned
+        self.lock = threading.RLock()
+        # {fd: (sock, callback)} and {sock: fd} (a closed socket has no fileno)
+        self.callbacks = {}
+        self.fds = {}
+        # stop() writes a byte here to wake the loop
+        self._wakeup, self._wakeup_w = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._register(self._wakeup.fileno())
+
+        self.running = False
+        self.thread = None
+
+    def __len__(self):
+        return len(self.callbacks)
+
+    def _register(self, fd):
+        if selectors is not None:
+            self.selector.register(fd, selectors.EVENT_READ)
+        elif hasattr(select, 'epoll'):
+            self.selector.register(fd, select.EPOLLIN)
+        else:
+            self.selector.register(fd, select.POLLIN)
+
+    def _poll(self, timeout):
+        """
+        file descriptors that are readable (or closed) within timeout seconds
+        """
+        try:
+            if selectors is not None:
+                return [key.fd for key, events in self.selector.select(timeout)]
+            if hasattr(select, 'epoll'):
+                return [fd for fd, events in self.selector.poll(timeout)]
+            return [fd for fd, events in self.selector.poll(timeout * 1000)]
+        except (IOError, OSError, select.error) as E:
+            # interrupted by a signal
+            if E.args and E.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def register(self, sock, callback):
+        """
+        call callback(sock) from the reactor thread whenever sock is readable
+        (or closed by the other end: then sock.recv returns b'')
+        """
+        with self.lock:
+            if sock in self.fds:
+                self.unregister(sock)
+            fd = sock.fileno()
+            self._register(fd)
+            self.callbacks[fd] = (sock, callback)
+            self.fds[sock] = fd
+
+    def unregister(self, sock):
+        """
+        stop calling back for sock, call it before closing sock
+        """
+        with self.lock:
+            fd = self.fds.pop(sock, None)
+            if fd is None:
+                return
+            del self.callbacks[fd]
+            try:
+                self.selector.unregister(fd)
+            except (KeyError, ValueError, IOError, OSError):
+                # already closed
+                pass
+
+    def run_once(self, timeout=None):
+        """
+        wait up to timeout seconds (default poll_interval) for readable
+        sockets and call them back
+
+        returns the number of callbacks made
+        """
+        if timeout is None:
+            timeout = self.poll_interval
+        ncalls = 0
+        for fd in self._poll(timeout):
+            if fd == self._wakeup.fileno():
+                try:
+                    self._wakeup.recv(4096)
+                except socket.error:
+                    pass
+                continue
+            with self.lock:
+                # unregistered while we were waiting
+                if fd not in self.callbacks:
+                    continue
+                sock, callback = self.callbacks[fd]
+                try:
+                    callback(sock)
+                except Exception:
+                    # one bridge must not take the others down
+                    traceback.print_exc()
+                ncalls += 1
+        return ncalls
+
+    def _run(self):
+        while self.running:
+            self.run_once()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        try:
+            self._wakeup_w.send(b'\0')
+        except socket.error:
+            pass
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        """
+        stop and release the selector, registered sockets are left open
+        """
+        self.stop()
+        with self.lock:
+            for sock in list(self.fds):
+                self.unregister(sock)
+        if hasattr(self.selector, 'close'):
+            self.selector.close()
+        self._wakeup.close()
+        self._wakeup_w.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,168 @@
+#
+# pumpreply.py
+#
+# NE500 reply frames parsed once into Reply objects, instead of substring
+# checks on the raw frame:
+#
+#   reply = parse_reply(n.call_and_response('01 DIS'))
+#   if reply.ok:
+#       infused, withdrawn, units = reply.dispensed()
+#
+# frame layout: STX, 2 digit address, status letter, [data], ETX
+#
+
+import re
+
+from ipserial import STX, ETX, to_str
+
+
+# status letters
+STOPPED = 'S'
+INFUSING = 'I'
+WITHDRAWING = 'W'
+PAUSED = 'P'
+ALARM = 'A'
+
+STATES = {
+    STOPPED: 'stopped',
+    INFUSING: 'infusing',
+    WITHDRAWING: 'withdrawing',
+    PAUSED: 'paused',
+    ALARM: 'alarm',
+}
+
+# command errors, the data of the reply
+ERRORS = {
+    '?': 'command not recognized',
+    '?NA': 'command not applicable',
+    '?OOR': 'command data out of range',
+    '?COM': 'invalid communications packet',
+    '?IGN': 'command ignored',
+}
+
+# alarm codes, after 'A?'
+ALARMS = {
+    'R': 'pump was reset',
+    'S': 'pump motor stalled',
+    'T': 'safe mode communications time out',
+    'E': 'pumping program error',
+    'O': 'pumping program phase out of range',
+}
+
+# not float() alone: that also parses 'INF' (as in DIR INF)
+_number = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)')
+_dispensed = re.compile(r'^I([-+]?[\d.]+)W([-+]?[\d.]+)([A-Z]+)$')
+
+
+class FrameError(IOError, ValueError):
+    """
+    not a reply frame (short or garbled): an IOError, like the transport
+    errors callers already handle, and a ValueError as it used to be
+    """
+
+
+class Reply(object):
+    __slots__ = ('address', 'status', 'error', 'alarm', 'data')
+
+    def __init__(self, address, status, error=None, alarm=None, data=''):
+        """
+        one parsed reply frame
+
+        address : int or None
+            address of the pump that replied
+
+        status : str
+            status letter (STOPPED, INFUSING, ...)
+
+        error : str or None
+            command error ('?', '?NA', '?OOR', ... see ERRORS)
+
+        alarm : str or None
+            alarm code if status is ALARM ('S', 'R', ... see ALARMS)
+
+        data : str
+            the rest of the reply (query results), '' for errors and alarms
+        """
+        self.address = address
+        self.status = status
+        self.error = error
+        self.alarm = alarm
+        self.data = data
+
+    @property
+    def ok(self):
+        """
+        False for command errors and alarms
+        """
+        return self.error is None and self.status != ALARM
+
+    @property
+    def running(self):
+        return self.status in (INFUSING, WITHDRAWING)
+
+    def value(self):
+        """
+        comparable value of a query result: the leading number as a float
+        (units dropped, '100.0MH' -> 100.0), or the data as is ('INF')
+        """
+        data = self.data.replace(' ', '')
+        m = _number.match(data)
+        if m:
+            return float(m.group(0))
+        return data
+
+    def dispensed(self):
+        """
+        decoded DIS result: (infused, withdrawn, units), None if data isn't one
+        """
+        m = _dispensed.match(self.data.replace(' ', ''))
+        if m is None:
+            return None
+        return float(m.group(1)), float(m.group(2)), m.group(3)
+
+    def describe(self):
+        """
+        readable status, error or alarm
+        """
+        if self.status == ALARM:
+            return 'alarm: %s' % ALARMS.get(self.alarm, self.alarm)
+        if self.error is not None:
+            return ERRORS.get(self.error, self.error)
+        return STATES.get(self.status, self.status)
+
+    def __repr__(self):
+        return 'Reply(%r, %r, error=%r, alarm=%r, data=%r)' % \
+            (self.address, self.status, self.error, self.alarm, self.data)
+
+
+def number(text):
+    """
+    text as a float if all of it is a number ('0.02', '15.', '.5'), else None
+    """
+    m = _number.match(text)
+    if m is None or m.end() != len(text):
+        return None
+    return float(text)
+
+
+def parse_reply(frame):
+    """
+    parse one STX ... ETX reply frame (bytes, memoryview or str)
+
+    raises FrameError if frame is not a complete reply frame
+    """
+    if isinstance(frame, memoryview):
+        frame = frame.tobytes()
+    text = to_str(frame)
+    if len(text) < 5 or text[0] != to_str(STX) or text[-1] != to_str(ETX):
+        raise FrameError('not a reply frame: %r' % (frame,))
+    address = None
+    if text[1:3].isdigit():
+        address = int(text[1:3])
+    status = text[3]
+    data = text[4:-1]
+    if data[:1] != '?':
+        return Reply(address, status, data=data)
+    if status == ALARM:
+        return Reply(address, status, alarm=data[1:])
+    return Reply(address, status, error=data)
@@ -0,0 +1,459 @@
+#
+# pumpsim.py
+#
+# Stand-in for an IP-serial bridge with a network of NE500 pumps behind it,
+# so IPSerial, NE500Network, IPSerialBridge and aiopumpnetwork can be run
+# (and benchmarked) without the rigs:
+#
+#   sim = BridgeSimulator(npumps=2, latency=0.005).start()
+#   n = pumpnetwork.NE500Network(*sim.address, npumps=2)
+#
+# or from the command line: python pumpsim.py --port 10000 --npumps 2
+#
+
+import re
+import time
+import socket
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from pumpprofiles import volume_units
+
+
+STX = '\x02'
+ETX = '\x03'
+
+# ml/hr is the only rate unit simulated, VOL and DIS are in ml or ul
+# depending on DIA (see pumpprofiles.volume_units)
+MAX_RATE = 1000.0
+
+
+class OutOfRange(ValueError):
+    pass
+
+
+class SimulatedPump(object):
+    def __init__(self, address, speed=1.0):
+        """
+        state of one simulated NE500 pump
+
+        address : int
+            network address (0-99)
+
+        speed : float
+            simulated time runs this many times faster than real time, so
+            pumping phases finish sooner
+        """
+        self.address = address
+        self.speed = speed
+        self.reset()
+
+    def reset(self):
+        self.dia = 15.0
+        # program phases (PHN/FUN), RAT, VOL and DIR apply to the current one
+        self.phases = [self._new_phase()]
+        self.phase = 0
+        self.loops = {}
+        self.dispensed = {'INF': 0.0, 'WDR': 0.0}
+        self.running = False
+        self.run_start = 0.0
+        self.run_direction = 'INF'
+        self.alarm = None
+
+    @staticmethod
+    def _new_phase():
+        return {'FUN': 'RAT', 'rate': 0.0, 'vol': 0.0, 'direction': 'INF'}
+
+    def _phase_property(key):
+        def get(self):
+            return self.phases[self.phase][key]
+
+        def set(self, value):
+            self.phases[self.phase][key] = value
+        return property(get, set)
+
+    rate = _phase_property('rate')
+    vol = _phase_property('vol')
+    direction = _phase_property('direction')
+    del _phase_property
+
+    def units(self):
+        return volume_units(self.dia)
+
+    def _pumped(self, now):
+        """
+        volume (in VOL units) pumped so far in the current run
+        """
+        hours = (now - self.run_start) * self.speed / 3600.
+        pumped = self.rate * hours
+        if self.units() == 'UL':
+            pumped *= 1000.
+        if self.vol > 0:
+            pumped = min(pumped, self.vol)
+        return pumped
+
+    def update(self, now):
+        """
+        finish the current run if its volume has been pumped, and go on with
+        the next program phases
+        """
+        while self.running and self.vol > 0 and self._pumped(now) >= self.vol:
+            # the next phase starts when this one ended
+            scale = 1000. if self.units() == 'UL' else 1.
+            end = self.run_start + self.vol / (self.rate * scale) * 3600. / self.speed
+            self.stop(end)
+            self.phase += 1
+            self._enter(end)
+
+    def _enter(self, now):
+        """
+        execute phases from the current one until one pumps or the program
+        ends (back to phase 1)
+        """
+        while self.phase < len(self.phases):
+            fun = self.phases[self.phase]['FUN']
+            if fun == 'RAT':
+                if self.rate <= 0:
+                    break
+                self.running = True
+                self.run_start = now
+                self.run_direction = self.direction
+                return
+            if fun.startswith('LOP'):
+                count = self.loops.get(self.phase, 0) + 1
+                start = max([i for i in range(self.phase)
+                    if self.phases[i]['FUN'] == 'LPS'] or [-1])
+                if count < int(fun[3:]):
+                    self.loops[self.phase] = count
+                    self.phase = start + 1
+                    continue
+                self.loops.pop(self.phase, None)
+            elif fun == 'STP':
+                break
+            self.phase += 1
+        self.phase = 0
+        self.loops = {}
+
+    def stop(self, now):
+        if self.running:
+            self.dispensed[self.run_direction] += self._pumped(now)
+            self.running = False
+
+    def status(self):
+        if self.alarm is not None:
+            return 'A'
+        if self.running:
+            return self.run_direction[0]
+        return 'S'
+
+    def dis(self, now):
+        dispensed = dict(self.dispensed)
+        if self.running:
+            dispensed[self.run_direction] += self._pumped(now)
+        return 'I%.3fW%.3f%s' % (dispensed['INF'], dispensed['WDR'], self.units())
+
+    def command(self, cmd, args, now):
+        """
+        execute one command, returns (status, data) for the reply
+        """
+        self.update(now)
+        if self.alarm is not None:
+            # alarms are reported (once) in the reply to the next command
+            alarm = self.alarm
+            self.alarm = None
+            return 'A', '?' + alarm
+
+        if cmd == '':
+            return self.status(), ''
+
+        handler = getattr(self, 'cmd_' + cmd, None)
+        if handler is None:
+            return self.status(), '?'
+        try:
+            data = handler(args, now)
+        except ValueError:
+            return self.status(), '?'
+        return self.status(), data
+
+    def _number(self, args, low, high):
+        value = float(args[0])
+        if value < low or value > high:
+            raise OutOfRange()
+        return value
+
+    def _setter(self, args, low, high):
+        if self.running:
+            return None, '?NA'
+        try:
+            return self._number(args, low, high), ''
+        except OutOfRange:
+            return None, '?OOR'
+
+    def cmd_DIA(self, args, now):
+        if not args:
+            return '%.2f' % self.dia
+        value, error = self._setter(args, 0.1, 50.0)
+        if value is not None:
+            self.dia = value
+        return error
+
+    def cmd_RAT(self, args, now):
+        if not args:
+            return '%.1fMH' % self.rate
+        # the rate can be changed while pumping
+        try:
+            self.rate = self._number(args, 0.0, MAX_RATE)
+        except OutOfRange:
+            return '?OOR'
+        return ''
+
+    def cmd_VOL(self, args, now):
+        if not args:
+            return '%.3f%s' % (self.vol, self.units())
+        value, error = self._setter(args, 0.0, 9999.0)
+        if value is not None:
+            self.vol = value
+        return error
+
+    def cmd_DIR(self, args, now):
+        if not args:
+            return self.direction
+        direction = args[0]
+        if direction == 'REV':
+            direction = {'INF': 'WDR', 'WDR': 'INF'}[self.direction]
+        if direction not in ('INF', 'WDR'):
+            return '?OOR'
+        if self.running and direction != self.run_direction:
+            # reversing while pumping starts a new run the other way
+            self.stop(now)
+            self.run_direction = direction
+            self.run_start = now
+            self.running = True
+        self.direction = direction
+        return ''
+
+    def cmd_RUN(self, args, now):
+        if self.running:
+            return ''
+        if self.phases[self.phase]['FUN'] == 'RAT' and self.rate <= 0:
+            return '?NA'
+        self._enter(now)
+        return ''
+
+    def cmd_STP(self, args, now):
+        self.stop(now)
+        self.phase = 0
+        self.loops = {}
+        return ''
+
+    def cmd_PHN(self, args, now):
+        if not args:
+            return '%02i' % (self.phase + 1)
+        if self.running:
+            return '?NA'
+        try:
+            phase = int(self._number(args, 1, 41))
+        except OutOfRange:
+            return '?OOR'
+        while len(self.phases) < phase:
+            self.phases.append(self._new_phase())
+        self.phase = phase - 1
+        return ''
+
+    def cmd_FUN(self, args, now):
+        if not args:
+            return self.phases[self.phase]['FUN']
+        if self.running:
+            return '?NA'
+        fun = args[0].upper()
+        if fun == 'LOP':
+            try:
+                fun = 'LOP%02i' % self._number(args[1:], 2, 99)
+            except (OutOfRange, IndexError):
+                return '?OOR'
+        elif fun not in ('RAT', 'STP', 'LPS'):
+            return '?OOR'
+        self.phases[self.phase]['FUN'] = fun
+        return ''
+
+    def cmd_DIS(self, args, now):
+        return self.dis(now)
+
+    def cmd_CLD(self, args, now):
+        if not args or args[0] not in ('INF', 'WDR'):
+            return '?'
+        self.dispensed[args[0]] = 0.0
+        return ''
+
+    def cmd_ADR(self, args, now):
+        return ''
+
+    def cmd_RESET(self, args, now):
+        self.reset()
+        return ''
+
+
+class PumpNetworkSimulator(object):
+    def __init__(self, npumps=2, latency=0.0, speed=1.0):
+        """
+        NE500 pump network: pumps 1..npumps on one serial line
+
+        latency : float
+            seconds before each reply frame is sent
+
+        speed : float
+            see SimulatedPump
+        """
+        self.pumps = dict((a, SimulatedPump(a, speed)) for a in range(1, npumps + 1))
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def alarm(self, address, code='S'):
+        """
+        raise an alarm on a pump, e.g. 'S' (stall), 'R' (reset), 'T' (timeout)
+        """
+        with self.lock:
+            pump = self.pumps[address]
+            pump.stop(time.time())
+            pump.alarm = code
+
+    def _pump_command(self, address, text, now):
+        words = text.split()
+        cmd = words[0].upper() if words else ''
+        pump = self.pumps.get(address)
+        if pump is None:
+            return None
+        status, data = pump.command(cmd, words[1:], now)
+        return STX + '%02i%s%s' % (address, status, data) + ETX
+
+    def handle_line(self, line):
+        """
+        execute one '\r'-terminated command line, returns the reply frames
+        (in order)
+
+        lines can be
+            '<address> <command>'   one pump (no address = pump 0)
+            '*<command>'            broadcast, only the lowest address replies
+            '<n> <cmd>* <n> <cmd>*' network command burst, each pump replies
+        """
+        line = line.strip()
+        now = time.time()
+        with self.lock:
+            m = re.match(r'^(\d*)\s*\*\s*RESET$', line, re.IGNORECASE)
+            if m:
+                for pump in self.pumps.values():
+                    pump.reset()
+                address = int(m.group(1)) if m.group(1) else min(self.pumps)
+                return [self._pump_command(address, '', now)]
+
+            if line.startswith('*'):
+                replies = [self._pump_command(a, line[1:], now) for a in sorted(self.pumps)]
+                return replies[:1]
+
+            replies = []
+            for part in [p.strip() for p in line.split('*')]:
+                if part == '' and replies:
+                    continue
+                m = re.match(r'^(\d*)\s*(.*)$', part)
+                address = int(m.group(1)) if m.group(1) else 0
+                reply = self._pump_command(address, m.group(2), now)
+                if reply is not None:
+                    replies.append(reply)
+            return replies
+
+
+class _BridgeHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        network = self.server.network
+        buf = ''
+        while True:
+            try:
+                data = sock.recv(4096)
+            except socket.error:
+                return
+            if not data:
+                return
+            buf += data.decode('latin-1')
+            while '\r' in buf:
+                line, buf = buf.split('\r', 1)
+                for reply in network.handle_line(line):
+                    if network.latency > 0:
+                        time.sleep(network.latency)
+                    sock.sendall(reply.encode('latin-1'))
+
+
+class _BridgeServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class BridgeSimulator(object):
+    def __init__(self, npumps=2, host='127.0.0.1', port=0, latency=0.0, speed=1.0):
+        """
+        TCP server emulating one IP-serial bridge (see PumpNetworkSimulator)
+
+        port : int
+            0 picks a free port, see address
+        """
+        self.network = PumpNetworkSimulator(npumps, latency, speed)
+        self.server = _BridgeServer((host, port), _BridgeHandler)
+        self.server.network = self.network
+        self.thread = None
+
+    @property
+    def address(self):
+        """
+        (host, port) to connect to
+        """
+        return self.server.server_address
+
+    @property
+    def pumps(self):
+        return self.network.pumps
+
+    def alarm(self, address, code='S'):
+        self.network.alarm(address, code)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='simulated NE500 IP-serial bridge')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=10000)
+    parser.add_argument('--npumps', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds before each reply')
+    parser.add_argument('--speed', type=float, default=1.0,
+        help='simulated pumping time runs this many times faster')
+    args = parser.parse_args()
+
+    sim = BridgeSimulator(args.npumps, args.host, args.port, args.latency, args.speed)
+    print('Simulating %i pumps on %s:%i' % ((args.npumps,) + sim.address))
+    try:
+        sim.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,155 @@
+#
+# pumpstatus.py
+#
+# Background status watching for the pumps on one bridge: a StatusPoller
+# thread queries every pump at an adaptive rate, publishes state changes
+# and resolves "pump idle" waits, so callers don't spin on status queries:
+#
+#   poller = StatusPoller(n).start()
+#   poller.subscribe(lambda n, pump, old, new: ...)
+#   n.infuse(1, 0.02)
+#   poller.wait_idle(1).result(timeout=10)
+#
+
+import time
+import socket
+import threading
+
+from pumpnetwork import PendingReply
+# status letters in NE500 replies, re-exported here
+from pumpreply import STOPPED, INFUSING, WITHDRAWING, PAUSED, ALARM, STATES, parse_reply
+
+
+class StatusPoller(object):
+    def __init__(self, network, pumps=None, min_interval=0.02, max_interval=1.0):
+        """
+        network : NE500Network
+            connected network, shared with other threads through network.lock
+
+        pumps : list of int
+            pump addresses to watch, defaults to 1..network.npumps
+
+        min_interval : float
+            seconds between polls of a pump that is running, has just
+            changed state or is being waited for
+
+        max_interval : float
+            polls of an idle pump back off (doubling) up to this many seconds
+        """
+        if pumps is None:
+            pumps = range(1, network.npumps + 1)
+        self.network = network
+        self.pumps = list(pumps)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self.lock = threading.Lock()
+        self.status = dict((p, None) for p in self.pumps)
+        self.intervals = dict((p, min_interval) for p in self.pumps)
+        self.next_poll = dict((p, 0.0) for p in self.pumps)
+        self.waiters = dict((p, []) for p in self.pumps)
+        self.listeners = []
+
+        self.wake = threading.Event()
+        self.running = False
+        self.thread = None
+
+    def subscribe(self, callback):
+        """
+        call callback(network, pump, old, new) whenever a pump's status letter
+        changes (old is None for the first poll), from the poller thread
+        """
+        self.listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        self.listeners.remove(callback)
+
+    def wait_idle(self, pump):
+        """
+        returns a PendingReply that resolves to the status reply the next
+        time pump reports stopped (or fails if polling it fails)
+        """
+        pending = PendingReply('%02i\r' % pump)
+        with self.lock:
+            self.waiters[pump].append(pending)
+            # poll it right away
+            self.intervals[pump] = self.min_interval
+            self.next_poll[pump] = 0.0
+        self.wake.set()
+        return pending
+
+    def poll(self, pump):
+        """
+        query one pump now, publish changes, resolve waiters
+        """
+        try:
+            reply = self.network.call_and_response('%02i\r' % pump,
+                timeout=self.network.reply_timeout or 1.0)
+        except (socket.error, IOError) as E:
+            with self.lock:
+                waiters, self.waiters[pump] = self.waiters[pump], []
+                self._reschedule(pump, changed=False)
+            for pending in waiters:
+                pending.set_exception(E)
+            return None
+
+        new = parse_reply(reply).status
+        with self.lock:
+            old = self.status[pump]
+            self.status[pump] = new
+            waiters = []
+            if new == STOPPED:
+                waiters, self.waiters[pump] = self.waiters[pump], []
+            self._reschedule(pump, changed=(new != old))
+
+        if new != old:
+            for callback in list(self.listeners):
+                callback(self.network, pump, old, new)
+        for pending in waiters:
+            pending.set_result(reply)
+        return new
+
+    def _reschedule(self, pump, changed):
+        busy = self.status[pump] in (INFUSING, WITHDRAWING) or self.waiters[pump]
+        if changed or busy:
+            interval = self.min_interval
+        else:
+            interval = min(self.intervals[pump] * 2, self.max_interval)
+        self.intervals[pump] = interval
+        self.next_poll[pump] = time.time() + interval
+
+    def poll_due(self):
+        """
+        poll every pump whose next poll is due, returns seconds until the next
+        one is
+        """
+        now = time.time()
+        for pump in self.pumps:
+            if self.next_poll[pump] <= now:
+                self.poll(pump)
+        return max(min(self.next_poll.values()) - time.time(), 0)
+
+    def _run(self):
+        while self.running:
+            self.wake.wait(self.poll_due())
+            self.wake.clear()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
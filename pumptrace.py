@@ -0,0 +1,367 @@
+#
+# pumptrace.py
+#
+# Per-command trace records from NE500Network, and hooks to collect them:
+#
+#   ring = RingBuffer(1000)
+#   n.add_hook(ring)
+#   ...
+#   for r in ring.records(): print(r.command, r.duration, r.select_wait)
+#
+# a hook is any callable taking a CommandRecord, it runs on the thread that
+# sent the command, so it should be quick
+#
+# BinaryLog keeps every exchange as a fixed size record for later analysis,
+# read_log maps such a file as a NumPy record array:
+#
+#   n.add_hook(BinaryLog('session.ne500', setups={'192.168.0.2': 1}))
+#   log = read_log('session.ne500')
+#   water = log['param'][(log['command'] == COMMANDS.index('VOL')) & (log['error'] == 0)]
+#
+
+import os
+import json
+import struct
+import socket
+import threading
+from collections import deque
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pumpreply import FrameError, number, parse_reply
+
+
+class CommandRecord(object):
+    __slots__ = ('timestamp', 'address', 'port', 'pump', 'command', 'status', 'reply',
+        'bytes_sent', 'bytes_received', 'select_wait', 'sleep', 'duration', 'retries',
+        'error')
+
+    def __init__(self, timestamp, address, port, pump, command, status, reply,
+            bytes_sent, bytes_received, select_wait, sleep, duration, retries, error):
+        """
+        one command/reply exchange with a bridge
+
+        timestamp : float
+            time.time() when the command was written
+
+        address, port :
+            the bridge
+
+        pump : int or None
+            pump address of the command (None for broadcasts and bursts)
+
+        command : str
+            command as sent, without the '\\r'
+
+        status : str
+            status letter of the reply ('S', 'I', 'W', 'A', ...), '' if none
+
+        reply : str
+            reply as received ('' if none)
+
+        bytes_sent, bytes_received : int
+
+        select_wait : float
+            seconds spent waiting in select for the reply (with a ReplyReader:
+            from the end of the write until the reply came in)
+
+        sleep : float
+            seconds spent in fixed pauses
+
+        duration : float
+            seconds from writing the command to having the reply
+
+        retries : int
+            read/write timeouts that were retried
+
+        error : str or None
+            the error if the exchange failed
+        """
+        self.timestamp = timestamp
+        self.address = address
+        self.port = port
+        self.pump = pump
+        self.command = command
+        self.status = status
+        self.reply = reply
+        self.bytes_sent = bytes_sent
+        self.bytes_received = bytes_received
+        self.select_wait = select_wait
+        self.sleep = sleep
+        self.duration = duration
+        self.retries = retries
+        self.error = error
+
+    @property
+    def name(self):
+        """
+        command word ('RUN', 'VOL', ...), 'status' for a bare status query
+        """
+        # bursts ('1 DIS* 2 DIS') are named after their first command
+        words = self.command.lstrip('0123456789* ').split('*')[0].split()
+        if not words:
+            return 'status'
+        return words[0].upper()
+
+    def as_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def __repr__(self):
+        return 'CommandRecord(%r, pump=%r, status=%r, duration=%.4f)' % \
+            (self.command, self.pump, self.status, self.duration)
+
+
+class RingBuffer(object):
+    def __init__(self, size=10000):
+        """
+        keeps the last size records
+        """
+        self.buffer = deque(maxlen=size)
+
+    def __call__(self, record):
+        self.buffer.append(record)
+
+    def records(self):
+        return list(self.buffer)
+
+    def clear(self):
+        self.buffer.clear()
+
+
+class Histogram(object):
+    # upper bin edges, in ms
+    edges = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self, edges=None):
+        """
+        command durations per command name (see CommandRecord.name), binned
+
+        edges : sequence of float
+            upper bin edges in ms, anything longer lands in an overflow bin
+        """
+        if edges is not None:
+            self.edges = tuple(edges)
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def __call__(self, record):
+        ms = record.duration * 1000.
+        i = 0
+        while i < len(self.edges) and ms > self.edges[i]:
+            i += 1
+        with self.lock:
+            counts = self.counts.get(record.name)
+            if counts is None:
+                counts = self.counts[record.name] = [0] * (len(self.edges) + 1)
+            counts[i] += 1
+
+    def summary(self):
+        """
+        {name: [(upper edge in ms or None for overflow, count), ...]}
+        """
+        edges = list(self.edges) + [None]
+        with self.lock:
+            return dict((name, list(zip(edges, counts)))
+                for name, counts in self.counts.items())
+
+    def clear(self):
+        with self.lock:
+            self.counts = {}
+
+
+class FileLog(object):
+    def __init__(self, f):
+        """
+        writes one JSON object per record and line
+
+        f : str or file
+            path (opened for appending) or an open file
+        """
+        if isinstance(f, str):
+            f = open(f, 'a')
+        self.file = f
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record.as_dict(), sort_keys=True)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+# command codes of BinaryLog records, anything else is logged as OTHER
+COMMANDS = ('status', 'RUN', 'STP', 'DIA', 'RAT', 'VOL', 'DIR', 'DIS', 'CLD', 'PHN',
+    'FUN', 'ADR', 'RESET')
+OTHER = 255
+
+# error codes of BinaryLog records
+ERROR_CODES = {None: 0, '?': 1, '?NA': 2, '?OOR': 3}
+OTHER_ERROR = 4
+ALARM_ERROR = 5
+# no reply (timeout, connection lost, ...)
+FAILED = 6
+
+LOG_MAGIC = b'NE500LOG'
+LOG_VERSION = 1
+# little endian, no padding, see LOG_FIELDS
+LOG_FORMAT = '<dIHHbBcBf4sffff'
+LOG_FIELDS = (
+    ('time', '<f8'),        # time.time() when the command was written
+    ('address', '<u4'),     # bridge IPv4 address (as an int, 0 if not IPv4)
+    ('port', '<u2'),        # bridge port
+    ('setup', '<u2'),       # see BinaryLog setups
+    ('pump', 'i1'),         # pump address, -1 for broadcasts and bursts
+    ('command', 'u1'),      # index into COMMANDS, or OTHER
+    ('status', 'S1'),       # status letter of the reply, b' ' if none
+    ('error', 'u1'),        # 0, see ERROR_CODES, OTHER_ERROR, ALARM_ERROR, FAILED
+    ('param', '<f4'),       # numeric parameter, NaN if none
+    ('arg', 'S4'),          # text parameter ('INF', 'WDR', ...), b'' if none
+    ('value', '<f4'),       # numeric query result, NaN if none
+    ('infused', '<f4'),     # DIS results, NaN for other commands
+    ('withdrawn', '<f4'),
+    ('duration', '<f4'),    # seconds
+)
+_record = struct.Struct(LOG_FORMAT)
+_header = struct.Struct('<8sII')
+NAN = float('nan')
+
+
+def _ipv4(address):
+    try:
+        return struct.unpack('>I', socket.inet_aton(address))[0]
+    except (socket.error, TypeError, ValueError):
+        return 0
+
+
+class BinaryLog(object):
+    def __init__(self, f, setups=None):
+        """
+        appends one fixed size binary record per record (see LOG_FIELDS and
+        read_log)
+
+        f : str or file
+            path (opened for appending) or a file open in binary append mode
+
+        setups : dict
+            {bridge address: setup number} for the setup field (0 if missing)
+        """
+        if isinstance(f, str):
+            f = open(f, 'ab')
+        self.file = f
+        self.setups = dict(setups or {})
+        self.addresses = {}
+        self.lock = threading.Lock()
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            f.write(_header.pack(LOG_MAGIC, LOG_VERSION, _record.size))
+
+    def pack(self, record):
+        """
+        the binary record of a CommandRecord
+        """
+        address = self.addresses.get(record.address)
+        if address is None:
+            address = self.addresses[record.address] = _ipv4(record.address)
+        name = record.name
+        command = COMMANDS.index(name) if name in COMMANDS else OTHER
+
+        param, arg = NAN, b''
+        words = record.command.split('*')[0].split()
+        if name in words and words.index(name) + 1 < len(words):
+            text = words[words.index(name) + 1]
+            value = number(text)
+            if value is None:
+                arg = text[:4].encode('latin-1')
+            else:
+                param = value
+
+        status, error = b' ', FAILED
+        value = infused = withdrawn = NAN
+        if record.error is None and '\x03' in record.reply:
+            try:
+                # the first frame (bursts have one per pump)
+                reply = parse_reply(record.reply[:record.reply.index('\x03') + 1])
+            except FrameError:
+                reply = None
+            if reply is not None:
+                status = reply.status.encode('latin-1')
+                if reply.alarm is not None:
+                    error = ALARM_ERROR
+                else:
+                    error = ERROR_CODES.get(reply.error, OTHER_ERROR)
+                result = reply.value()
+                if isinstance(result, float):
+                    value = result
+                dispensed = reply.dispensed()
+                if dispensed is not None:
+                    infused, withdrawn = dispensed[:2]
+
+        return _record.pack(record.timestamp, address, record.port or 0,
+            self.setups.get(record.address, 0), -1 if record.pump is None else record.pump,
+            command, status, error, param, arg, value, infused, withdrawn, record.duration)
+
+    def __call__(self, record):
+        data = self.pack(record)
+        with self.lock:
+            self.file.write(data)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def _log_records(path):
+    """
+    number of complete records in a log file (a partly written last record
+    is ignored), checks the header
+    """
+    with open(path, 'rb') as f:
+        header = f.read(_header.size)
+    if len(header) < _header.size:
+        raise ValueError('%s is not a BinaryLog file' % path)
+    magic, version, size = _header.unpack(header)
+    if magic != LOG_MAGIC or version != LOG_VERSION or size != _record.size:
+        raise ValueError('%s is not a version %i BinaryLog file' % (path, LOG_VERSION))
+    return (os.path.getsize(path) - _header.size) // _record.size
+
+
+def read_log(path):
+    """
+    memory-map a BinaryLog file as a NumPy record array (fields: LOG_FIELDS),
+    read-only, nothing is loaded until it is used
+
+    needs numpy, see iter_log otherwise
+    """
+    if numpy is None:
+        raise ImportError('read_log needs numpy, use iter_log instead')
+    count = _log_records(path)
+    dtype = numpy.dtype(list(LOG_FIELDS))
+    if count == 0:
+        return numpy.zeros(0, dtype=dtype).view(numpy.recarray)
+    return numpy.memmap(path, dtype=dtype, mode='r', offset=_header.size,
+        shape=(count,)).view(numpy.recarray)
+
+
+def iter_log(path):
+    """
+    records of a BinaryLog file as tuples (in LOG_FIELDS order), no numpy needed
+    """
+    count = _log_records(path)
+    with open(path, 'rb') as f:
+        f.seek(_header.size)
+        for i in range(count):
+            yield _record.unpack(f.read(_record.size))
@@ -0,0 +1,242 @@
+#
+# pumpvolume.py
+#
+# Volume delivered per pump and session, from the pumps' own DIS counters
+# (cleared with CLD at session boundaries). A VolumeLedger reads every pump
+# on a bridge with one command burst, periodically and/or after RUN
+# commands, so totals come from memory instead of a round trip per pump:
+#
+#   ledger = VolumeLedger(n, setup=3).start()
+#   n.infuse(1, 0.02)
+#   ledger.totals()          # {pump: (infused ml, withdrawn ml)}
+#   ledger.new_session()     # close the session, clear the counters
+#
+
+import time
+import socket
+import threading
+
+from pumpnetwork import CommandBurst
+from pumpreply import parse_reply
+
+# DIS units to ml
+UNITS = {'ML': 1.0, 'UL': 0.001}
+
+
+class VolumeLedger(object):
+    def __init__(self, network, pumps=None, setup=None, interval=None, after_run=True,
+            settle=0.05):
+        """
+        network : NE500Network
+            connected network, shared with other threads through network.lock
+
+        pumps : list of int
+            pump addresses (0-9, they are read with command bursts), defaults
+            to 1..network.npumps
+
+        setup : any
+            label for this bridge, see combined_totals
+
+        interval : float or None
+            seconds between readings of every pump (None: no periodic readings)
+
+        after_run : bool
+            read a pump after each RUN sent to it (through the network's trace
+            hooks), again every settle seconds until it reports stopped
+        """
+        if pumps is None:
+            pumps = range(1, network.npumps + 1)
+        self.network = network
+        self.pumps = list(pumps)
+        assert all((p >= 0) and (p <= 9) for p in self.pumps)
+        self.setup = setup
+        self.interval = interval
+        self.settle = settle
+
+        self.lock = threading.Lock()
+        # current session, volumes in ml: counters read so far, and what
+        # counters that went back to 0 (pump reset, CLD elsewhere) had counted
+        self.session = {'name': None, 'start': time.time()}
+        self.counters = dict((p, (0.0, 0.0)) for p in self.pumps)
+        self.carried = dict((p, (0.0, 0.0)) for p in self.pumps)
+        self.sampled = dict((p, None) for p in self.pumps)
+        # closed sessions
+        self.sessions = []
+        self.dirty = set()
+
+        self.wake = threading.Event()
+        self.running = False
+        self.thread = None
+        if after_run:
+            network.add_hook(self._on_record)
+
+    def _on_record(self, record):
+        # runs on the thread that sent the command, network.lock held
+        if record.name != 'RUN' or record.error is not None:
+            return
+        if record.pump is None:
+            # '*RUN' starts every pump
+            pumps = self.pumps
+        elif record.pump in self.counters:
+            pumps = [record.pump]
+        else:
+            return
+        with self.lock:
+            self.dirty.update(pumps)
+        self.wake.set()
+
+    def sample(self, pumps=None):
+        """
+        read the DIS counters of pumps (default: all) with one burst and
+        update the ledger
+
+        returns the pumps that are still running (or didn't reply)
+        """
+        if pumps is None:
+            pumps = self.pumps
+        burst = CommandBurst()
+        for p in pumps:
+            burst.add(p, 'DIS')
+        results = self.network.send_burst(burst)
+        now = time.time()
+
+        busy = []
+        with self.lock:
+            for pump, cmd, param, frame in results:
+                if frame is None:
+                    busy.append(pump)
+                    continue
+                reply = parse_reply(frame)
+                dispensed = reply.dispensed()
+                if not reply.ok or dispensed is None:
+                    busy.append(pump)
+                    continue
+                infused, withdrawn, units = dispensed
+                scale = UNITS.get(units, 1.0)
+                self._count(pump, infused * scale, withdrawn * scale)
+                self.sampled[pump] = now
+                if reply.running:
+                    busy.append(pump)
+        return busy
+
+    def _count(self, pump, infused, withdrawn):
+        last_infused, last_withdrawn = self.counters[pump]
+        if infused < last_infused or withdrawn < last_withdrawn:
+            # counters were cleared behind our back, keep what they had
+            carried = self.carried[pump]
+            self.carried[pump] = (carried[0] + last_infused, carried[1] + last_withdrawn)
+        self.counters[pump] = (infused, withdrawn)
+
+    def totals(self):
+        """
+        {pump: (infused ml, withdrawn ml)} in the current session, as of the
+        last reading (no commands are sent)
+        """
+        with self.lock:
+            return dict((p, (self.carried[p][0] + self.counters[p][0],
+                self.carried[p][1] + self.counters[p][1])) for p in self.pumps)
+
+    def new_session(self, name=None):
+        """
+        read every pump a last time, close the current session and clear the
+        pump counters (CLD INF, CLD WDR), holding network.lock so no command
+        gets in between
+
+        returns the closed session: dict with 'name', 'start', 'end' and
+        'volumes' ({pump: (infused ml, withdrawn ml)})
+        """
+        with self.network.lock:
+            self.sample()
+            burst = CommandBurst()
+            for p in self.pumps:
+                burst.add(p, 'CLD', 'INF')
+                burst.add(p, 'CLD', 'WDR')
+            results = self.network.send_burst(burst)
+            failed = [pump for pump, cmd, param, reply in results
+                if reply is None or not parse_reply(reply).ok]
+            if failed:
+                raise IOError('could not clear the volume counters of pumps %s' % \
+                    sorted(set(failed)))
+
+            with self.lock:
+                session = dict(self.session)
+                session['end'] = time.time()
+                session['volumes'] = dict((p, (self.carried[p][0] + self.counters[p][0],
+                    self.carried[p][1] + self.counters[p][1])) for p in self.pumps)
+                self.sessions.append(session)
+                self.session = {'name': name, 'start': session['end']}
+                for p in self.pumps:
+                    self.counters[p] = (0.0, 0.0)
+                    self.carried[p] = (0.0, 0.0)
+                self.dirty.clear()
+        return session
+
+    def _run(self):
+        next_sample = time.time()
+        while self.running:
+            timeout = None
+            with self.lock:
+                if self.dirty:
+                    timeout = self.settle
+            if self.interval is not None:
+                due = max(next_sample - time.time(), 0)
+                timeout = due if timeout is None else min(timeout, due)
+            self.wake.wait(timeout)
+            self.wake.clear()
+            if not self.running:
+                break
+
+            with self.lock:
+                pumps, self.dirty = self.dirty, set()
+            if self.interval is not None and time.time() >= next_sample:
+                pumps = set(self.pumps)
+                next_sample = time.time() + self.interval
+            if not pumps:
+                continue
+            try:
+                busy = self.sample(sorted(pumps))
+            except (socket.error, IOError):
+                busy = pumps
+            with self.lock:
+                self.dirty.update(busy)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        """
+        stop, and remove the RUN hook from the network
+        """
+        self.stop()
+        if self._on_record in self.network.hooks:
+            self.network.remove_hook(self._on_record)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def combined_totals(ledgers):
+    """
+    totals of several ledgers (one per bridge), from memory
+
+    returns {(setup, pump): (infused ml, withdrawn ml)}
+    """
+    totals = {}
+    for ledger in ledgers:
+        for pump, volumes in ledger.totals().items():
+            totals[(ledger.setup, pump)] = volumes
+    return totals
@@ -0,0 +1,34 @@
+#
+# conftest.py
+#
+# pytest fixtures: a simulated bridge (pumpsim.BridgeSimulator) and an
+# NE500Network connected to it, so the tests run without the rigs:
+#
+#   python -m pytest tests
+#
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pumpsim
+from pumpnetwork import NE500Network
+
+
+@pytest.fixture
+def sim():
+    # fast pumps: a delivery is over by the time the next command goes out
+    bridge = pumpsim.BridgeSimulator(npumps=2, speed=1e6).start()
+    yield bridge
+    bridge.stop()
+
+
+@pytest.fixture
+def network(sim):
+    n = NE500Network(sim.address[0], sim.address[1], npumps=2, reply_timeout=1.0)
+    yield n
+    n.stop_reader()
+    n.disconnect()
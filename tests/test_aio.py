@@ -0,0 +1,45 @@
+import asyncio
+
+from aiopumpnetwork import AsyncNE500Network, run_setups
+from pumpreply import parse_reply
+
+
+def run(sim, coroutine_function, npumps=2):
+    async def main():
+        n = AsyncNE500Network(sim.address[0], sim.address[1], npumps=npumps)
+        await n.connect(pump_wait=0)
+        try:
+            return await coroutine_function(n)
+        finally:
+            await n.disconnect()
+    return asyncio.run(main())
+
+
+def test_status_and_replies(sim):
+    async def check(n):
+        assert await n.status(1) == 'S'
+        return await n.call_and_response('02 DIA')
+    assert parse_reply(run(sim, check)).value() == 15.0
+
+
+def test_infuse_takes_an_int_volume(sim):
+    async def check(n):
+        await n.call_and_response('01 RAT 100.0')
+        await n.infuse(1, 1)
+        await n.wait_until_stopped(1)
+    run(sim, check)
+    assert sim.pumps[1].dispensed['INF'] == 1.0
+
+
+def test_single_pump_commandset_goes_to_pump_id(sim):
+    async def check(n):
+        return await n.run_commandset(2, {'RAT': '100.0', 'VOL': '0.5'}, npumps=1)
+    assert parse_reply(run(sim, check)).address == 2
+    assert sim.pumps[2].vol == 0.5
+    assert sim.pumps[1].vol == 0.0
+
+
+def test_run_setups(sim):
+    results = run_setups([sim.address[0]], sim.address[1], 1,
+        {'RAT': '100.0', 'VOL': '0.02'})
+    assert parse_reply(results[sim.address[0]]).address == 1
@@ -0,0 +1,62 @@
+from pumpnetwork import CommandBurst
+from pumpreply import parse_reply
+
+
+def test_pack_one_line():
+    burst = CommandBurst()
+    burst.add(0, 'RAT', 100)
+    burst.add(1, 'RAT', 250)
+    assert burst.pack(64) == [('0 RAT 100* 1 RAT 250*\r',
+        [(0, 'RAT', '100'), (1, 'RAT', '250')])]
+
+
+def test_pack_one_command_per_pump_per_line():
+    burst = CommandBurst()
+    burst.add(1, 'DIR', 'INF')
+    burst.add(1, 'VOL', 0.02)
+    burst.add(2, 'VOL', 0.02)
+    lines = burst.pack(64)
+    assert [line for line, commands in lines] == ['1 DIR INF* 2 VOL 0.02*\r', '1 VOL 0.02*\r']
+
+
+def test_pack_splits_long_lines():
+    burst = CommandBurst()
+    for pump in range(10):
+        burst.add(pump, 'RUN')
+    lines = burst.pack(20)
+    assert len(lines) > 1
+    assert all(len(line) <= 20 for line, commands in lines)
+    assert sum(len(commands) for line, commands in lines) == 10
+
+
+def test_send_burst(network):
+    burst = CommandBurst()
+    burst.add(1, 'DIA')
+    burst.add(2, 'DIA')
+    results = network.send_burst(burst)
+    assert [(pump, parse_reply(reply).address) for pump, cmd, param, reply in results] == \
+        [(1, 1), (2, 2)]
+
+
+def test_send_burst_with_reader(network):
+    network.start_reader()
+    test_send_burst(network)
+
+
+def test_send_burst_ignores_frames_from_other_pumps(network):
+    records = []
+    network.add_hook(records.append)
+    # left over from earlier: a reply from a pump not on the line, and garbage
+    network.rxbuffer.feed(b'\x0202S\x03\x02\x03')
+    burst = CommandBurst()
+    burst.add(1, 'DIA')
+    [(pump, cmd, param, reply)] = network.send_burst(burst)
+    assert parse_reply(reply).address == 1
+    assert len(records) == 1
+
+
+def test_set_params_burst_skips_cached(network):
+    commandset = {'DIA': '15.0', 'VOL': '0.02'}
+    assert len(network.set_params_burst([1, 2], commandset)) == 4
+    assert network.set_params_burst([1, 2], commandset) == []
+
@@ -0,0 +1,48 @@
+from pumpnetwork import param_value
+from pumpprofiles import Profile
+
+
+def test_param_value():
+    assert param_value('0.0200') == param_value(0.02) == 0.02
+    assert param_value('INF') == 'INF'
+
+
+def test_unchanged_param_is_not_sent(network):
+    assert network.set_param(1, 'VOL', '0.02') is not None
+    assert network.set_param(1, 'VOL', 0.0200) is None
+    assert network.set_param(1, 'VOL', '0.03') is not None
+    assert network.pumpstate[1]['VOL'] == 0.03
+
+
+def test_rejected_param_is_not_cached(network):
+    assert network.set_param(1, 'DIA', '99.0') is not None
+    assert 'DIA' not in network.pumpstate.get(1, {})
+
+
+def test_dia_clears_the_other_params(network):
+    network.set_param(1, 'VOL', '0.02')
+    network.set_param(1, 'DIA', '15.0')
+    assert network.pumpstate[1] == {'DIA': 15.0}
+
+
+def test_alarm_clears_the_cache(network, sim):
+    network.set_param(1, 'VOL', '0.02')
+    sim.alarm(1)
+    assert network.status(1) == 'A'
+    assert 1 not in network.pumpstate
+    assert network.set_param(1, 'VOL', '0.02') is not None
+
+
+def test_reconnect_clears_the_cache(network):
+    network.set_param(1, 'VOL', '0.02')
+    network.disconnect()
+    network.connect()
+    assert network.pumpstate == {}
+
+
+def test_profile_frames(network):
+    profile = Profile('test', {'DIA': '15.0', 'RAT': '100.0', 'VOL': '0.02', 'DIR': 'INF'})
+    sent = network.set_params(1, profile)
+    assert [cmd for cmd, reply in sent] == ['DIA', 'RAT', 'VOL', 'DIR']
+    assert network.set_params(1, profile) == []
+    assert network.set_params(1, {'VOL': '0.02', 'DIA': 15.0}) == []
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from pumpnetwork import CommandPipeline
+from pumpreply import parse_reply
+
+
+def test_replies_in_order(network):
+    replies = network.call_pipelined(['01', '02', '01 DIA', '02 DIA'], max_inflight=2)
+    assert [parse_reply(r).address for r in replies] == [1, 2, 1, 2]
+
+
+def test_timeout_raises(network, sim):
+    sim.network.latency = 0.1
+    with network.lock:
+        pipeline = CommandPipeline(network, timeout=0.01)
+        pending = pipeline.submit('01')
+        with pytest.raises(IOError):
+            pipeline.flush()
+    with pytest.raises(IOError):
+        pending.result(0)
+    assert len(pipeline) == 0
+
+
+def test_late_reply_is_dropped(network, sim):
+    sim.network.latency = 0.1
+    with network.lock:
+        pipeline = CommandPipeline(network, timeout=0.01)
+        pipeline.submit('01')
+        with pytest.raises(IOError):
+            pipeline.flush()
+        time.sleep(0.15)
+        sim.network.latency = 0.0
+        pipeline = CommandPipeline(network, timeout=1.0)
+        pending = pipeline.submit('02')
+        pipeline.flush()
+    assert parse_reply(pending.result(0)).address == 2
+
+
+def test_frame_with_nothing_in_flight(network):
+    network.pumpstate[2] = {'VOL': 0.02}
+    with network.lock:
+        pipeline = CommandPipeline(network, timeout=1.0)
+        # a reply, then an alarm nobody asked for, then (from the pump) the
+        # reply again: only the first one has a command waiting
+        network.rxbuffer.feed(b'\x0201S\x03\x0202A?S\x03')
+        pending = pipeline.submit('01')
+        pipeline.flush()
+    assert pending.result(0) == b'\x0201S\x03'
+    # the alarm went through check_alarm
+    assert 2 not in network.pumpstate
+
+
+def test_refuses_a_network_with_a_reader(network):
+    network.start_reader()
+    with pytest.raises(IOError):
+        CommandPipeline(network)
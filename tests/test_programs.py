@@ -0,0 +1,58 @@
+from pumpnetwork import PumpProgram
+from pumptrace import RingBuffer
+
+
+def commands(ring):
+    return [r.command for r in ring.records()]
+
+
+def test_reward_sends_only_what_changed(network, sim):
+    network.set_param(1, 'RAT', '100.0')
+    ring = RingBuffer()
+    network.add_hook(ring)
+    network.infuse(1, 1)
+    assert commands(ring) == ['01 DIR INF', '01 VOL 1.0000', '01 RUN']
+    network.wait_until_stopped(1)
+    ring.clear()
+    network.infuse(1, 1)
+    assert commands(ring) == ['01 RUN']
+    network.wait_until_stopped(1)
+    ring.clear()
+    network.infuse(1, 2)
+    assert commands(ring) == ['01 VOL 2.0000', '01 RUN']
+    network.wait_until_stopped(1)
+    # the simulator times runs only to a few percent at its speed
+    assert abs(sim.pumps[1].dispensed['INF'] - 4.0) < 0.1
+
+
+def test_reward_program_is_cached_per_direction(network):
+    network.set_param(1, 'RAT', '100.0')
+    network.infuse(1, 1)
+    network.wait_until_stopped(1)
+    network.withdraw(1, 1)
+    network.wait_until_stopped(1)
+    network.infuse(1, 1.0)
+    assert sorted(network.programs) == [(1, 'INF'), (1, 'WDR')]
+    assert network.programs[(1, 'INF')].volume == 1.0
+
+
+def test_trigger_runs_the_uploaded_program(network, sim):
+    network.set_param(1, 'DIA', '15.0')
+    network.upload_program(1, PumpProgram().loop_start().rate(100.0, 1.0).loop(3).stop())
+    assert network.trigger(1) is not None
+    network.wait_until_stopped(1)
+    assert abs(sim.pumps[1].dispensed['INF'] - 3.0) < 0.1
+
+
+def test_parameter_writes_leave_the_program(network, sim):
+    network.set_param(1, 'RAT', '100.0')
+    network.upload_program(1, PumpProgram().loop_start().rate(100.0, 1.0).loop(3).stop())
+    network.infuse(1, 2.0)
+    network.wait_until_stopped(1)
+    # one delivery of 2.0, not the program's loop over the new volume
+    assert abs(sim.pumps[1].dispensed['INF'] - 2.0) < 0.1
+    assert 1 not in network.uploaded
+    # back to the single phase delivery
+    network.infuse(1, 2.0)
+    network.wait_until_stopped(1)
+    assert abs(sim.pumps[1].dispensed['INF'] - 4.0) < 0.1
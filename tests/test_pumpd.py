@@ -0,0 +1,82 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+import pumpd
+from pumpnetwork import BridgePool, NE500Network
+from pumpreactor import Reactor
+
+
+@pytest.fixture
+def client(sim):
+    def factory(address, port, **kwargs):
+        return NE500Network(sim.address[0], sim.address[1], **kwargs)
+
+    reactor = Reactor().start()
+    pool = BridgePool(factory, npumps=2, reply_timeout=1.0, reactor=reactor)
+    path = os.path.join(tempfile.mkdtemp(), 'pumpd.sock')
+    daemon = pumpd.PumpDaemon(path, {1: 'sim'}, pool=pool).start()
+    c = pumpd.PumpClient(path)
+    c.daemon = daemon
+    yield c
+    c.close()
+    daemon.shutdown()
+    reactor.close()
+
+
+def test_round_trip(client):
+    assert client.ping()['time'] > 0
+    assert client.status(1, 1)['status'] == 'S'
+    assert client.call('setups') == {'1': 'sim'}
+    assert 'training' in client.call('profiles')
+
+
+def test_run_profile_and_stop(client):
+    replies = client.run_profile(1, 'training', [1, 2])
+    assert sorted(replies) == ['1', '2']
+    assert all(reply['ok'] for reply in replies.values())
+    assert client.stop(1, 1)['ok']
+
+
+def test_errors(client):
+    with pytest.raises(pumpd.RPCError) as E:
+        client.status(9, 1)
+    assert E.value.code == pumpd.PUMP_ERROR
+    with pytest.raises(pumpd.RPCError) as E:
+        client.call('nosuch')
+    assert E.value.code == pumpd.METHOD_NOT_FOUND
+    with pytest.raises(pumpd.RPCError) as E:
+        client.call('status', setup=1)
+    assert E.value.code == pumpd.INVALID_PARAMS
+
+
+def test_internal_error(client):
+    client.daemon.rpc_boom = lambda: 1 / 0
+    with pytest.raises(pumpd.RPCError) as E:
+        client.call('boom')
+    assert E.value.code == pumpd.INTERNAL_ERROR
+    assert client.ping()
+
+
+def test_client_reconnects_after_timeout(client):
+    client.daemon.rpc_slow = lambda: time.sleep(0.3)
+    client.timeout = 0.1
+    client.sock.settimeout(0.1)
+    with pytest.raises(IOError):
+        client.call('slow')
+    time.sleep(0.3)
+    # the late response to slow must not be taken for this one
+    assert 'time' in client.ping()
+
+
+def test_notifications_are_not_answered(client):
+    daemon = client.daemon
+    assert daemon.handle({'method': 'ping'}) is None
+    assert daemon.handle({'method': 'nosuch'}) is None
+    assert daemon.handle({'method': 'status', 'params': {'setup': 9, 'pump': 1}}) is None
+    assert daemon.handle({'method': 'status', 'params': {'setup': 1}}) is None
+    assert daemon.handle({'id': 1, 'method': 'nosuch'})['error']['code'] == \
+        pumpd.METHOD_NOT_FOUND
+    assert daemon.handle([])['error']['code'] == pumpd.INVALID_REQUEST
@@ -0,0 +1,83 @@
+import socket
+import threading
+
+import pumpsim
+from pumpnetwork import NE500Network
+from pumpreactor import Reactor
+from pumpreply import parse_reply
+
+
+def test_run_once_calls_back_readable_sockets():
+    reactor = Reactor()
+    a, b = socket.socketpair()
+    received = []
+    try:
+        reactor.register(a, lambda sock: received.append(sock.recv(100)))
+        assert len(reactor) == 1
+        assert reactor.run_once(0) == 0
+        b.send(b'x')
+        assert reactor.run_once(1.0) == 1
+        assert received == [b'x']
+        reactor.unregister(a)
+        b.send(b'y')
+        assert reactor.run_once(0.1) == 0
+        assert len(reactor) == 0
+    finally:
+        reactor.close()
+        a.close()
+        b.close()
+
+
+def test_failing_callback_does_not_stop_the_others():
+    reactor = Reactor()
+    pairs = [socket.socketpair() for i in range(2)]
+    received = []
+
+    def boom(sock):
+        sock.recv(100)
+        raise ValueError('boom')
+
+    try:
+        reactor.register(pairs[0][0], boom)
+        reactor.register(pairs[1][0], lambda sock: received.append(sock.recv(100)))
+        for a, b in pairs:
+            b.send(b'x')
+        assert reactor.run_once(1.0) == 2
+        assert received == [b'x']
+    finally:
+        reactor.close()
+        for a, b in pairs:
+            a.close()
+            b.close()
+
+
+def test_stop_wakes_the_loop():
+    reactor = Reactor(poll_interval=60.0).start()
+    thread = threading.Thread(target=reactor.stop)
+    thread.start()
+    thread.join(2.0)
+    assert not thread.is_alive()
+    reactor.close()
+
+
+def test_networks_share_a_reactor():
+    sims = [pumpsim.BridgeSimulator(npumps=2, speed=1e6).start() for i in range(2)]
+    networks = []
+    with Reactor() as reactor:
+        try:
+            for sim in sims:
+                networks.append(NE500Network(sim.address[0], sim.address[1], npumps=2,
+                    reply_timeout=1.0, reactor=reactor))
+            assert len(reactor) == 2
+            for n in networks:
+                assert parse_reply(n.call_and_response('02')).address == 2
+            # a reconnect registers the new socket in place of the old one
+            networks[0].reconnect()
+            assert len(reactor) == 2
+            assert networks[0].status(1) == 'S'
+        finally:
+            for n in networks:
+                n.stop_reader()
+                n.disconnect()
+            for sim in sims:
+                sim.stop()
@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+from pumpreply import ALARM, parse_reply
+
+
+def test_replies_go_to_the_command_that_asked(network):
+    network.call_and_response('01 DIA 15.0')
+    network.call_and_response('01 RAT 100.0')
+    network.start_reader()
+    errors = []
+
+    def query(cmd, expected):
+        for i in range(100):
+            reply = network.call_and_response(cmd)
+            if parse_reply(reply).value() != expected:
+                errors.append((cmd, reply))
+
+    # two commands to the same pump from different threads at once
+    threads = [threading.Thread(target=query, args=args)
+        for args in [('01 DIA', 15.0), ('01 RAT', 100.0)] * 2]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+
+def test_pumps_are_routed_by_address(network):
+    network.start_reader()
+    assert parse_reply(network.call_and_response('02')).address == 2
+    assert parse_reply(network.call_and_response('01')).address == 1
+
+
+def test_late_reply_is_dropped(network, sim):
+    network.call_and_response('01 RAT 100.0')
+    network.start_reader()
+    sim.network.latency = 0.1
+    with pytest.raises(IOError):
+        network.call_and_response('01 DIA', timeout=0.01)
+    sim.network.latency = 0.0
+    # the DIA reply must not be taken for the RAT reply
+    assert parse_reply(network.call_and_response('01 RAT')).value() == 100.0
+    time.sleep(0.15)
+    assert network.read() == b''
+
+
+def test_unanswered_command_fails_only_once(network):
+    network.start_reader()
+    # as if the reply to a cancelled command never came
+    network.reader.stale[1] = 1
+    with pytest.raises(IOError):
+        network.call_and_response('01', timeout=0.2)
+    assert parse_reply(network.call_and_response('01')).address == 1
+    assert not network.reader.stale[1]
+
+
+def test_unclaimed_alarm_goes_to_alarms(network):
+    reader = network.start_reader()
+    alarms = []
+    reader.subscribe(lambda n, reply: alarms.append(reply))
+    reader._dispatch(b'\x0202A?S\x03')
+    reply = reader.alarms.get(timeout=1.0)
+    assert (reply.address, reply.status, reply.alarm) == (2, ALARM, 'S')
+    assert alarms == [reply]
+
+
+def test_garbled_frame_does_not_stop_the_reader(network):
+    reader = network.start_reader()
+    reader._dispatch(b'\x02\x03')
+    assert network.read() == b'\x02\x03'
+    assert network.status(1) == 'S'
@@ -0,0 +1,57 @@
+import socket
+
+import pytest
+
+import pumpsim
+from pumpnetwork import NE500Network, idempotent
+from pumpreply import parse_reply
+
+
+def test_idempotent():
+    assert idempotent('01 DIA 15.0\r')
+    assert idempotent(b'02\r')
+    assert not idempotent('01 RUN\r')
+    assert not idempotent('01 DIR REV\r')
+    assert not idempotent('1 VOL 0.02* 2 VOL 0.02*\r')
+
+
+def drop(network):
+    # as if the bridge had closed the connection
+    network.socket.shutdown(socket.SHUT_RDWR)
+
+
+def test_idempotent_command_is_sent_again(network):
+    network.set_param(1, 'VOL', '0.02')
+    drop(network)
+    assert parse_reply(network.call_and_response('01 DIA')).value() == 15.0
+    # the cache was read back from the pump
+    assert network.pumpstate[1] == {'VOL': 0.02}
+
+
+def test_other_commands_are_not_repeated(network, sim):
+    network.call_and_response('01 RAT 100.0')
+    drop(network)
+    with pytest.raises(IOError):
+        network.call_and_response('01 RUN')
+    assert not sim.pumps[1].running
+    # but the connection works again
+    assert network.status(1) == 'S'
+
+
+def test_bridge_restart():
+    sim = pumpsim.BridgeSimulator(npumps=2, speed=1e6).start()
+    host, port = sim.address
+    network = NE500Network(host, port, npumps=2, reply_timeout=1.0, backoff=0.01)
+    try:
+        network.set_param(1, 'VOL', '0.02')
+        sim.stop()
+        with pytest.raises(IOError):
+            network.reconnect(attempts=2)
+        sim = pumpsim.BridgeSimulator(npumps=2, port=port, speed=1e6).start()
+        network.reconnect()
+        # the restarted pumps hold the defaults, not what was cached
+        assert network.pumpstate[1] == {'VOL': 0.0}
+        assert network.set_param(1, 'VOL', '0.02') is not None
+    finally:
+        network.disconnect()
+        sim.stop()
@@ -0,0 +1,55 @@
+import pytest
+
+from pumpreply import ALARM, INFUSING, STOPPED, FrameError, number, parse_reply
+
+
+def test_parse_reply():
+    reply = parse_reply(b'\x0201S100.0MH\x03')
+    assert (reply.address, reply.status, reply.ok) == (1, STOPPED, True)
+    assert reply.value() == 100.0
+    assert parse_reply(memoryview(b'\x0202IINF\x03')).value() == 'INF'
+    assert parse_reply('\x0202I\x03').running
+
+
+def test_errors_and_alarms():
+    reply = parse_reply(b'\x0201S?OOR\x03')
+    assert (reply.ok, reply.error, reply.data) == (False, '?OOR', '')
+    assert reply.describe() == 'command data out of range'
+    reply = parse_reply(b'\x0201A?S\x03')
+    assert (reply.ok, reply.status, reply.alarm) == (False, ALARM, 'S')
+    assert reply.describe() == 'alarm: pump motor stalled'
+
+
+@pytest.mark.parametrize('frame', [b'', b'\x02\x03', b'\x0201S', b'01S\x03', b'\x0201\x03'])
+def test_short_or_garbled_frames(frame):
+    with pytest.raises(FrameError):
+        parse_reply(frame)
+
+
+def test_frame_error_is_an_ioerror_and_a_valueerror():
+    for error in (IOError, ValueError):
+        with pytest.raises(error):
+            parse_reply(b'\x02\x03')
+
+
+def test_number():
+    assert number('0.02') == 0.02
+    assert number('15.') == 15.0
+    assert number('.5') == 0.5
+    assert number('INF') is None
+    assert number('100.0MH') is None
+
+
+def test_simulator_replies(network, sim):
+    assert parse_reply(network.call_and_response('01 DIA')).value() == 15.0
+    reply = parse_reply(network.call_and_response('01 DIA 99.0'))
+    assert reply.error == '?OOR'
+    network.call_and_response('01 RAT 100.0')
+    network.call_and_response('01 VOL 1.0')
+    assert parse_reply(network.call_and_response('01 RUN')).status == INFUSING
+    network.wait_until_stopped(1)
+    infused, withdrawn, units = parse_reply(network.call_and_response('01 DIS')).dispensed()
+    assert (withdrawn, units) == (0.0, 'ML')
+    assert abs(infused - 1.0) < 0.1
+    sim.alarm(2)
+    assert parse_reply(network.call_and_response('02')).alarm == 'S'
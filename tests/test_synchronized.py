@@ -0,0 +1,100 @@
+import socket
+import time
+
+import pytest
+
+import pumpsim
+from pumpnetwork import BridgePool, NE500Network, fire_synchronized, run_synchronized
+from pumpreply import parse_reply
+
+COMMANDSET = {'RAT': '100.0', 'VOL': '1.0', 'DIR': 'INF'}
+
+
+@pytest.fixture
+def sims():
+    sims = dict((name, pumpsim.BridgeSimulator(npumps=2, speed=1e6).start())
+        for name in ('a', 'b'))
+    yield sims
+    for sim in sims.values():
+        sim.stop()
+
+
+@pytest.fixture
+def pool(sims):
+    def factory(address, port, **kwargs):
+        host, port = sims[address].address
+        return NE500Network(host, port, **kwargs)
+
+    pool = BridgePool(factory, npumps=2, reply_timeout=1.0)
+    yield pool
+    pool.close_all()
+
+
+def test_run_synchronized(sims, pool):
+    result = run_synchronized({1: 'a', 2: 'b'}, 0, pumps=(1, 2), commandset=COMMANDSET,
+        pool=pool)
+    assert sorted(result['pumps']) == [(1, 1), (1, 2), (2, 1), (2, 2)]
+    assert all(r['status'] == 'I' for r in result['pumps'].values())
+    assert min(r['skew'] for r in result['pumps'].values()) == 0
+    assert result['spread'] >= 0
+    assert all(sim.pumps[p].vol == 1.0 for sim in sims.values() for p in (1, 2))
+
+
+def test_setup_that_cannot_be_armed_starts_nothing(sims, pool):
+    sims['b'].alarm(2)
+    with pytest.raises(IOError):
+        run_synchronized({1: 'a', 2: 'b'}, 0, commandset=COMMANDSET, pool=pool)
+    assert not any(pump.running for pump in sims['a'].pumps.values())
+
+
+def test_arm_line_too_long(network):
+    network.max_burst_length = 10
+    with pytest.raises(IOError):
+        network.arm([1, 2])
+
+
+def networks(sims, reader):
+    result = []
+    for name in ('a', 'b'):
+        n = NE500Network(sims[name].address[0], sims[name].address[1], npumps=2,
+            reply_timeout=1.0)
+        n.call_and_response('01 RAT 100.0')
+        if reader:
+            n.start_reader()
+        result.append(n)
+    return result
+
+
+@pytest.mark.parametrize('reader', [False, True])
+def test_fire_with_a_failing_bridge(sims, reader):
+    a, b = networks(sims, reader)
+    try:
+        # as if the connection to b had gone
+        b.socket.shutdown(socket.SHUT_WR)
+        with pytest.raises(IOError) as E:
+            fire_synchronized([('a', a, [1], b'01 RUN\r'), ('b', b, [1], b'01 RUN\r')])
+        assert "went out to ['a']" in str(E.value)
+        assert sims['a'].pumps[1].running or sims['a'].pumps[1].dispensed['INF'] > 0
+        # the RUN reply was collected, not left for the next command
+        assert parse_reply(a.call_and_response('01 DIA')).value() == 15.0
+        if reader:
+            assert not any(b.reader.waiting.values())
+        else:
+            assert a.read() == b''
+    finally:
+        for n in (a, b):
+            n.stop_reader()
+            n.disconnect()
+
+
+def test_arm_timeout_is_shared(network):
+    # pump 1 stops after about 0.5 s, pump 2 runs on (VOL 0: continuous)
+    for p, vol in ((1, 139.0), (2, 0)):
+        network.call_and_response('%02i RAT 1.0' % p)
+        network.call_and_response('%02i VOL %s' % (p, vol))
+        network.call_and_response('%02i RUN' % p)
+    tic = time.time()
+    with pytest.raises(IOError):
+        network.arm([1, 2], timeout=1.0)
+    assert network.status(1) == 'S'
+    assert time.time() - tic < 1.05
@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+
+from pumptrace import COMMANDS, ERROR_CODES, LOG_FIELDS, BinaryLog, RingBuffer, iter_log, \
+    read_log
+
+
+def test_records(network):
+    ring = RingBuffer(10)
+    network.add_hook(ring)
+    reply = network.call_and_response('01 DIA')
+    [record] = ring.records()
+    assert (record.pump, record.command, record.name, record.status) == (1, '01 DIA', 'DIA', 'S')
+    assert record.bytes_sent == len(b'01 DIA\r')
+    assert record.bytes_received == len(reply)
+    assert record.error is None
+
+
+def test_records_with_a_reader(network, sim):
+    network.start_reader()
+    sim.network.latency = 0.05
+    ring = RingBuffer(10)
+    stop = threading.Event()
+
+    def chatter():
+        while not stop.is_set():
+            network.call_and_response('02')
+
+    thread = threading.Thread(target=chatter)
+    thread.start()
+    try:
+        network.add_hook(ring)
+        reply = network.call_and_response('01 DIA')
+        network.remove_hook(ring)
+    finally:
+        stop.set()
+        thread.join()
+    record = [r for r in ring.records() if r.pump == 1][0]
+    # only this exchange's traffic, and the time the reply took
+    assert record.bytes_sent == len(b'01 DIA\r')
+    assert record.bytes_received == len(reply)
+    assert 0.04 < record.select_wait <= record.duration
+
+
+def log_session(network, path):
+    log = BinaryLog(str(path), setups={network.address: 3})
+    network.add_hook(log)
+    network.call_and_response('01 VOL 0.02')
+    network.call_and_response('01 DIR INF')
+    network.call_and_response('01 DIA 99.0')
+    network.call_and_response('02 DIS')
+    network.remove_hook(log)
+    log.close()
+
+
+def test_binary_log(network, tmp_path):
+    path = tmp_path / 'session.ne500'
+    log_session(network, path)
+    records = list(iter_log(str(path)))
+    assert len(records) == 4
+    fields = [name for name, dtype in LOG_FIELDS]
+    vol, dir, dia, dis = [dict(zip(fields, r)) for r in records]
+    assert (vol['setup'], vol['pump'], vol['command']) == (3, 1, COMMANDS.index('VOL'))
+    assert abs(vol['param'] - 0.02) < 1e-6
+    assert (dir['arg'].rstrip(b'\x00'), dir['status']) == (b'INF', b'S')
+    assert dia['error'] == ERROR_CODES['?OOR']
+    assert (dis['pump'], dis['infused'], dis['withdrawn']) == (2, 0.0, 0.0)
+
+
+def test_read_log(network, tmp_path):
+    pytest.importorskip('numpy')
+    path = tmp_path / 'session.ne500'
+    log_session(network, path)
+    # appending to the same file keeps one header
+    log_session(network, path)
+    log = read_log(str(path))
+    assert len(log) == 8
+    vol = log[log['command'] == COMMANDS.index('VOL')]
+    assert list(vol['pump']) == [1, 1]
+    assert (log['error'] == ERROR_CODES['?OOR']).sum() == 2
+
+
+def test_not_a_log(tmp_path):
+    path = tmp_path / 'other'
+    path.write_bytes(b'something else')
+    with pytest.raises(ValueError):
+        list(iter_log(str(path)))
@@ -0,0 +1,54 @@
+import time
+
+from pumpvolume import VolumeLedger, combined_totals
+
+
+def deliver(network, pump, volume):
+    network.set_param(pump, 'RAT', '100.0')
+    network.infuse(pump, volume)
+    network.wait_until_stopped(pump)
+
+
+def close(a, b):
+    return all(abs(x - y) < 0.1 for x, y in zip(a, b))
+
+
+def test_sample(network):
+    ledger = VolumeLedger(network, setup=1, after_run=False)
+    deliver(network, 1, 1.0)
+    assert ledger.sample() == []
+    totals = ledger.totals()
+    assert close(totals[1], (1.0, 0.0))
+    assert totals[2] == (0.0, 0.0)
+    assert close(combined_totals([ledger])[(1, 1)], (1.0, 0.0))
+
+
+def test_counters_cleared_elsewhere_are_carried(network):
+    ledger = VolumeLedger(network, after_run=False)
+    deliver(network, 1, 1.0)
+    ledger.sample()
+    # cleared, and read again before it is back at 1.0
+    network.call_and_response('01 CLD INF')
+    deliver(network, 1, 0.5)
+    ledger.sample()
+    assert close(ledger.totals()[1], (1.5, 0.0))
+
+
+def test_new_session(network, sim):
+    ledger = VolumeLedger(network, after_run=False)
+    deliver(network, 2, 1.0)
+    session = ledger.new_session('next')
+    assert close(session['volumes'][2], (1.0, 0.0))
+    assert ledger.session['name'] == 'next'
+    assert ledger.totals()[2] == (0.0, 0.0)
+    assert sim.pumps[2].dispensed == {'INF': 0.0, 'WDR': 0.0}
+
+
+def test_read_after_run(network):
+    with VolumeLedger(network, settle=0.01) as ledger:
+        deliver(network, 1, 1.0)
+        deadline = time.time() + 2.0
+        while ledger.sampled[1] is None and time.time() < deadline:
+            time.sleep(0.01)
+        assert close(ledger.totals()[1], (1.0, 0.0))
+    assert ledger._on_record not in network.hooks